@@ -0,0 +1,50 @@
+#!/usr/local/bin/python3
+"""
+Micro-benchmark for the AWS client registry.
+
+Compares the cost of the boto3 objects a single `/email` or `/sms` request
+used to build for itself (a DynamoDB resource and Table plus an SES or SNS
+client) against fetching the same objects from `meerkat_hermes.clients`. No
+AWS calls are made, only client construction is timed.
+
+Run:
+    `python benchmarks/bench_clients.py [--repeat N]`
+"""
+from meerkat_hermes import app, clients
+import argparse
+import timeit
+import boto3
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--repeat', type=int, default=50,
+                    help='Number of simulated requests to time.')
+args = parser.parse_args()
+
+
+def per_request_construction():
+    db = boto3.resource(
+        'dynamodb',
+        endpoint_url=app.config['DB_URL'],
+        region_name='eu-west-1'
+    )
+    db.Table(app.config['LOG'])
+    boto3.client('ses', region_name='eu-west-1')
+    boto3.client('sns', region_name='eu-west-1')
+
+
+def registry_lookup():
+    clients.table(app.config['LOG'])
+    clients.client('ses')
+    clients.client('sns')
+
+
+# Warm up the registry so only the steady state is measured.
+registry_lookup()
+
+for name, function in [('per-request boto3', per_request_construction),
+                       ('client registry', registry_lookup)]:
+    seconds = timeit.timeit(function, number=args.repeat)
+    print("{:<20} {:>10.3f} ms per request".format(
+        name,
+        seconds * 1000 / args.repeat
+    ))
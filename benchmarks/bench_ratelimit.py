@@ -0,0 +1,73 @@
+#!/usr/local/bin/python3
+"""
+Benchmark for the publish rate limiter under burst load.
+
+Fires a burst of calls at the old CALL_TIMES list limiter and at the sliding
+window limiter in `meerkat_hermes.ratelimit`, and reports the time per call
+and the memory each holds after the burst. The old limiter appends every call
+to a list and pops expired calls from its front, so its cost grows with the
+burst. The sliding window keeps two counters per limit.
+
+The dynamodb backend is only timed with --dynamodb, as it makes real calls to
+the configured RATE_LIMITS table.
+
+Run:
+    `python benchmarks/bench_ratelimit.py [--burst N] [--dynamodb]`
+"""
+from meerkat_hermes import app, ratelimit
+from datetime import datetime, timedelta
+import argparse
+import time
+import uuid
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--burst', type=int, default=100000,
+                    help='Number of calls in the burst.')
+parser.add_argument('--dynamodb', action='store_true',
+                    help='Also time the dynamodb backend (100 calls).')
+args = parser.parse_args()
+
+
+def call_times_limiter(call_times, limit):
+    # The limiter previously used by util.limit_exceeded().
+    call_times.append(datetime.now())
+    while call_times[0] < datetime.now()-timedelta(hours=1):
+        call_times.pop(0)
+    return len(call_times) > limit
+
+
+def time_burst(function, calls):
+    start = time.perf_counter()
+    for i in range(calls):
+        function()
+    return (time.perf_counter() - start) * 1e6 / calls
+
+
+limit = app.config['PUBLISH_RATE_LIMIT']
+call_times = []
+seconds = time_burst(lambda: call_times_limiter(call_times, limit), args.burst)
+print("{:<24} {:>8.2f} us per call, {:>8} entries held".format(
+    'CALL_TIMES list', seconds, len(call_times)
+))
+
+# An hour after the burst, every call pops from the front of the list.
+call_times[:] = [datetime.now() - timedelta(hours=2)] * args.burst
+seconds = time_burst(lambda: call_times_limiter(call_times, limit), 1)
+print("{:<24} {:>8.2f} us for the first call after the burst expires".format(
+    'CALL_TIMES list', seconds
+))
+
+app.config['RATE_LIMIT_BACKEND'] = 'local'
+scope = 'bench:' + uuid.uuid4().hex
+seconds = time_burst(lambda: ratelimit.hit(scope) > limit, args.burst)
+print("{:<24} {:>8.2f} us per call, {:>8} entries held".format(
+    'sliding window (local)', seconds, len(ratelimit.backend().counters)
+))
+
+if args.dynamodb:
+    app.config['RATE_LIMIT_BACKEND'] = 'dynamodb'
+    scope = 'bench:' + uuid.uuid4().hex
+    seconds = time_burst(lambda: ratelimit.hit(scope) > limit, 100)
+    print("{:<24} {:>8.2f} us per call".format(
+        'sliding window (dynamodb)', seconds
+    ))
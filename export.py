@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Exports the subscribers or the message log as CSV or NDJSON, streaming the
+table to a file (or stdout) as it is scanned, so that even very large tables
+export in constant memory.
+
+Run e.g.:
+    `export.py subscribers --format csv --output subscribers.csv`
+    `export.py log --start 2017-06-01 --end 2017-07-01 --segments 8`
+"""
+from meerkat_hermes import app, export
+import argparse
+import sys
+
+parser = argparse.ArgumentParser()
+parser.add_argument('table', choices=sorted(export.TABLES),
+                    help='The table to export.')
+parser.add_argument('--format', choices=sorted(export.FORMATS),
+                    default='ndjson', help='The export format.')
+parser.add_argument('--segments', type=int,
+                    default=app.config['SCAN_SEGMENTS'],
+                    help='The number of segments to scan in parallel.')
+parser.add_argument('--start',
+                    help='Only export log messages sent from this UTC date.')
+parser.add_argument('--end',
+                    help='Only export log messages sent before this UTC date.')
+parser.add_argument('--columns',
+                    help='A comma separated list of attributes to export.')
+parser.add_argument('--output',
+                    help='The file to write to. Defaults to stdout.')
+args = parser.parse_args()
+
+columns = args.columns.split(',') if args.columns else None
+try:
+    chunks = export.export(args.table, args.format, max(args.segments, 1),
+                           args.start, args.end, columns)
+except ValueError as e:
+    parser.error(str(e))
+
+output = open(args.output, 'w', newline='') if args.output else sys.stdout
+try:
+    for chunk in chunks:
+        output.write(chunk)
+finally:
+    if args.output:
+        output.close()
@@ -9,6 +9,7 @@ Run:
     `local_db.py --clear` (To get rid of any existing db)
     `local_db.py --setup` (To setup the db tables)
     `local_db.py --populate` (To populate the tables with accounts & roles)
+    `local_db.py --index` (To rebuild the topic index from the subscribers)
     `local_db.py --list` (To list the acounts in the db)
 
 If no flag is provided (i.e. you just run `local_db.py`) it will perform all
@@ -45,6 +46,11 @@ parser.add_argument(
     help='Populate the local dynamodb development database.',
     action='store_true'
 )
+parser.add_argument(
+    '--index',
+    help='Rebuild the topic index from the subscribers table.',
+    action='store_true'
+)
 args = parser.parse_args()
 args_dict = vars(args)
 
@@ -66,6 +72,9 @@ if args.clear:
         print('Cleaning the dev db.')
         response = db.Table(app.config['SUBSCRIBERS']).delete()
         response = db.Table(app.config['LOG']).delete()
+        response = db.Table(app.config['DELIVERIES']).delete()
+        response = db.Table(app.config['SUBSCRIPTIONS']).delete()
+        response = db.Table(app.config['RATE_LIMITS']).delete()
         print('Cleaned the db.')
     except Exception as e:
         print(e)
@@ -88,7 +97,8 @@ if args.setup:
         TableName=app.config['SUBSCRIBERS'],
         AttributeDefinitions=[
             {'AttributeName': 'id', 'AttributeType': 'S'},
-            {'AttributeName': 'email', 'AttributeType': 'S'}
+            {'AttributeName': 'email', 'AttributeType': 'S'},
+            {'AttributeName': 'country', 'AttributeType': 'S'}
         ],
         KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
         ProvisionedThroughput={
@@ -106,6 +116,17 @@ if args.setup:
                 'ReadCapacityUnits': 1,
                 'WriteCapacityUnits': 1
             }
+        }, {
+            'IndexName': app.config['SUBSCRIBERS_COUNTRY_INDEX'],
+            'KeySchema': [{
+                'AttributeName': 'country',
+                'KeyType': 'HASH'
+            }],
+            'Projection': {'ProjectionType': 'ALL'},
+            'ProvisionedThroughput': {
+                'ReadCapacityUnits': 1,
+                'WriteCapacityUnits': 1
+            }
         }],
     )
     print("Table {} status: {}".format(
@@ -117,7 +138,9 @@ if args.setup:
         TableName=app.config['LOG'],
         AttributeDefinitions=[
             {'AttributeName': 'id', 'AttributeType': 'S'},
-            {'AttributeName': 'message', 'AttributeType': 'S'}
+            {'AttributeName': 'message', 'AttributeType': 'S'},
+            {'AttributeName': 'day', 'AttributeType': 'S'},
+            {'AttributeName': 'timestamp', 'AttributeType': 'S'}
         ],
         KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
         ProvisionedThroughput={
@@ -135,6 +158,20 @@ if args.setup:
                 'ReadCapacityUnits': 1,
                 'WriteCapacityUnits': 1
             }
+        }, {
+            'IndexName': app.config['LOG_TIME_INDEX'],
+            'KeySchema': [{
+                'AttributeName': 'day',
+                'KeyType': 'HASH'
+            }, {
+                'AttributeName': 'timestamp',
+                'KeyType': 'RANGE'
+            }],
+            'Projection': {'ProjectionType': 'ALL'},
+            'ProvisionedThroughput': {
+                'ReadCapacityUnits': 1,
+                'WriteCapacityUnits': 1
+            }
         }],
     )
     print("Table {} status: {}".format(
@@ -142,6 +179,67 @@ if args.setup:
         response['TableDescription'].get('TableStatus')
     ))
 
+    response = db.create_table(
+        TableName=app.config['DELIVERIES'],
+        AttributeDefinitions=[
+            {'AttributeName': 'log_id', 'AttributeType': 'S'},
+            {'AttributeName': 'delivery_id', 'AttributeType': 'S'}
+        ],
+        KeySchema=[
+            {'AttributeName': 'log_id', 'KeyType': 'HASH'},
+            {'AttributeName': 'delivery_id', 'KeyType': 'RANGE'}
+        ],
+        ProvisionedThroughput={
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        }
+    )
+    print("Table {} status: {}".format(
+        app.config['DELIVERIES'],
+        response['TableDescription'].get('TableStatus')
+    ))
+
+    response = db.create_table(
+        TableName=app.config['SUBSCRIPTIONS'],
+        AttributeDefinitions=[
+            {'AttributeName': 'topicID', 'AttributeType': 'S'},
+            {'AttributeName': 'subscriberID', 'AttributeType': 'S'}
+        ],
+        KeySchema=[
+            {'AttributeName': 'topicID', 'KeyType': 'HASH'},
+            {'AttributeName': 'subscriberID', 'KeyType': 'RANGE'}
+        ],
+        ProvisionedThroughput={
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        }
+    )
+    print("Table {} status: {}".format(
+        app.config['SUBSCRIPTIONS'],
+        response['TableDescription'].get('TableStatus')
+    ))
+
+    response = db.create_table(
+        TableName=app.config['RATE_LIMITS'],
+        AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+        KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+        ProvisionedThroughput={
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        }
+    )
+    db.update_time_to_live(
+        TableName=app.config['RATE_LIMITS'],
+        TimeToLiveSpecification={
+            'Enabled': True,
+            'AttributeName': 'expires'
+        }
+    )
+    print("Table {} status: {}".format(
+        app.config['RATE_LIMITS'],
+        response['TableDescription'].get('TableStatus')
+    ))
+
 # Put initial fake data into the database.
 if args.populate:
 
@@ -173,6 +271,12 @@ if args.populate:
 
     print('Populated dev db.')
 
+# Rebuild the topic index for any subscribers that were added without it.
+if args.index:
+    print('Rebuilding the topic index.')
+    count = util.rebuild_subscriptions()
+    print('Indexed {} verified subscribers.'.format(count))
+
 # Finally list all items in the database, so we know what it is populated with.
 if args.list:
     print('Listing data in the database.')
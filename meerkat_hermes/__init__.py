@@ -8,7 +8,6 @@ from flask_restful import Api
 from raven.contrib.flask import Sentry
 from functools import wraps
 from meerkat_libs.auth_client import auth
-import boto3
 import logging
 import os
 
@@ -71,30 +70,42 @@ def authorise(f):
     return decorated
 
 
-# Import the API resources
+# Import the AWS client registry and the API resources
 # Import them after creating the app, because they depend upon the app.
+from meerkat_hermes import clients
 from meerkat_hermes.resources.subscribe import Subscribe
 from meerkat_hermes.resources.subscribers import Subscribers
+from meerkat_hermes.resources.bulk import BulkSubscribe, BulkUnsubscribe
 from meerkat_hermes.resources.email import Email
 from meerkat_hermes.resources.sms import Sms
-from meerkat_hermes.resources.gcm import Gcm
-from meerkat_hermes.resources.publish import Publish, Error, Notify
+from meerkat_hermes.resources.gcm import Gcm, GcmBatch
+from meerkat_hermes.resources.publish import (
+    Publish, PublishStatus, Error, Notify
+)
 from meerkat_hermes.resources.log import Log
 from meerkat_hermes.resources.verify import Verify
 from meerkat_hermes.resources.unsubscribe import Unsubscribe
+from meerkat_hermes.resources.metrics import Metrics
+from meerkat_hermes.resources.export import Export
 
 # Add the API  resources.
 api.add_resource(Subscribe, "/subscribe", "/subscribe/<string:subscriber_id>")
 api.add_resource(Subscribers, "/subscribers/<string:country>")
+api.add_resource(BulkSubscribe, "/subscribe/bulk")
+api.add_resource(BulkUnsubscribe, "/unsubscribe/bulk")
 api.add_resource(Email, "/email")
 api.add_resource(Sms, "/sms")
 api.add_resource(Gcm, "/gcm")
+api.add_resource(GcmBatch, "/gcm/batch")
 api.add_resource(Publish, "/publish")
+api.add_resource(PublishStatus, "/publish/<string:message_id>/status")
 api.add_resource(Error, "/error")
 api.add_resource(Notify, "/notify")
-api.add_resource(Log, "/log/<string:log_id>")
+api.add_resource(Log, "/log", "/log/<string:log_id>")
 api.add_resource(Verify, "/verify", "/verify/<string:subscriber_id>")
 api.add_resource(Unsubscribe, "/unsubscribe/<string:subscriber_id>")
+api.add_resource(Metrics, "/metrics")
+api.add_resource(Export, "/export/<string:table>")
 
 
 # display something at /
@@ -105,10 +116,5 @@ def hello_world():
     This method loads a dynamodb table and displays its creation date.
     """
     logging.warning("Index called")
-    db = boto3.resource(
-        'dynamodb',
-        endpoint_url=app.config['DB_URL'],
-        region_name='eu-west-1'
-    )
-    table = db.Table(app.config['SUBSCRIBERS'])
+    table = clients.table(app.config['SUBSCRIBERS'])
     return table.creation_date_time.strftime('%d/%m/%Y')
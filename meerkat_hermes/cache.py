@@ -0,0 +1,257 @@
+"""
+cache.py
+
+An in-process read-through cache for subscriber records and topic membership
+lists, which change a few times a day but are read on every publish.
+
+Each namespace (e.g. 'subscribers' or 'topics') is a least recently used
+cache of at most CACHE_SIZE entries, each kept for at most CACHE_TTL seconds.
+A CACHE_SIZE of 0 turns caching off. Entries are invalidated when hermes
+changes the underlying records.
+
+Invalidations are shared between processes by a backend, chosen with the
+CACHE_BACKEND config. The 'local' backend only invalidates this process's
+cache, suitable for development and testing. The 'dynamodb' backend also adds
+one to a shared generation counter for the namespace, in the RATE_LIMITS
+counters table. Every process checks the counters at most once every
+CACHE_SYNC_INTERVAL seconds and clears any namespace whose generation has
+changed, so that other uwsgi workers never serve stale records for long.
+"""
+from meerkat_hermes import app, clients
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache(object):
+    """
+    A thread safe least recently used cache with a time to live, counting its
+    hits and misses.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.generation = None
+        self.last_sync = 0
+
+    def get(self, key):
+        """
+        Gets a cached value, counting a hit or a miss.
+
+        Args:
+            key (str): Required. The entry's key.
+
+        Returns:
+            The cached value, or None if it isn't cached or has expired.
+        """
+        with self.lock:
+            value, expires = self.entries.get(key, (None, 0))
+            if expires < time.time():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Caches a value, evicting the least recently used entry if the cache
+        is full.
+
+        Args:
+            key (str): Required. The entry's key.
+            value: Required. The value to cache. Must not be None.
+        """
+        size = app.config['CACHE_SIZE']
+        if not size:
+            return
+        with self.lock:
+            self.entries[key] = (value, time.time() + app.config['CACHE_TTL'])
+            self.entries.move_to_end(key)
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+
+    def delete(self, keys):
+        """
+        Removes the given keys from the cache.
+        """
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        """
+        Removes every entry from the cache.
+        """
+        with self.lock:
+            self.entries.clear()
+
+
+class LocalBackend(object):
+    """
+    Shares invalidations with no other process.
+    """
+
+    def bump(self, namespace):
+        """
+        Records that a namespace has changed.
+
+        Returns:
+            The namespace's new generation, or None if not tracked.
+        """
+        return None
+
+    def generation(self, namespace):
+        """
+        Returns the namespace's current generation, or None if not tracked.
+        """
+        return None
+
+
+class DynamoDBBackend(object):
+    """
+    Shares invalidations through generation counters in the RATE_LIMITS
+    DynamoDB table.
+    """
+
+    def bump(self, namespace):
+        """
+        Records that a namespace has changed.
+
+        Returns:
+            The namespace's new generation.
+        """
+        response = clients.table(app.config['RATE_LIMITS']).update_item(
+            Key={'id': 'cache:' + namespace},
+            UpdateExpression='ADD #count :one',
+            ExpressionAttributeNames={'#count': 'count'},
+            ExpressionAttributeValues={':one': 1},
+            ReturnValues='UPDATED_NEW'
+        )
+        return int(response['Attributes']['count'])
+
+    def generation(self, namespace):
+        """
+        Returns the namespace's current generation.
+        """
+        response = clients.table(app.config['RATE_LIMITS']).get_item(
+            Key={'id': 'cache:' + namespace},
+            ConsistentRead=True
+        )
+        return int(response.get('Item', {}).get('count', 0))
+
+
+BACKENDS = {
+    'local': LocalBackend,
+    'dynamodb': DynamoDBBackend
+}
+
+_backends = {}
+_caches = {}
+_lock = threading.Lock()
+
+
+def backend():
+    """
+    Returns the invalidation backend selected by the CACHE_BACKEND config.
+    """
+    name = app.config['CACHE_BACKEND']
+    if name not in _backends:
+        with _lock:
+            if name not in _backends:
+                _backends[name] = BACKENDS[name]()
+    return _backends[name]
+
+
+def _cache(namespace):
+    # Returns the namespace's cache, created on first use.
+    if namespace not in _caches:
+        with _lock:
+            if namespace not in _caches:
+                _caches[namespace] = LRUCache()
+    return _caches[namespace]
+
+
+def _sync(namespace, cache):
+    # Clears the cache if another process has changed the namespace.
+    now = time.time()
+    if now - cache.last_sync < app.config['CACHE_SYNC_INTERVAL']:
+        return
+    cache.last_sync = now
+    generation = backend().generation(namespace)
+    if generation != cache.generation:
+        cache.clear()
+        cache.generation = generation
+
+
+def get(namespace, key):
+    """
+    Gets a value from a namespace's cache.
+
+    Args:
+        namespace (str): Required. The cache namespace e.g. 'subscribers'.
+        key (str): Required. The entry's key e.g. a subscriber ID.
+
+    Returns:
+        The cached value, or None if it isn't cached.
+    """
+    if not app.config['CACHE_SIZE']:
+        return None
+    cache = _cache(namespace)
+    _sync(namespace, cache)
+    return cache.get(key)
+
+
+def set(namespace, key, value):
+    """
+    Caches a value in a namespace. Cached values are shared, so they must not
+    be modified once cached.
+
+    Args:
+        namespace (str): Required. The cache namespace e.g. 'subscribers'.
+        key (str): Required. The entry's key e.g. a subscriber ID.
+        value: Required. The value to cache. Must not be None.
+    """
+    _cache(namespace).set(key, value)
+
+
+def invalidate(namespace, keys):
+    """
+    Removes entries from a namespace's cache, in this process and, through
+    the backend, in every other process.
+
+    Args:
+        namespace (str): Required. The cache namespace e.g. 'subscribers'.
+        keys ([str]): Required. The keys of the changed entries.
+    """
+    cache = _cache(namespace)
+    cache.delete(keys)
+    generation = backend().bump(namespace)
+
+    # Only this process's change can be skipped by the next sync.
+    if generation is not None and generation - 1 == cache.generation:
+        cache.generation = generation
+
+
+def stats():
+    """
+    Returns the size and hit/miss counts of each namespace's cache, as a
+    dict of dicts indexed by namespace.
+    """
+    return {namespace: {
+        'size': len(cache.entries),
+        'hits': cache.hits,
+        'misses': cache.misses
+    } for namespace, cache in list(_caches.items())}
+
+
+def clear():
+    """
+    Clears every namespace's cache in this process.
+    """
+    for cache in list(_caches.values()):
+        cache.clear()
@@ -0,0 +1,173 @@
+"""
+clients.py
+
+A process-wide registry of AWS clients, DynamoDB table handles and the HTTP
+session used to post to Slack and GCM.
+
+Building a boto3 client parses botocore's service models and opens a new
+connection pool, which used to dominate the latency of single sends. Clients
+are therefore created lazily, once per process, and reused. Clients are
+thread-safe and shared between threads. DynamoDB resources are not, so table
+handles are cached once per thread instead.
+
+Likewise, outbound HTTP requests share one keep-alive session, so that
+repeated posts to the same host reuse a pooled connection instead of paying
+for a new TCP and TLS handshake each time.
+"""
+from meerkat_hermes import app
+from requests.adapters import HTTPAdapter
+import botocore.config
+import threading
+import requests
+import boto3
+
+_lock = threading.RLock()
+_session = None
+_clients = {}
+_http = None
+_local = threading.local()
+
+
+class HTTPSession(requests.Session):
+    """
+    A requests session that applies the HTTP_CONNECT_TIMEOUT and
+    HTTP_READ_TIMEOUT configs to every request that doesn't set its own
+    timeout, so that a hung endpoint can't hold a worker forever.
+    """
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault('timeout', (
+            app.config['HTTP_CONNECT_TIMEOUT'],
+            app.config['HTTP_READ_TIMEOUT']
+        ))
+        return super().request(*args, **kwargs)
+
+
+def session():
+    """
+    Returns the shared boto3 session, creating it on first use.
+    """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = boto3.session.Session()
+    return _session
+
+
+# Services whose sends are retried by hermes, see retry.py, so botocore
+# shouldn't also retry them.
+RETRIED_SERVICES = ['ses', 'sns']
+
+
+def _client_config(service=None):
+    kwargs = {}
+    if service in RETRIED_SERVICES:
+        kwargs['retries'] = {'total_max_attempts': 1}
+    return botocore.config.Config(
+        max_pool_connections=app.config['AWS_MAX_POOL_CONNECTIONS'],
+        **kwargs
+    )
+
+
+def client(service):
+    """
+    Returns a shared boto3 client for the given AWS service. DynamoDB clients
+    connect to the configured DB_URL.
+
+    Args:
+        service (str): Required. The AWS service name e.g. 'ses' or 'sns'.
+
+    Returns:
+        The boto3 client.
+    """
+    endpoint_url = app.config['DB_URL'] if service == 'dynamodb' else None
+    key = (service, endpoint_url, app.config['AWS_REGION'])
+    if key not in _clients:
+        # Sessions are not thread-safe, so create clients under the lock.
+        with _lock:
+            if key not in _clients:
+                _clients[key] = session().client(
+                    service,
+                    endpoint_url=endpoint_url,
+                    region_name=app.config['AWS_REGION'],
+                    config=_client_config(service)
+                )
+    return _clients[key]
+
+
+def dynamodb():
+    """
+    Returns this thread's DynamoDB service resource, creating it on first
+    use.
+
+    Returns:
+        The boto3 DynamoDB service resource.
+    """
+    key = (app.config['DB_URL'], app.config['AWS_REGION'])
+    resources = _local.__dict__.setdefault('resources', {})
+    if key not in resources:
+        with _lock:
+            resources[key] = session().resource(
+                'dynamodb',
+                endpoint_url=app.config['DB_URL'],
+                region_name=app.config['AWS_REGION'],
+                config=_client_config()
+            )
+    return resources[key]
+
+
+def table(name):
+    """
+    Returns this thread's handle on the named DynamoDB table.
+
+    Args:
+        name (str): Required. The table name, typically from the app config.
+
+    Returns:
+        The boto3 DynamoDB Table resource.
+    """
+    tables = _local.__dict__.setdefault('tables', {})
+    key = (app.config['DB_URL'], app.config['AWS_REGION'], name)
+    if key not in tables:
+        tables[key] = dynamodb().Table(name)
+    return tables[key]
+
+
+def http():
+    """
+    Returns the shared HTTP session, creating it on first use. Each host gets
+    a pool of at most HTTP_POOL_SIZE keep-alive connections.
+
+    Returns:
+        The requests session.
+    """
+    global _http
+    if _http is None:
+        with _lock:
+            if _http is None:
+                adapter = HTTPAdapter(
+                    pool_connections=app.config['HTTP_POOL_HOSTS'],
+                    pool_maxsize=app.config['HTTP_POOL_SIZE'],
+                    pool_block=True
+                )
+                session = HTTPSession()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _http = session
+    return _http
+
+
+def reset():
+    """
+    Forget every cached client and table, e.g. after the config has changed
+    or in a forked worker process.
+    """
+    global _session, _http
+    with _lock:
+        _session = None
+        _clients.clear()
+        if _http is not None:
+            _http.close()
+        _http = None
+    _local.__dict__.clear()
@@ -0,0 +1,204 @@
+"""
+coalesce.py
+
+Coalesces bursts of slack notifications into digests, so that an error storm
+stays readable and within slack's webhook rate limit of about one post per
+second per channel.
+
+The first message to a channel opens a window of SLACK_COALESCE_WINDOW
+seconds. Every message to the channel within the window is added to a single
+digest, posted by a background thread when the window closes. Identical
+messages, with the same subject and text, are listed once with a count. A
+digest lists at most SLACK_DIGEST_LINES distinct messages. A window holding a
+single message posts it unchanged. Anything still waiting is posted when the
+process exits.
+"""
+from meerkat_hermes import app, logger
+from collections import OrderedDict
+import threading
+import atexit
+import time
+import os
+
+
+class Digest(object):
+    """
+    The messages waiting to be posted to one channel.
+
+    Args:
+        post (function): Required. Posts a message to slack, called as
+            post(channel, message, subject).
+    """
+
+    def __init__(self, post):
+        self.post = post
+        self.entries = OrderedDict()
+        self.count = 0
+        self.deadline = time.time() + app.config['SLACK_COALESCE_WINDOW']
+
+    def add(self, message, subject):
+        """
+        Adds a message to the digest, counting repeats of the same message.
+        """
+        key = (subject, message)
+        self.entries[key] = self.entries.get(key, 0) + 1
+        self.count += 1
+
+    def render(self):
+        """
+        Returns the digest as a (message, subject) tuple.
+        """
+        if self.count == 1:
+            (subject, message), = self.entries
+            return message, subject
+
+        limit = app.config['SLACK_DIGEST_LINES']
+        lines = []
+        for (subject, message), count in list(self.entries.items())[:limit]:
+            line = "*_{}_* | {}".format(subject, message) if subject \
+                else message
+            if count > 1:
+                line += " (x{})".format(count)
+            lines.append(line)
+        if len(self.entries) > limit:
+            lines.append("...and {} more distinct messages.".format(
+                len(self.entries) - limit
+            ))
+        subject = "{} messages in {}s".format(
+            self.count,
+            app.config['SLACK_COALESCE_WINDOW']
+        )
+        return "\n".join(lines), subject
+
+
+class Coalescer(object):
+    """
+    Collects slack messages into a digest per channel, and posts each digest
+    from a background thread once its window has closed.
+    """
+
+    def __init__(self):
+        self.digests = {}
+        self.condition = threading.Condition()
+        self.received = 0
+        self.posted = 0
+        self.failed = 0
+        self.pid = os.getpid()
+        self.thread = threading.Thread(
+            target=self._run,
+            name='hermes-slack-coalescer',
+            daemon=True
+        )
+        self.thread.start()
+
+    def add(self, channel, message, subject, post):
+        """
+        Adds a message to its channel's digest, opening a new window if
+        there isn't one.
+        """
+        with self.condition:
+            if channel not in self.digests:
+                self.digests[channel] = Digest(post)
+                self.condition.notify()
+            self.digests[channel].add(message, subject)
+            self.received += 1
+
+    def flush(self):
+        """
+        Posts every waiting digest straight away, from the calling thread.
+        """
+        with self.condition:
+            digests = list(self.digests.items())
+            self.digests.clear()
+        for channel, digest in digests:
+            self._post(channel, digest)
+
+    def _run(self):
+        # Wait for the earliest window to close, then post its digest.
+        while True:
+            with self.condition:
+                while True:
+                    now = time.time()
+                    due = [c for c, d in self.digests.items()
+                           if d.deadline <= now]
+                    if due:
+                        break
+                    timeout = None
+                    if self.digests:
+                        timeout = min(
+                            d.deadline for d in self.digests.values()
+                        ) - now
+                    self.condition.wait(timeout)
+                digests = [(c, self.digests.pop(c)) for c in due]
+            for channel, digest in digests:
+                self._post(channel, digest)
+
+    def _post(self, channel, digest):
+        message, subject = digest.render()
+        try:
+            digest.post(channel, message, subject)
+            self.posted += 1
+        except Exception:
+            logger.exception("Failed to post {} messages to {}.".format(
+                digest.count,
+                channel
+            ))
+            self.failed += 1
+
+
+_coalescer = None
+_lock = threading.Lock()
+
+
+def coalescer():
+    """
+    Returns this process's coalescer, starting it if needed. A process forked
+    from one with a coalescer starts its own, as threads aren't copied by
+    fork.
+    """
+    global _coalescer
+    if _coalescer is None or _coalescer.pid != os.getpid():
+        with _lock:
+            if _coalescer is None or _coalescer.pid != os.getpid():
+                _coalescer = Coalescer()
+    return _coalescer
+
+
+def add(channel, message, subject, post):
+    """
+    Queues a slack message to be posted in its channel's next digest.
+
+    Args:
+        channel (str): Required. The channel or username to post to.
+        message (str): Required. The message.
+        subject (str): Required. The message subject, may be empty.
+        post (function): Required. Posts the digest, called as
+            post(channel, message, subject), e.g. util.slack.
+    """
+    coalescer().add(channel, message, subject, post)
+
+
+def flush():
+    """
+    Posts every digest waiting in this process straight away.
+    """
+    if _coalescer is not None and _coalescer.pid == os.getpid():
+        _coalescer.flush()
+
+
+def stats():
+    """
+    Returns the number of slack messages received, the digests posted and
+    failed, and the channels waiting to post, as a dict.
+    """
+    if _coalescer is None or _coalescer.pid != os.getpid():
+        return {'received': 0, 'posted': 0, 'failed': 0, 'waiting': 0}
+    return {
+        'received': _coalescer.received,
+        'posted': _coalescer.posted,
+        'failed': _coalescer.failed,
+        'waiting': len(_coalescer.digests)
+    }
+
+
+atexit.register(flush)
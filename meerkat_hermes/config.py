@@ -15,8 +15,31 @@ class Config(object):
     SUBSCRIBERS = 'hermes_subscribers'
     SUBSCRIPTIONS = 'hermes_subscriptions'
     LOG = 'hermes_log'
+    DELIVERIES = 'hermes_deliveries'
+    RATE_LIMITS = 'hermes_rate_limits'
+    # The subscribers table's index on 'country', used to list a country's
+    # subscribers without scanning the table. '' falls back to scanning.
+    SUBSCRIBERS_COUNTRY_INDEX = 'country-index'
+    # The log table's index on ('day', 'timestamp'), used to list the
+    # messages sent between two times, at most LOG_QUERY_MAX_DAYS apart.
+    LOG_TIME_INDEX = 'day-index'
+    LOG_QUERY_MAX_DAYS = 366
 
     DB_URL = os.environ.get("DB_URL", "http://dynamodb:8000")
+    AWS_REGION = 'eu-west-1'
+    AWS_MAX_POOL_CONNECTIONS = 50
+    # Keep-alive connections to at most HTTP_POOL_HOSTS hosts, and at most
+    # HTTP_POOL_SIZE to each, for Slack and GCM. Timeouts are in seconds.
+    HTTP_POOL_HOSTS = 10
+    HTTP_POOL_SIZE = 10
+    HTTP_CONNECT_TIMEOUT = 5
+    HTTP_READ_TIMEOUT = 15
+    # Number of segments (and threads) for parallel scans of whole tables.
+    SCAN_SEGMENTS = 4
+    # The most parallel scan segments an export may ask for.
+    EXPORT_MAX_SEGMENTS = 16
+    # Rows of a bulk subscribe or unsubscribe written at a time.
+    BULK_CHUNK_SIZE = 100
     ROOT_URL = os.environ.get("MEERKAT_HERMES_ROOT", "/hermes")
 
     SENTRY_DNS = os.environ.get('SENTRY_DNS', '')
@@ -28,8 +51,87 @@ class Config(object):
         'Notifications <notifications@emro.info>'
     )
 
+    # Publish emails with SES bulk templated sends, in batches of at most 50.
+    SES_BULK_EMAIL = True
+    SES_BULK_SIZE = 50
+
+    # Maximum publishes per hour, overall, to any one topic and from any one
+    # caller. 0 means no limit. The 'local' backend counts per process, the
+    # 'dynamodb' backend shares the counts between processes.
     PUBLISH_RATE_LIMIT = int(os.environ.get("MESSAGE_RATE_LIMIT", "100"))
-    CALL_TIMES = []
+    PUBLISH_TOPIC_RATE_LIMIT = int(
+        os.environ.get("MESSAGE_TOPIC_RATE_LIMIT", "0")
+    )
+    PUBLISH_CALLER_RATE_LIMIT = int(
+        os.environ.get("MESSAGE_CALLER_RATE_LIMIT", "0")
+    )
+    RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "local")
+
+    # Cache up to CACHE_SIZE subscribers and topics per process, for at most
+    # CACHE_TTL seconds. 0 means no caching. The 'dynamodb' backend shares
+    # invalidations between processes, checked every CACHE_SYNC_INTERVAL.
+    CACHE_SIZE = 10000
+    CACHE_TTL = 300
+    CACHE_SYNC_INTERVAL = 5
+    CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "local")
+
+    # Write the message log in batches of up to 25 entries, at least every
+    # LOG_FLUSH_INTERVAL seconds, buffering at most LOG_QUEUE_SIZE entries.
+    LOG_BATCH_SIZE = 25
+    LOG_FLUSH_INTERVAL = 1
+    LOG_QUEUE_SIZE = 10000
+
+    # Remember the last DEDUP_CACHE_SIZE message ids exactly, and the ids
+    # seen before them in a Bloom filter, to skip reading the log for new ids.
+    DEDUP_CACHE_SIZE = 10000
+    DEDUP_BLOOM_BITS = 8 * 1024 * 1024
+    DEDUP_BLOOM_CAPACITY = 500000
+
+    # Sends that are throttled, or fail because of a brief outage, are
+    # retried up to RETRY_ATTEMPTS times within RETRY_BUDGET seconds of the
+    # first attempt. Retries wait a random delay of up to RETRY_BASE_DELAY
+    # seconds, doubling with each retry up to RETRY_MAX_DELAY.
+    RETRY_ATTEMPTS = 5
+    RETRY_BASE_DELAY = 0.2
+    RETRY_MAX_DELAY = 10
+    RETRY_BUDGET = 60
+
+    # Pace sends to each provider to stay under its quota, in messages per
+    # second. The SES rate is read from the account's send quota if
+    # PACING_SES_QUOTA is set, every PACING_QUOTA_REFRESH seconds. Only
+    # PACING_HEADROOM of each quota is used, split between the
+    # PACING_PROCESSES processes sending from the same account. 0 means the
+    # processes count themselves through the RATE_LIMIT_BACKEND, which
+    # must then be 'dynamodb' for more than one process.
+    PACING_RATES = {'ses': 14, 'sns': 20, 'slack': 1}
+    PACING_SES_QUOTA = True
+    PACING_QUOTA_REFRESH = 300
+    PACING_HEADROOM = 0.9
+    PACING_PROCESSES = int(os.environ.get("PACING_PROCESSES", "0"))
+
+    # Number of concurrent sends per medium when publishing.
+    PUBLISH_WORKERS = {'email': 10, 'sms': 5, 'slack': 2}
+
+    # Queue publishes to be sent by runworker.py instead of sending them
+    # during the request. Jobs in progress are re-sent by another worker if
+    # they haven't reported progress for PUBLISH_JOB_LEASE seconds.
+    PUBLISH_ASYNC = False
+    PUBLISH_QUEUE = os.environ.get(
+        "PUBLISH_QUEUE",
+        "/tmp/hermes_publish_queue.db"
+    )
+    PUBLISH_JOB_LEASE = 600
+
+    # A claimed message that hasn't changed state for PUBLISH_CLAIM_LEASE
+    # seconds is assumed abandoned, and can be resumed by a retried request.
+    PUBLISH_CLAIM_LEASE = 600
+
+    # How often, in seconds, a message being sent records its progress and
+    # renews its claim. Its deliveries are written at each checkpoint, or
+    # once PUBLISH_CHECKPOINT_DELIVERIES are waiting, so a resumed message
+    # skips the subscribers it was already sent to.
+    PUBLISH_CHECKPOINT_INTERVAL = 10
+    PUBLISH_CHECKPOINT_DELIVERIES = 25
 
     NEXMO_PUBLIC_KEY = ''
     NEXMO_PRIVATE_KEY = ''
@@ -37,8 +139,25 @@ class Config(object):
     ERROR_REPORTING = ['error-reporting']
     NOTIFY_DEV = ['notify-dev']
 
+    # Post the slack messages of errors and notifications sent to a channel
+    # within SLACK_COALESCE_WINDOW seconds as one digest, listing at most
+    # SLACK_DIGEST_LINES distinct messages. 0 posts every message at once.
+    SLACK_COALESCE_WINDOW = 5
+    SLACK_DIGEST_LINES = 20
+    SLACK_WEBHOOK_URL = os.environ.get(
+        "SLACK_WEBHOOK_URL",
+        "https://hooks.slack.com/services/T050E3XPP/"
+        "B0G7UKUCA/EtXIFB3CRGyey2L7x5WbT32B"
+    )
+
     GCM_API_URL = "https://gcm-http.googleapis.com/gcm/send"
     GCM_AUTHENTICATION_KEY = ''
+    # Registration tokens per GCM multicast request, at most 1000. A batch
+    # send waits in the request to retry, so it stops retrying once
+    # GCM_BATCH_RETRY_BUDGET seconds have passed since the request began,
+    # which should be well within the callers' request timeout.
+    GCM_BATCH_SIZE = 1000
+    GCM_BATCH_RETRY_BUDGET = 10
     GCM_ALLOWED_TOPICS = ['/topics/demo']
     GCM_MOCK_RESPONSE_ONLY = 1
 
@@ -53,6 +172,8 @@ class Config(object):
 
 class Production(Config):
     PRODUCTION = True
+    RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "dynamodb")
+    CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "dynamodb")
     LOGGING_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     DB_URL = os.environ.get(
         "DB_URL",
@@ -80,5 +201,12 @@ class Testing(Config):
     SUBSCRIBERS = 'test_hermes_subscribers'
     SUBSCRIPTIONS = 'test_hermes_subscriptions'
     LOG = 'test_hermes_log'
+    DELIVERIES = 'test_hermes_deliveries'
+    RATE_LIMITS = 'test_hermes_rate_limits'
+    RATE_LIMIT_BACKEND = 'local'
+    CACHE_BACKEND = 'local'
+    PACING_RATES = {}
+    PACING_SES_QUOTA = False
+    PUBLISH_QUEUE = '/tmp/test_hermes_publish_queue.db'
     DB_URL = "https://dynamodb.eu-west-1.amazonaws.com"
     GCM_MOCK_RESPONSE_ONLY = 0
@@ -0,0 +1,161 @@
+"""
+dedup.py
+
+Remembers the message ids this process has recently seen, so that checking
+whether a published message id is new doesn't always need to read the log.
+
+Recently seen ids are kept exactly in a least recently used cache of at most
+DEDUP_CACHE_SIZE ids. Every id seen is also added to a Bloom filter of
+DEDUP_BLOOM_BITS bits, which can say an id has definitely not been seen by
+this process using far less memory. A DEDUP_BLOOM_BITS of 0 turns the filter
+off. The filter is emptied once DEDUP_BLOOM_CAPACITY ids have been added, so
+that it doesn't fill up and report every id as possibly seen.
+
+Ids seen by other processes aren't known here, so an id that hasn't been
+seen is only probably new. It must then be claimed with a conditional write
+to the log, see util.claim_id(), which is what finally prevents a message
+being published twice.
+"""
+from meerkat_hermes import app
+from collections import OrderedDict
+import threading
+import hashlib
+
+SEEN = 'seen'
+NEW = 'new'
+MAYBE = 'maybe'
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter of strings, using slices of a blake2b digest as its hash
+    functions.
+    """
+
+    def __init__(self, bits, hashes=7):
+        self.bits = bits
+        self.hashes = hashes
+        self.array = bytearray((bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode('UTF-8')).digest()
+        for i in range(self.hashes):
+            chunk = digest[i * 8:(i + 1) * 8]
+            yield int.from_bytes(chunk, 'little') % self.bits
+
+    def add(self, value):
+        """
+        Adds a string to the filter.
+        """
+        for position in self._positions(value):
+            self.array[position // 8] |= 1 << (position % 8)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(
+            self.array[position // 8] & (1 << (position % 8))
+            for position in self._positions(value)
+        )
+
+
+class Dedup(object):
+    """
+    The ids seen by this process, in an LRU cache and a Bloom filter.
+    """
+
+    def __init__(self):
+        self.recent = OrderedDict()
+        self.bloom = None
+        if app.config['DEDUP_BLOOM_BITS']:
+            self.bloom = BloomFilter(app.config['DEDUP_BLOOM_BITS'])
+        self.lock = threading.Lock()
+
+    def add(self, message_id):
+        """
+        Records that a message id has been seen.
+        """
+        with self.lock:
+            self.recent[message_id] = True
+            self.recent.move_to_end(message_id)
+            while len(self.recent) > app.config['DEDUP_CACHE_SIZE']:
+                self.recent.popitem(last=False)
+            if self.bloom is not None:
+                if self.bloom.count >= app.config['DEDUP_BLOOM_CAPACITY']:
+                    self.bloom = BloomFilter(self.bloom.bits)
+                self.bloom.add(message_id)
+
+    def discard(self, message_id):
+        """
+        Forgets that a message id has been seen, e.g. because its log has
+        been deleted. The Bloom filter can't forget the id, so it will be
+        checked against the log.
+        """
+        with self.lock:
+            self.recent.pop(message_id, None)
+
+    def check(self, message_id):
+        """
+        Checks whether a message id has been seen by this process.
+
+        Returns:
+            SEEN if it has definitely been seen, NEW if it definitely hasn't
+            been seen by this process, or MAYBE if the log must be checked.
+        """
+        with self.lock:
+            if message_id in self.recent:
+                self.recent.move_to_end(message_id)
+                return SEEN
+            if self.bloom is not None and message_id not in self.bloom:
+                return NEW
+            return MAYBE
+
+
+_dedup = None
+_lock = threading.Lock()
+
+
+def dedup():
+    """
+    Returns this process's record of seen message ids.
+    """
+    global _dedup
+    if _dedup is None:
+        with _lock:
+            if _dedup is None:
+                _dedup = Dedup()
+    return _dedup
+
+
+def add(message_id):
+    """
+    Records that a message id has been seen by this process.
+
+    Args:
+        message_id (str): Required. The message id.
+    """
+    dedup().add(message_id)
+
+
+def discard(message_id):
+    """
+    Forgets that a message id has been seen by this process.
+
+    Args:
+        message_id (str): Required. The message id.
+    """
+    dedup().discard(message_id)
+
+
+def check(message_id):
+    """
+    Checks whether a message id has been seen by this process.
+
+    Args:
+        message_id (str): Required. The message id.
+
+    Returns:
+        SEEN if it has definitely been seen, NEW if it definitely hasn't been
+        seen by this process, or MAYBE if the log must be checked.
+    """
+    return dedup().check(message_id)
@@ -0,0 +1,188 @@
+"""
+export.py
+
+Exports whole tables as CSV or newline delimited JSON (NDJSON), for audits
+and backups. Used by the `/export` resource and by `export.py`.
+
+Tables are read with paginated scans, optionally in parallel segments, and
+each item is written out as soon as its page arrives, so only a few pages are
+ever held in memory however large the table. The message log can be limited
+to the messages sent between two UTC dates, which are read day by day from the
+log's time index, as by GET /log, rather than with a scan.
+"""
+from meerkat_hermes import app, logwriter
+from datetime import datetime
+from decimal import Decimal
+import meerkat_hermes.util as util
+import json
+import csv
+import io
+
+# The tables that can be exported, and their config keys.
+TABLES = {'subscribers': 'SUBSCRIBERS', 'log': 'LOG'}
+
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+# The CSV columns of each table, unless others are asked for.
+COLUMNS = {
+    'subscribers': ['id', 'first_name', 'last_name', 'email', 'country',
+                    'sms', 'slack', 'topics', 'verified'],
+    'log': ['id', 'time', 'timestamp', 'medium', 'topics', 'destination',
+            'subject', 'message', 'state', 'delivery_count']
+}
+
+# Write output in chunks of about this many characters.
+CHUNK_SIZE = 64 * 1024
+
+
+def _number(value):
+    # DynamoDB loads numbers as Decimals.
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() \
+            else float(value)
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+def items(table, segments=1, start=None, end=None, columns=None):
+    """
+    Lazily reads every item of a table.
+
+    Args:
+        table (str): Required. 'subscribers' or 'log'.
+        segments (int): The number of segments to scan in parallel, unless
+            the export is dated.
+        start (str): Only export log messages sent at or after this UTC
+            date, see util.parse_time(). Messages logged before the log's
+            time index existed aren't included in dated exports.
+        end (str): Only export log messages sent before this UTC date.
+            Defaults to now if there is a start.
+        columns ([str]): Only read these attributes, and the id. Defaults
+            to whole items.
+
+    Returns:
+        A generator of items, in no particular order.
+
+    Raises:
+        ValueError: If the table is unknown, or the dates are invalid.
+    """
+    if table not in TABLES:
+        raise ValueError("Unknown table {}.".format(table))
+    if (start or end) and table != 'log':
+        raise ValueError("Only the log can be filtered by date.")
+    if end and not start:
+        raise ValueError("A dated export needs a start date.")
+
+    # Include any log entries this process is still writing.
+    if table == 'log':
+        logwriter.flush()
+    if start:
+        start = util.parse_time(start)
+        end = util.parse_time(end) if end else datetime.utcnow()
+        return _dated_log(start, end, columns)
+    kwargs = util.projection_kwargs(columns)
+    return util.parallel_scan(app.config[TABLES[table]], segments, **kwargs)
+
+
+def _dated_log(start, end, columns):
+    # Check the range before the first item is asked for.
+    messages, token = util.query_log(start, end, limit=1000,
+                                     attributes=columns)
+
+    def pages(messages, token):
+        yield from messages
+        while token:
+            messages, token = util.query_log(start, end, limit=1000,
+                                             token=token, attributes=columns)
+            yield from messages
+    return pages(messages, token)
+
+
+def ndjson(rows):
+    """
+    Writes items as newline delimited JSON.
+
+    Args:
+        rows: Required. An iterable of items.
+
+    Returns:
+        A generator of chunks of NDJSON text.
+    """
+    chunk = []
+    size = 0
+    for row in rows:
+        line = json.dumps(row, default=_number) + '\n'
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def to_csv(rows, columns):
+    """
+    Writes items as CSV, with a header row. Attributes not in the columns are
+    left out. Lists are written with their values separated by spaces, and
+    other nested values as JSON.
+
+    Args:
+        rows: Required. An iterable of items.
+        columns ([str]): Required. The attributes to write, in order.
+
+    Returns:
+        A generator of chunks of CSV text.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, columns, extrasaction='ignore')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({key: _cell(value) for key, value in row.items()})
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _cell(value):
+    # Flatten a value into a single CSV cell.
+    if isinstance(value, list) and all(isinstance(v, str) for v in value):
+        return ' '.join(value)
+    if isinstance(value, (list, dict, set)):
+        return json.dumps(value, default=_number)
+    if isinstance(value, Decimal):
+        return _number(value)
+    return value
+
+
+def export(table, export_format='ndjson', segments=1, start=None, end=None,
+           columns=None):
+    """
+    Exports a table as CSV or NDJSON.
+
+    Args:
+        table (str): Required. 'subscribers' or 'log'.
+        export_format (str): 'csv' or 'ndjson'.
+        segments (int): The number of segments to scan in parallel.
+        start (str): Only export log messages sent at or after this date.
+        end (str): Only export log messages sent before this date.
+        columns ([str]): The attributes to export. Defaults to whole items
+            in NDJSON, and to the table's COLUMNS in CSV.
+
+    Returns:
+        A generator of chunks of text.
+
+    Raises:
+        ValueError: If the table or format is unknown, or a date is invalid.
+    """
+    if export_format not in FORMATS:
+        raise ValueError("Unknown format {}.".format(export_format))
+    if export_format == 'csv':
+        columns = columns or COLUMNS.get(table)
+    rows = items(table, segments, start, end, columns)
+    if export_format == 'csv':
+        return to_csv(rows, columns)
+    return ndjson(rows)
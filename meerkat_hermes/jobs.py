@@ -0,0 +1,207 @@
+"""
+jobs.py
+
+A persistent queue of publish jobs, so that large publishes can be accepted
+straight away and sent by a separate worker process (see runworker.py).
+
+Jobs are stored in a local SQLite database, at the path given by the
+PUBLISH_QUEUE config. Each job records its state ('queued', 'sending', 'done'
+or 'failed') and how many messages have been sent for each medium.
+"""
+from meerkat_hermes import app, logger
+import meerkat_hermes.util as util
+from contextlib import contextmanager
+import sqlite3
+import json
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    args TEXT NOT NULL,
+    state TEXT NOT NULL,
+    progress TEXT NOT NULL,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+)
+"""
+
+
+@contextmanager
+def _connect():
+    # Opens a connection and commits (or rolls back) and closes it on exit.
+    connection = sqlite3.connect(app.config['PUBLISH_QUEUE'], timeout=30)
+    connection.row_factory = sqlite3.Row
+    try:
+        connection.execute(SCHEMA)
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def _job(row):
+    if row is None:
+        return None
+    return {
+        'id': row['id'],
+        'state': row['state'],
+        'progress': json.loads(row['progress']),
+        'error': row['error'],
+        'created': row['created'],
+        'updated': row['updated']
+    }
+
+
+def enqueue(args):
+    """
+    Adds a publish job to the queue. Enqueuing the same message id twice
+    does not create a second job, so callers can safely retry. A job that
+    hasn't finished is queued again with the new args, so that a message
+    whose claim has been taken over is resumed with the new claim.
+
+    Args:
+        args (dict): Required. The publish args, as accepted by util.publish.
+
+    Returns:
+        The queued job, or the existing job with the same id.
+    """
+    now = time.time()
+    with _connect() as connection:
+        connection.execute(
+            "INSERT INTO jobs VALUES (?, ?, 'queued', '{}', NULL, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET args = excluded.args, "
+            "state = 'queued', error = NULL, updated = excluded.updated "
+            "WHERE state != 'done'",
+            (args['id'], json.dumps(args), now, now)
+        )
+    return status(args['id'])
+
+
+def status(job_id):
+    """
+    Gets the state and progress of a publish job.
+
+    Args:
+        job_id (str): Required. The message id of the job.
+
+    Returns:
+        The job as a dict, or None if no such job was queued.
+    """
+    with _connect() as connection:
+        row = connection.execute(
+            "SELECT * FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+    return _job(row)
+
+
+def claim():
+    """
+    Claims the oldest waiting job for this worker. Jobs left 'sending' by a
+    worker that hasn't reported progress within the PUBLISH_JOB_LEASE are
+    assumed abandoned and can be claimed again, and are resumed from the
+    deliveries the abandoned attempt made.
+
+    Returns:
+        A tuple (job_id, args) or None if the queue is empty.
+    """
+    now = time.time()
+    expired = now - app.config['PUBLISH_JOB_LEASE']
+    with _connect() as connection:
+        # Take the write lock before reading, so two workers can't claim the
+        # same job.
+        connection.execute("BEGIN IMMEDIATE")
+        row = connection.execute(
+            "SELECT id, args, state FROM jobs WHERE state = 'queued' OR "
+            "(state = 'sending' AND updated < ?) ORDER BY created LIMIT 1",
+            (expired,)
+        ).fetchone()
+        if row is None:
+            return None
+        connection.execute(
+            "UPDATE jobs SET state = 'sending', updated = ? WHERE id = ?",
+            (now, row['id'])
+        )
+    args = json.loads(row['args'])
+    if row['state'] == 'sending':
+        args['resume'] = True
+    return row['id'], args
+
+
+def update(job_id, state=None, progress=None, error=None):
+    """
+    Records a job's state and/or progress.
+
+    Args:
+        job_id (str): Required. The message id of the job.
+        state (str): The new state of the job.
+        progress (dict): The per-medium send counts.
+        error (str): A description of why the job failed.
+    """
+    updates = {'updated': time.time()}
+    if state is not None:
+        updates['state'] = state
+    if progress is not None:
+        updates['progress'] = json.dumps(progress)
+    if error is not None:
+        updates['error'] = error
+    with _connect() as connection:
+        connection.execute(
+            "UPDATE jobs SET {} WHERE id = ?".format(
+                ', '.join(key + ' = ?' for key in updates)
+            ),
+            list(updates.values()) + [job_id]
+        )
+
+
+def run(job_id, args):
+    """
+    Publishes a claimed job, recording its progress as messages are sent.
+
+    Args:
+        job_id (str): Required. The message id of the job.
+        args (dict): Required. The publish args.
+    """
+    last_update = [0]
+
+    def progress(counts):
+        # Throttle writes to the queue, but always record the final counts.
+        now = time.time()
+        done = all(c['sent'] == c['total'] for c in counts.values())
+        if done or now - last_update[0] > 1:
+            update(job_id, progress=counts)
+            last_update[0] = now
+
+    try:
+        util.publish(args, progress=progress)
+        update(job_id, state='done')
+    except util.ClaimLost:
+        # Another request has taken over the message, and queued it again.
+        logger.warning("Publish job {} was taken over.".format(job_id))
+    except Exception as e:
+        logger.exception("Publish job {} failed.".format(job_id))
+        update(job_id, state='failed', error=str(e))
+
+
+def work(poll_interval=1, once=False):
+    """
+    Drains the publish queue, sleeping for poll_interval seconds whenever it
+    is empty.
+
+    Args:
+        poll_interval (float): Seconds to wait between polls of the queue.
+        once (bool): Return once the queue is empty instead of polling.
+    """
+    logger.info("Publish worker started on {}".format(
+        app.config['PUBLISH_QUEUE']
+    ))
+    while True:
+        job = claim()
+        if job:
+            logger.info("Publishing job {}".format(job[0]))
+            run(*job)
+        elif once:
+            return
+        else:
+            time.sleep(poll_interval)
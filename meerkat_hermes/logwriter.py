@@ -0,0 +1,241 @@
+"""
+logwriter.py
+
+A background writer for the message log and delivery records, so that sending
+a message doesn't wait on DynamoDB to log it.
+
+Log entries are buffered in a queue and written by a thread using DynamoDB
+BatchWriteItem, as soon as LOG_BATCH_SIZE entries (at most 25) are waiting or
+LOG_FLUSH_INTERVAL seconds after the oldest waiting entry was logged. The
+queue holds at most LOG_QUEUE_SIZE entries, after which logging blocks until
+there is room. Anything still queued is written when the process exits.
+
+Entries that DynamoDB leaves unprocessed, e.g. while the table is throttled,
+are retried with the backoff of retry.Backoff, and counted as failed once the
+retries run out, so that a throttled table can't hold up a flush forever.
+"""
+from meerkat_hermes import app, logger, clients, retry
+from botocore.exceptions import ClientError
+import threading
+import atexit
+import queue
+import time
+import os
+
+# Queued by flush() to have the waiting entries written straight away.
+FLUSH = object()
+
+
+class LogWriter(object):
+    """
+    Buffers log entries and writes them to their tables in batches, from a
+    thread started when the first entry is logged.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=app.config['LOG_QUEUE_SIZE'])
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.pid = os.getpid()
+        self.thread = threading.Thread(
+            target=self._run,
+            name='hermes-log-writer',
+            daemon=True
+        )
+        self.thread.start()
+
+    def put(self, table_name, key, item):
+        """
+        Queues an item to be written to a table.
+
+        Args:
+            table_name (str): Required. The table to write to.
+            key ([str]): Required. The names of the table's key attributes.
+            item (dict): Required. The entry, including its key.
+        """
+        entry = (table_name, tuple(item[k] for k in key), item)
+        with self.lock:
+            self.pending[entry[:2]] = self.pending.get(entry[:2], 0) + 1
+        self.queue.put(entry)
+
+    def is_pending(self, table_name, key):
+        """
+        Returns True if an entry with the given table name and tuple of key
+        values is queued or being written.
+        """
+        return (table_name, key) in self.pending
+
+    def flush(self):
+        """
+        Blocks until every queued entry has been written.
+        """
+        # The marker stops the writer waiting for a full batch.
+        self.queue.put(FLUSH)
+        self.queue.join()
+
+    def _run(self):
+        # Take the first waiting entry, then wait for a full batch, for the
+        # flush interval to pass or for a flush, whichever is sooner.
+        while True:
+            entry = self.queue.get()
+            if entry is FLUSH:
+                self.queue.task_done()
+                continue
+            batch = [entry]
+            deadline = time.time() + app.config['LOG_FLUSH_INTERVAL']
+            while len(batch) < app.config['LOG_BATCH_SIZE']:
+                try:
+                    entry = self.queue.get(
+                        timeout=max(deadline - time.time(), 0)
+                    )
+                except queue.Empty:
+                    break
+                if entry is FLUSH:
+                    self.queue.task_done()
+                    break
+                batch.append(entry)
+            try:
+                self._write(batch)
+            except Exception:
+                logger.exception("Failed to write {} log entries.".format(
+                    len(batch)
+                ))
+                self.failed += len(batch)
+            finally:
+                with self.lock:
+                    for entry in batch:
+                        self.pending[entry[:2]] -= 1
+                        if not self.pending[entry[:2]]:
+                            del self.pending[entry[:2]]
+                for entry in batch:
+                    self.queue.task_done()
+
+    def _write(self, batch):
+        # DynamoDB rejects a batch that writes the same key twice, so only the
+        # last entry for each key is written.
+        entries = list({e[:2]: e for e in batch}.values())
+        request = {}
+        for table_name, key, item in entries:
+            request.setdefault(table_name, []).append(
+                {'PutRequest': {'Item': item}}
+            )
+        try:
+            backoff = retry.Backoff()
+            unwritten = 0
+            while request:
+                response = clients.dynamodb().batch_write_item(
+                    RequestItems=request
+                )
+                request = response.get('UnprocessedItems')
+                if not request:
+                    break
+                delay = backoff.delay()
+                if delay is None:
+                    for table_name, requests in request.items():
+                        items = [r['PutRequest']['Item'] for r in requests]
+                        logger.error("Gave up writing {} entries to {}: {}"
+                                     .format(len(items), table_name, items))
+                        unwritten += len(items)
+                    break
+                time.sleep(delay)
+            self.batches += 1
+            self.written += len(entries) - unwritten
+            self.failed += unwritten
+        except ClientError as e:
+            # One bad entry, usually one over DynamoDB's item size limit,
+            # fails the whole batch. So write the entries one at a time.
+            if e.response['Error']['Code'] != 'ValidationException':
+                raise
+            for table_name, key, item in entries:
+                self._write_item(table_name, item)
+
+    def _write_item(self, table_name, item):
+        # If the paramaeters are too large, it can cause problems.
+        table = clients.table(table_name)
+        try:
+            table.put_item(Item=item)
+        except Exception:
+            if 'message' not in item:
+                raise
+            item = dict(item, message='Message too large to log.')
+            table.put_item(Item=item)
+        self.written += 1
+
+
+_writer = None
+_lock = threading.Lock()
+
+
+def writer():
+    """
+    Returns this process's log writer, starting it if needed. A process
+    forked from one with a writer starts its own, as threads aren't copied by
+    fork.
+    """
+    global _writer
+    if _writer is None or _writer.pid != os.getpid():
+        with _lock:
+            if _writer is None or _writer.pid != os.getpid():
+                _writer = LogWriter()
+    return _writer
+
+
+def put(item):
+    """
+    Queues an entry to be written to the message log.
+
+    Args:
+        item (dict): Required. The log entry, including its 'id'.
+    """
+    writer().put(app.config['LOG'], ['id'], item)
+
+
+def put_delivery(item):
+    """
+    Queues a delivery record to be written to the DELIVERIES table.
+
+    Args:
+        item (dict): Required. The delivery record, including its 'log_id'
+            and 'delivery_id'.
+    """
+    writer().put(app.config['DELIVERIES'], ['log_id', 'delivery_id'], item)
+
+
+def is_pending(log_id):
+    """
+    Returns True if an entry with the given id has been logged by this
+    process but not yet written.
+    """
+    return (_writer is not None and
+            _writer.is_pending(app.config['LOG'], (log_id,)))
+
+
+def flush():
+    """
+    Blocks until every entry logged by this process has been written.
+    """
+    if _writer is not None and _writer.pid == os.getpid():
+        _writer.flush()
+
+
+def stats():
+    """
+    Returns the depth of the log queue and counts of the entries and batches
+    written, as a dict.
+    """
+    if _writer is None or _writer.pid != os.getpid():
+        return {'queued': 0, 'pending': 0, 'written': 0, 'failed': 0,
+                'batches': 0}
+    return {
+        'queued': _writer.queue.qsize(),
+        'pending': len(_writer.pending),
+        'written': _writer.written,
+        'failed': _writer.failed,
+        'batches': _writer.batches
+    }
+
+
+atexit.register(flush)
@@ -0,0 +1,242 @@
+"""
+pacing.py
+
+Paces sends to stay just under each provider's quota, rather than sending as
+fast as the publish workers can and being throttled.
+
+Each provider ('ses', 'sns', 'slack' or 'gcm') has a token bucket, refilled
+at its rate in messages per second and holding at most one second's worth of
+sends. Every send takes a token for each message, waiting until there are
+enough. A GCM multicast request takes a single token.
+The bucket is shared by all of the threads in this process.
+
+Rates are set by the PACING_RATES config. If PACING_SES_QUOTA is set, the SES
+rate is instead read from the account's SES send quota, and re-read every
+PACING_QUOTA_REFRESH seconds. Only PACING_HEADROOM of each rate is used, and
+the rate is divided between the processes that send from the same account, so
+that together they stay under the quota. Unless PACING_PROCESSES sets how
+many there are, each process counts itself in the rate limit backend once
+every PACING_QUOTA_REFRESH seconds, see processes(). A provider without a
+rate isn't paced.
+"""
+from meerkat_hermes import app, logger, clients, ratelimit
+import threading
+import time
+
+
+class Pacer(object):
+    """
+    A token bucket pacing the sends to one provider, counting how much of
+    its rate is being used.
+
+    Args:
+        rate (float): Required. The sends allowed per second.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.time()
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.waited = 0
+        self.window = int(self.updated)
+        self.window_sent = 0
+        self.last_window_sent = 0
+
+    def acquire(self, count=1):
+        """
+        Takes tokens for a number of sends, blocking until they are due. The
+        tokens are reserved before waiting, so waiting threads are served in
+        order.
+
+        Args:
+            count (int): The number of messages about to be sent.
+
+        Returns:
+            The number of seconds waited.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.rate,
+                self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= count
+            wait = max(-self.tokens / self.rate, 0)
+            self._count(now + wait, count)
+            self.waited += wait
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def _count(self, when, count):
+        # Count the sends in whole second windows, to measure utilisation.
+        window = int(when)
+        if window != self.window:
+            self.last_window_sent = self.window_sent
+            if window != self.window + 1:
+                self.last_window_sent = 0
+            self.window = window
+            self.window_sent = 0
+        self.window_sent += count
+        self.sent += count
+
+    def stats(self):
+        """
+        Returns the pacer's rate, the sends and seconds waited so far, and
+        the fraction of the rate used in the last whole second, as a dict.
+        """
+        with self.lock:
+            last = self.last_window_sent
+            if int(time.time()) > self.window + 1:
+                last = 0
+            elif int(time.time()) > self.window:
+                last = self.window_sent
+            return {
+                'rate': self.rate,
+                'sent': self.sent,
+                'waited': round(self.waited, 3),
+                'utilisation': round(last / self.rate, 3)
+            }
+
+
+_pacers = {}
+_refreshed = {}
+_registered = {}
+_lock = threading.Lock()
+
+
+def processes():
+    """
+    Returns the number of processes sharing each provider's quota. This is
+    the PACING_PROCESSES config if set. Otherwise each process adds itself
+    to a count in the rate limit backend once per PACING_QUOTA_REFRESH
+    window, when it refreshes its pacers, and the larger of the current and
+    previous windows' counts is used. Only the 'dynamodb' backend shares
+    the count between processes.
+    """
+    if app.config['PACING_PROCESSES']:
+        return app.config['PACING_PROCESSES']
+    window = app.config['PACING_QUOTA_REFRESH']
+    index = int(time.time() // window)
+    key = 'pacing:processes:{}:{}'.format(window, index)
+    with _lock:
+        register = _registered.get(window) != index
+        _registered[window] = index
+    if register:
+        current = ratelimit.backend().incr(key, (index + 2) * window)
+    else:
+        current = ratelimit.backend().get(key)
+    previous = ratelimit.backend().get(
+        'pacing:processes:{}:{}'.format(window, index - 1)
+    )
+    return max(current, previous, 1)
+
+
+def quota(provider):
+    """
+    Returns a provider's quota in sends per second across all processes, or
+    None if sends to it aren't paced.
+
+    Args:
+        provider (str): Required. 'ses', 'sns', 'slack' or 'gcm'.
+    """
+    rate = app.config['PACING_RATES'].get(provider)
+    if provider == 'ses' and app.config['PACING_SES_QUOTA']:
+        try:
+            send_quota = clients.client('ses').get_send_quota()
+            rate = float(send_quota['MaxSendRate'])
+        except Exception as e:
+            logger.warning("Failed to read the SES send quota: {}".format(e))
+    return rate
+
+
+def pacer(provider):
+    """
+    Returns this process's pacer for a provider, or None if sends to it
+    aren't paced. Quotas read from the provider are refreshed every
+    PACING_QUOTA_REFRESH seconds.
+
+    Args:
+        provider (str): Required. 'ses', 'sns', 'slack' or 'gcm'.
+    """
+    # Only one thread refreshes each provider, reading the quota and the
+    # process count without holding the lock, so other threads carry on
+    # with the current pacer meanwhile.
+    now = time.time()
+    refresh = app.config['PACING_QUOTA_REFRESH']
+    if now - _refreshed.get(provider, 0) > refresh:
+        with _lock:
+            due = now - _refreshed.get(provider, 0) > refresh
+            if due:
+                _refreshed[provider] = now
+        if due:
+            rate = quota(provider)
+            if rate:
+                rate = rate * app.config['PACING_HEADROOM'] / processes()
+            with _lock:
+                if not rate:
+                    _pacers.pop(provider, None)
+                elif provider in _pacers:
+                    _pacers[provider].rate = rate
+                else:
+                    _pacers[provider] = Pacer(rate)
+    return _pacers.get(provider)
+
+
+def acquire(provider, count=1):
+    """
+    Waits until a number of messages can be sent to a provider without
+    exceeding its quota.
+
+    Args:
+        provider (str): Required. 'ses', 'sns', 'slack' or 'gcm'.
+        count (int): The number of messages about to be sent.
+
+    Returns:
+        The number of seconds waited.
+    """
+    bucket = pacer(provider)
+    if bucket is None:
+        return 0
+    return bucket.acquire(count)
+
+
+def paced(provider, function, count=1):
+    """
+    Wraps a send function so that every call to it, including retries, is
+    paced.
+
+    Args:
+        provider (str): Required. 'ses', 'sns', 'slack' or 'gcm'.
+        function (function): Required. The function that sends the messages.
+        count (int): The number of messages each call sends.
+
+    Returns:
+        The wrapped function.
+    """
+    def send(*args, **kwargs):
+        acquire(provider, count)
+        return function(*args, **kwargs)
+    return send
+
+
+def stats():
+    """
+    Returns the rate, sends, seconds waited and utilisation of each paced
+    provider in this process, as a dict of dicts indexed by provider.
+    """
+    return {provider: bucket.stats()
+            for provider, bucket in list(_pacers.items())}
+
+
+def reset():
+    """
+    Forgets every pacer and quota, e.g. after the config has changed.
+    """
+    with _lock:
+        _pacers.clear()
+        _refreshed.clear()
+        _registered.clear()
@@ -0,0 +1,166 @@
+"""
+ratelimit.py
+
+Sliding window rate limiting, used to stop runaway publishing.
+
+Each limit counts calls in fixed windows and estimates the number of calls in
+the sliding window ending now by weighting the previous window's count by how
+much of it still overlaps. Checking a limit is therefore O(1) in time and
+memory, however bursty the calls.
+
+The counters are kept in a backend, chosen with the RATE_LIMIT_BACKEND config.
+The 'local' backend is a per-process dictionary, suitable for development and
+testing. The 'dynamodb' backend uses atomic counters in the RATE_LIMITS table,
+so that every uwsgi worker enforces one shared budget.
+"""
+from meerkat_hermes import app, clients
+import threading
+import time
+
+
+class LocalBackend(object):
+    """
+    Keeps the counters in a dictionary local to this process.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.next_purge = 0
+
+    def incr(self, key, expires):
+        """
+        Atomically adds one to a counter.
+
+        Args:
+            key (str): Required. The counter's key.
+            expires (float): Required. The time after which the counter can
+                be forgotten.
+
+        Returns:
+            The new count.
+        """
+        with self.lock:
+            now = time.time()
+            if now > self.next_purge:
+                self._purge(now)
+            count = self.counters.get(key, (0, expires))[0] + 1
+            self.counters[key] = (count, expires)
+            return count
+
+    def get(self, key):
+        """
+        Returns the current count of a counter, zero if it doesn't exist.
+        """
+        return self.counters.get(key, (0, 0))[0]
+
+    def _purge(self, now):
+        # Drop expired counters every so often, so memory stays bounded.
+        for key, (count, expires) in list(self.counters.items()):
+            if expires < now:
+                del self.counters[key]
+        self.next_purge = now + 60
+
+
+class DynamoDBBackend(object):
+    """
+    Keeps the counters as atomic counters in the RATE_LIMITS DynamoDB table,
+    shared by all hermes processes. The table should have DynamoDB's TTL
+    enabled on the 'expires' attribute.
+    """
+
+    def incr(self, key, expires):
+        """
+        Atomically adds one to a counter.
+
+        Args:
+            key (str): Required. The counter's key.
+            expires (float): Required. The time after which the counter can
+                be forgotten.
+
+        Returns:
+            The new count.
+        """
+        response = clients.table(app.config['RATE_LIMITS']).update_item(
+            Key={'id': key},
+            UpdateExpression=(
+                'ADD #count :one '
+                'SET expires = if_not_exists(expires, :expires)'
+            ),
+            ExpressionAttributeNames={'#count': 'count'},
+            ExpressionAttributeValues={':one': 1, ':expires': int(expires)},
+            ReturnValues='UPDATED_NEW'
+        )
+        return int(response['Attributes']['count'])
+
+    def get(self, key):
+        """
+        Returns the current count of a counter, zero if it doesn't exist.
+        """
+        response = clients.table(app.config['RATE_LIMITS']).get_item(
+            Key={'id': key},
+            ConsistentRead=True
+        )
+        return int(response.get('Item', {}).get('count', 0))
+
+
+BACKENDS = {
+    'local': LocalBackend,
+    'dynamodb': DynamoDBBackend
+}
+
+_backends = {}
+# The counts of the last closed window of each window length, as a tuple of
+# the window's index and a dict of the counts by scope. Only the scopes hit
+# since the window closed are kept.
+_closed_windows = {}
+_lock = threading.Lock()
+
+
+def backend():
+    """
+    Returns the counter backend selected by the RATE_LIMIT_BACKEND config.
+    """
+    name = app.config['RATE_LIMIT_BACKEND']
+    if name not in _backends:
+        with _lock:
+            if name not in _backends:
+                _backends[name] = BACKENDS[name]()
+    return _backends[name]
+
+
+def hit(scope, window=3600):
+    """
+    Records a call against a rate limit scope and estimates how many calls
+    have been made in the past window.
+
+    Args:
+        scope (str): Required. What is being limited e.g. 'publish' or
+            'publish:topic:<topic>'.
+        window (int): The length of the sliding window in seconds. Defaults
+            to an hour.
+
+    Returns:
+        The estimated number of calls in the past window, including this one.
+    """
+    now = time.time()
+    index = int(now // window)
+    current_key = '{}:{}:{}'.format(scope, window, index)
+    previous_key = '{}:{}:{}'.format(scope, window, index - 1)
+
+    current = backend().incr(current_key, (index + 2) * window)
+
+    # The previous window is closed, so its count can't change any more and
+    # only needs reading once per process. The counts of older windows are
+    # dropped, so scopes that are no longer hit don't build up.
+    closed_index, closed = _closed_windows.get(window, (None, {}))
+    if closed_index != index - 1:
+        closed = {}
+        _closed_windows[window] = (index - 1, closed)
+    if scope not in closed:
+        closed[scope] = backend().get(previous_key)
+    previous = closed[scope]
+
+    overlap = 1 - (now - index * window) / window
+    return previous * overlap + current
+
@@ -0,0 +1,127 @@
+"""
+These classes subscribe and unsubscribe many people in one request, e.g. when
+onboarding a country's staff from a spreadsheet. Both are POST requests.
+Rows are given either as a JSON array, or as newline delimited JSON with the
+content type "application/x-ndjson", one row per line. NDJSON is read from
+the request as it is written, so it suits large uploads best.
+"""
+from flask_restful import Resource
+from flask import Response, request
+from meerkat_hermes import authorise
+import meerkat_hermes.util as util
+import json
+
+NDJSON_TYPES = ['application/x-ndjson', 'application/jsonlines']
+
+# Stands in for an NDJSON line that isn't valid JSON, so that it is reported
+# as an invalid row.
+INVALID = object()
+
+
+def request_rows():
+    """
+    Reads the rows of a bulk request from its body. NDJSON is read one line
+    at a time from the request stream, as the rows are needed.
+
+    Returns:
+        An iterable of rows, with INVALID for each NDJSON line that isn't
+        valid JSON.
+
+    Raises:
+        ValueError: If the body isn't a JSON array or NDJSON.
+    """
+    if request.mimetype in NDJSON_TYPES:
+        return ndjson_rows(request.stream)
+    rows = json.loads(request.get_data(as_text=True))
+    if not isinstance(rows, list):
+        raise ValueError("Expected a JSON array of rows.")
+    return rows
+
+
+def ndjson_rows(stream):
+    """
+    Yields the rows of newline delimited JSON as they are read from a
+    stream, skipping blank lines.
+    """
+    for line in stream:
+        try:
+            line = line.decode('utf-8')
+        except UnicodeDecodeError:
+            yield INVALID
+            continue
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield INVALID
+
+
+def bulk_response(results):
+    """
+    Returns the per row results of a bulk request, with a count of each
+    status, as a json response.
+    """
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    return Response(json.dumps({'counts': counts, 'results': results}),
+                    status=200,
+                    mimetype='application/json')
+
+
+def invalid_request(error):
+    return Response(json.dumps({'message': str(error)}),
+                    status=400,
+                    mimetype='application/json')
+
+
+class BulkSubscribe(Resource):
+
+    decorators = [authorise]
+
+    def post(self):
+        """
+        Add many new subscribers. Each row is an object with the same fields
+        as a single subscribe, see Subscribe.put(). Each row is validated on
+        its own, so invalid rows don't stop the others from being added.
+
+        Returns:
+            A json object with the number of rows of each status as
+            "counts", and a result for each row, in order, as "results" e.g.
+            {"counts": {"subscribed": 1, "invalid": 1}, "results": [{"row": 0,
+            "status": "subscribed", "subscriber_id": "8d3b..."}, {"row": 1,
+            "status": "invalid", "error": "Missing email."}]}
+        """
+        try:
+            rows = request_rows()
+        except ValueError as e:
+            return invalid_request(e)
+        rows = (None if row is INVALID else row for row in rows)
+        return bulk_response(util.bulk_subscribe(rows))
+
+
+class BulkUnsubscribe(Resource):
+
+    decorators = [authorise]
+
+    def post(self):
+        """
+        Delete many subscribers. Each row is either a subscriber ID, or an
+        object with the subscriber ID as "id".
+
+        Returns:
+            A json object with the number of rows of each status as
+            "counts", and a result for each row, in order, as "results", with
+            a status of "unsubscribed", "not found", "invalid" or "failed".
+        """
+        try:
+            rows = request_rows()
+        except ValueError as e:
+            return invalid_request(e)
+        subscriber_ids = (
+            None if row is INVALID else
+            row.get('id') if isinstance(row, dict) else row
+            for row in rows
+        )
+        return bulk_response(util.bulk_unsubscribe(subscriber_ids))
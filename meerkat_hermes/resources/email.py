@@ -7,7 +7,6 @@ from flask import current_app, Response
 from meerkat_hermes import authorise
 import meerkat_hermes.util as util
 import uuid
-import boto3
 import json
 
 
@@ -15,15 +14,6 @@ class Email(Resource):
 
     decorators = [authorise]
 
-    def __init__(self):
-        # Load the database and tables, upon object creation.
-        db = boto3.resource(
-            'dynamodb',
-            endpoint_url=current_app.config['DB_URL'],
-            region_name='eu-west-1'
-        )
-        self.subscribers = db.Table(current_app.config['SUBSCRIBERS'])
-
     def put(self):
         """
         Send an email with Amazon SES.
@@ -44,7 +34,8 @@ class Email(Resource):
                         SENDER.
 
         Returns:
-            The amazon SES response.
+            The amazon SES response. If subscriber ids were given, the ids
+            that don't exist are listed in "unknown_subscriber_ids".
         """
 
         # Define an argument parser for creating a valid email message.
@@ -65,6 +56,7 @@ class Email(Resource):
 
         # If no email is given, look at the subscriber ids and find their
         # emails.
+        unknown = None
         if args['email'] is None:
             # If the caller has made a mistake and not provided any
             # destination, throw an error.
@@ -75,14 +67,33 @@ class Email(Resource):
                     mimetype='application/json'
                 )
             else:
+                # Load all the subscribers' email addresses in batches.
+                subscribers = util.get_subscribers(
+                    args['subscriber_id'],
+                    attributes=['email']
+                )
                 args['email'] = []
-                for subscriber_id in args['subscriber_id']:
-                    response = self.subscribers.get_item(
-                        Key={
-                            'id': subscriber_id
-                        }
+                unknown = []
+                for subscriber_id in dict.fromkeys(args['subscriber_id']):
+                    if subscriber_id in subscribers:
+                        args['email'].append(
+                            subscribers[subscriber_id]['email']
+                        )
+                    else:
+                        unknown.append(subscriber_id)
+
+                # Unknown ids are reported, but only fail the request if none
+                # of the subscribers exist.
+                if not args['email']:
+                    return Response(
+                        json.dumps({
+                            'message': ('400 Bad Request: No subscribers '
+                                        'found for the given subscriber ids.'),
+                            'unknown_subscriber_ids': unknown
+                        }),
+                        status=400,
+                        mimetype='application/json'
                     )
-                    args['email'].append(response['Item']['email'])
 
         # Set the from field to the config SENDER value if no from field is
         # supplied.
@@ -107,6 +118,8 @@ class Email(Resource):
         })
 
         response['log_id'] = message_id
+        if unknown is not None:
+            response['unknown_subscriber_ids'] = unknown
 
         return Response(json.dumps(response),
                         status=response['ResponseMetadata']['HTTPStatusCode'],
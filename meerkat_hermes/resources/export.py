@@ -0,0 +1,79 @@
+"""
+This class streams a whole table as CSV or NDJSON, for audits and backups,
+see meerkat_hermes/export.py.
+"""
+from flask_restful import Resource, reqparse
+from flask import current_app, Response, stream_with_context
+from meerkat_hermes import authorise, export
+import json
+
+
+class Export(Resource):
+
+    decorators = [authorise]
+
+    def get(self, table):
+        """
+        Export the subscribers or the message log. The export is streamed as
+        the table is scanned, so it starts straight away and takes constant
+        memory however large the table.
+
+        Arguments are passed in the query string.
+
+        Args:
+            table (str): "subscribers" or "log".\n
+            format (str): "csv" or "ndjson". Defaults to "ndjson".\n
+            segments (int): The number of segments to scan in parallel, at
+                            most EXPORT_MAX_SEGMENTS. Defaults to
+                            SCAN_SEGMENTS.\n
+            start (str): Only export log messages sent at or after this UTC
+                         date, e.g. "2017-06-01", using the log's time
+                         index, as for GET /log.\n
+            end (str): Only export log messages sent before this UTC date.
+                       Defaults to now.\n
+            columns (str): A comma separated list of the attributes to
+                           export. Defaults to all attributes in NDJSON and
+                           to the main attributes in CSV.
+
+        Returns:
+            The exported table as an attachment, or a json object with a
+            "message" if the arguments are invalid.
+        """
+        parser = reqparse.RequestParser()
+        parser.add_argument('format', type=str, default='ndjson',
+                            location='args', help='"csv" or "ndjson"')
+        parser.add_argument('segments', type=int, location='args',
+                            default=current_app.config['SCAN_SEGMENTS'],
+                            help='The number of parallel scan segments')
+        parser.add_argument('start', type=str, location='args',
+                            help='The earliest date to export')
+        parser.add_argument('end', type=str, location='args',
+                            help='The date to export up to')
+        parser.add_argument('columns', type=str, location='args',
+                            help='The attributes to export')
+        args = parser.parse_args()
+
+        segments = min(max(args['segments'], 1),
+                       current_app.config['EXPORT_MAX_SEGMENTS'])
+        columns = None
+        if args['columns']:
+            columns = [c.strip() for c in args['columns'].split(',')
+                       if c.strip()]
+        try:
+            chunks = export.export(table, args['format'], segments,
+                                   args['start'], args['end'], columns)
+        except ValueError as e:
+            message = {"message": "400 Bad Request: {}".format(e)}
+            return Response(json.dumps(message),
+                            status=400,
+                            mimetype='application/json')
+
+        filename = 'hermes_{}.{}'.format(table, args['format'])
+        return Response(
+            stream_with_context(chunks),
+            status=200,
+            mimetype=export.FORMATS[args['format']],
+            headers={
+                'Content-Disposition': 'attachment; filename=' + filename
+            }
+        )
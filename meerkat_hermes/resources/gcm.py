@@ -1,6 +1,9 @@
 """
 This resource provides a simple means of sending a given e-mail message to
 given e-mail addresses.
+
+The batch resource sends a message to many Collect tablets at once, by their
+GCM registration tokens.
 """
 from flask_restful import Resource, reqparse
 import uuid
@@ -84,3 +87,73 @@ class Gcm(Resource):
 
     def get(self):
         return "Meerkat Google Cloud Messaging service"
+
+
+class GcmBatch(Resource):
+
+    decorators = [authorise]
+
+    def put(self):
+        """
+        Send a GCM message to many devices, using GCM multicast requests of
+        up to GCM_BATCH_SIZE registration tokens each. The batch is logged as
+        a single message.
+
+        Arguments are passed in the request data.
+
+        Args:
+            message (str): Required. The message payload.\n
+            destination ([str]): Required. The GCM registration tokens of the
+                devices to send to. Accepts array of multiple tokens.\n
+
+        Returns:
+            The counts of devices sent to ('success') and not sent to
+            ('failure'), the GCM result for each token ('results'), the tokens
+            that are no longer valid and should be pruned ('invalid_tokens'),
+            the tokens that have been replaced, mapped to their replacements
+            ('canonical_ids'), and the 'log_id'.
+        """
+        parser = reqparse.RequestParser()
+        parser.add_argument('message', required=True,
+                            type=str, help='The message payload')
+        parser.add_argument('destination', required=True, action='append',
+                            type=str, help='The registration tokens')
+        args = parser.parse_args()
+
+        # Topics can only be sent to one at a time, through /gcm.
+        topics = [d for d in args['destination'] if d.startswith('/topics/')]
+        if topics:
+            return Response(
+                json.dumps({'message': ('Topics ' + ', '.join(topics) +
+                                        ' not allowed in a batch')}),
+                status=403,
+                mimetype='application/json'
+            )
+
+        # Return dummy response based on environment variable
+        if current_app.config['GCM_MOCK_RESPONSE_ONLY'] == 1:
+            return Response(
+                json.dumps({'message': 'Mock response from Hermes GCM API',
+                            'destination': args['destination'],
+                            'message_content': args['message']}),
+                status=200,
+                mimetype='application/json'
+            )
+
+        response = util.send_gcm_batch(args['destination'], args['message'])
+
+        message_id = 'G' + uuid.uuid4().hex
+        util.log_message(message_id, {
+            'destination_count': len(response['results']),
+            'success': response['success'],
+            'failure': response['failure'],
+            'invalid_count': len(response['invalid_tokens']),
+            'medium': ['gcm'],
+            'time': util.get_date(),
+            'message': args['message']
+        })
+        response['log_id'] = message_id
+
+        return Response(json.dumps(response),
+                        status=200,
+                        mimetype='application/json')
@@ -2,11 +2,57 @@
 This class enables management of the message log.  It includes methods to get
 the entire log or to get a single
 """
-import boto3
 import json
-from flask_restful import Resource
+import base64
+from datetime import datetime, timedelta
+from flask_restful import Resource, reqparse
 from flask import Response, current_app
-from meerkat_hermes import authorise
+from meerkat_hermes import authorise, clients, dedup, logwriter
+import meerkat_hermes.util as util
+
+
+def encode_token(key):
+    """
+    Encodes the key to continue paging from as an opaque token.
+    """
+    return base64.urlsafe_b64encode(
+        json.dumps(key).encode('UTF-8')
+    ).decode('UTF-8')
+
+
+def decode_token(token):
+    """
+    Decodes a token made by encode_token().
+
+    Returns:
+        The decoded dict.
+
+    Raises:
+        ValueError: If the token is invalid.
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token).decode('UTF-8'))
+    except ValueError:
+        raise ValueError("Invalid token")
+    if not isinstance(key, dict):
+        raise ValueError("Invalid token")
+    return key
+
+
+def is_key(key, names):
+    """
+    Returns True if a decoded token is a DynamoDB key with exactly the given
+    attribute names, each a string, so it can be used to continue a query.
+    """
+    return (isinstance(key, dict) and set(key) == set(names) and
+            all(isinstance(value, str) for value in key.values()))
+
+
+def bad_request(message):
+    message = {"message": "400 Bad Request: {}".format(message)}
+    return Response(json.dumps(message),
+                    status=400,
+                    mimetype="application/json")
 
 
 class Log(Resource):
@@ -14,32 +60,69 @@ class Log(Resource):
     decorators = [authorise]
 
     def __init__(self):
-        # Load the database and tables, upon object creation.
-        db = boto3.resource(
-            'dynamodb',
-            endpoint_url=current_app.config['DB_URL'],
-            region_name='eu-west-1'
-        )
-        self.log = db.Table(current_app.config['LOG'])
+        # Load the tables from the shared client registry.
+        self.log = clients.table(current_app.config['LOG'])
 
-    def get(self, log_id):
+    def get(self, log_id=None):
         """
-        Get message log records from the database.
+        Get message log records from the database, with a page of the
+        message's delivery records. Without a log_id, lists the messages
+        logged in a time range instead, see list().
+
+        Arguments for paging are passed in the query string.
 
         Args:
-             log_id (str): The id of the desired message log.
+             log_id (str): The id of the desired message log.\n
+             limit (int): The maximum number of delivery records to return.
+                          Defaults to 100.\n
+             token (str): The "NextToken" from the previous page of delivery
+                          records.
 
         Returns:
-             The amazon dynamodb response.
+             The amazon dynamodb response, with the page of delivery records
+             as "Deliveries" and, if there are more, a "NextToken" to get the
+             next page with.
         """
+        if log_id is None:
+            return self.list()
+
+        parser = reqparse.RequestParser()
+        parser.add_argument('limit', type=int, default=100, location='args',
+                            help='The maximum number of deliveries to return')
+        parser.add_argument('token', type=str, location='args',
+                            help='The token for the next page of deliveries')
+        args = parser.parse_args()
 
+        # Include any entries this process is still writing.
+        logwriter.flush()
         response = self.log.get_item(
             Key={
                 'id': log_id
             }
         )
         if 'Item' in response:
-            return Response(json.dumps(response),
+            # The token is the key of the last delivery on the previous page.
+            start = None
+            if args['token']:
+                try:
+                    start = decode_token(args['token'])
+                except ValueError as e:
+                    return bad_request(e)
+                if not is_key(start, ['log_id', 'delivery_id']) or \
+                        start['log_id'] != log_id:
+                    return bad_request("Invalid token")
+            deliveries, next_key = util.get_deliveries(
+                log_id,
+                limit=min(max(args['limit'], 1), 1000),
+                start=start
+            )
+            response['Deliveries'] = deliveries
+            if next_key:
+                response['NextToken'] = encode_token(next_key)
+
+            # DynamoDB loads numbers as Decimals, but the log only stores
+            # whole numbers.
+            return Response(json.dumps(response, default=int),
                             status=200,
                             mimetype="application/json")
         else:
@@ -48,22 +131,99 @@ class Log(Resource):
                             status=200,
                             mimetype="application/json")
 
-    def delete(self, log_id):
+    def list(self):
         """
-        Delete a log record from the database.
+        List the messages logged in a time range, newest first, a page at a
+        time. Only the range is read, using the log's time index.
+
+        Arguments are passed in the query string.
+
+        Args:
+             from (str): The earliest UTC time to list, e.g. "2017-06-01" or
+                         "2017-06-01T12:00:00". Defaults to a week before
+                         "to".\n
+             to (str): The UTC time to list up to, but not including.
+                       Defaults to now.\n
+             medium (str): Only list messages sent by this medium.\n
+             topic (str): Only list messages published to this topic.\n
+             limit (int): The maximum number of messages to return.
+                          Defaults to 100.\n
+             token (str): The "NextToken" from the previous page.
+
+        Returns:
+             A json object with the page of log records as "Items" and, if
+             there are more, a "NextToken" to get the next page with.
+        """
+        parser = reqparse.RequestParser()
+        for name in ['from', 'to', 'medium', 'topic', 'token']:
+            parser.add_argument(name, type=str, location='args')
+        parser.add_argument('limit', type=int, default=100, location='args',
+                            help='The maximum number of messages to return')
+        args = parser.parse_args()
+
+        try:
+            end = datetime.utcnow()
+            if args['to']:
+                end = util.parse_time(args['to'])
+            start = end - timedelta(days=7)
+            if args['from']:
+                start = util.parse_time(args['from'])
+            token = decode_token(args['token']) if args['token'] else None
+            if token is not None and (
+                not isinstance(token.get('day'), str) or
+                set(token) - {'day', 'key'} or
+                ('key' in token and
+                 not is_key(token['key'], ['id', 'day', 'timestamp']))
+            ):
+                raise ValueError("Invalid token")
+            logwriter.flush()
+            messages, next_token = util.query_log(
+                start,
+                end,
+                medium=args['medium'],
+                topic=args['topic'],
+                limit=min(max(args['limit'], 1), 1000),
+                token=token
+            )
+        except ValueError as e:
+            return bad_request(e)
+
+        response = {'Items': messages}
+        if next_token:
+            response['NextToken'] = encode_token(next_token)
+        return Response(json.dumps(response, default=int),
+                        status=200,
+                        mimetype="application/json")
+
+    def delete(self, log_id=None):
+        """
+        Delete a log record and its delivery records from the database.
 
         Args:
              log_id (str): for the record to be deleted.
 
         Returns:
-             The amazon dynamodb response.
+             The amazon dynamodb response, or a 405 Method Not Allowed
+             response if no log ID is given, as the whole log can't be
+             deleted.
         """
+        if log_id is None:
+            message = {"message": "405 Method Not Allowed: "
+                                  "A log ID is required."}
+            return Response(json.dumps(message),
+                            status=405,
+                            headers={'Allow': 'GET'},
+                            mimetype="application/json")
 
+        # Make sure a pending write can't recreate the deleted record.
+        logwriter.flush()
         log_response = self.log.delete_item(
             Key={
                 'id': log_id
             }
         )
+        util.delete_deliveries(log_id)
+        dedup.discard(log_id)
 
         return Response(
             json.dumps(log_response),
@@ -0,0 +1,40 @@
+"""
+This class reports metrics for the subscriber cache, the message log writer,
+the pacing of sends and the coalescing of slack messages, so that they can be
+monitored and tuned.
+"""
+from flask_restful import Resource
+from flask import Response
+from meerkat_hermes import authorise, cache, logwriter, pacing, coalesce
+import json
+
+
+class Metrics(Resource):
+
+    decorators = [authorise]
+
+    def get(self):
+        """
+        Get the metrics for this process.
+
+        Returns:
+             A json object with attributes "cache", the size and hit/miss
+             counts of each cache namespace, "log", the depth of the log
+             queue and counts of the entries written, "pacing", the rate,
+             sends and utilisation of each paced provider, and "slack", the
+             counts of slack messages received and digests posted e.g.
+             {"cache": {"subscribers": {"size": 10, "hits": 90, "misses": 10}},
+             "log": {"queued": 0, "pending": 0, "written": 100, "failed": 0,
+             "batches": 4}, "pacing": {"ses": {"rate": 12.6, "sent": 500,
+             "waited": 30.2, "utilisation": 0.98}}, "slack": {"received": 40,
+             "posted": 3, "failed": 0, "waiting": 1}}
+        """
+        metrics = {
+            'cache': cache.stats(),
+            'log': logwriter.stats(),
+            'pacing': pacing.stats(),
+            'slack': coalesce.stats()
+        }
+        return Response(json.dumps(metrics),
+                        status=200,
+                        mimetype='application/json')
@@ -4,11 +4,11 @@ subscribers with subscriptions to given topics. It is expected to be the
 primary function of meerkat hermes.
 """
 from flask_restful import Resource, reqparse
-from flask import current_app, Response
+from flask import current_app, request, Response
 from meerkat_hermes import authorise, logger
 import meerkat_hermes.util as util
+import meerkat_hermes.jobs as jobs
 import json
-import boto3
 
 
 class Publish(Resource):
@@ -25,8 +25,10 @@ class Publish(Resource):
 
         Args:
             id (str): Required. If another message with the same ID has been
-                      logged, this one won't send. Returns a 400 Bad Request
-                      error if this is the case.\n
+                      sent, this one won't send. Returns a 400 Bad Request
+                      error if this is the case, or the message's state with
+                      a 202 status if it is still being sent. A message whose
+                      publish failed is sent again.\n
             message (str): Required. The message.\n
             topics ([str]): Required. The topics the message fits into
                             (determines destination address/es). Accepts array
@@ -40,10 +42,14 @@ class Publish(Resource):
                                 the same as 'message'\n
             subject (str): The e-mail subject. Defaults to "".\n
             from (str): The address from which to send the message. \n
-                        Deafults to an emro address stored in the config.
+                        Deafults to an emro address stored in the config.\n
+            async (str): Queue the message to be sent by the publish worker
+                         and return straight away? Defaults to the config
+                         value PUBLISH_ASYNC. str is resolved to boolean.
 
         Returns:
-            An array of amazon SES and nexmo responses for each message sent.
+            An array of amazon SES and nexmo responses for each message sent,
+            or the queued job with a 202 status if the message was queued.
         """
         # Define an argument parser for creating a valid email message.
         parser = reqparse.RequestParser()
@@ -64,34 +70,28 @@ class Publish(Resource):
                             type=str, help='The email subject')
         parser.add_argument('from', required=False, type=str,
                             help='The address from which to send the message')
+        parser.add_argument('async', required=False, type=str,
+                            help='Queue the message? "True"/"False"')
         args = parser.parse_args()
 
-        # Log previous times the publish function has been called
-        logger.debug(current_app.config['CALL_TIMES'])
-
-        # Check that the message hasn't already been sent.
-        if not util.id_valid(args['id']):
-            logger.warning(
-                "Can't publish message. ID {} already exists.".format(
-                    args['id']
-                )
-            )
-            # If the message ID exists, return with a 400 bad request response.
-            message = {
-                "message": ("400 Bad Request: id " + args['id'] +
-                            " already exists")
-            }
-            return Response(json.dumps(message),
-                            status=400,
-                            mimetype='application/json')
-
-        # Check whether the rate limit has been exceeded.
-        if util.limit_exceeded():
+        # Check that the message hasn't already been sent. Ids new to this
+        # process are checked when they are claimed below. A message whose
+        # publish failed or was abandoned is resumed rather than rejected.
+        log = None
+        if not util.id_valid(args['id'], consistent=False):
+            log = util.get_log(args['id'])
+            if log is not None and not util.resumable(log):
+                return existing(args['id'], log)
+
+        # Check whether any of the rate limits have been exceeded.
+        exceeded = util.limit_exceeded(
+            topics=args['topics'],
+            caller=request.remote_addr
+        )
+        if exceeded:
 
             # Log the issue.
-            logger.error("Rate limit exceeded.\n{}".format(
-                current_app.config['CALL_TIMES']
-            ))
+            logger.error("Rate limit exceeded.\n{}".format(exceeded))
             # If limit exceeded, send 503 Service Unavailable error.
             message = {
                 "message": ("503 Service Unavailable: too many requests " +
@@ -101,10 +101,10 @@ class Publish(Resource):
             util.error({
                 'subject': 'URGENT ERROR - Message Rate Limit Exceeded',
                 'message': ('The hermes messaging rate limit has been '
-                            'exceeded. There have been {} attempts to publish '
-                            'in the last hour. Message with subject "{}" has '
-                            'been throttled.'.format(
-                                len(current_app.config['CALL_TIMES']),
+                            'exceeded. Attempts to publish in the last hour '
+                            'exceeded these limits: {}. Message with subject '
+                            '"{}" has been throttled.'.format(
+                                ', '.join(exceeded),
                                 args['subject']
                             )),
                 'medium': ['slack', 'email', 'sms']
@@ -123,6 +123,40 @@ class Publish(Resource):
         if not args['from']:
             args['from'] = current_app.config['SENDER']
 
+        # Claim the id, so no other request can publish the same message.
+        if log is not None:
+            claim = util.take_over(args['id'], log)
+        else:
+            claim = util.claim_id(args['id'], {
+                'medium': args['medium'],
+                'time': util.get_date(),
+                'message': args['message'],
+                'topics': 'Published to: ' + str(args['topics'])
+            })
+        if not claim:
+            # Lost the claim to another request. Its publish may have since
+            # failed or been abandoned, so resume it if it has, and
+            # otherwise report the state it is in now.
+            log = util.get_log(args['id'])
+            if log is not None and util.resumable(log):
+                claim = util.take_over(args['id'], log)
+            if not claim:
+                return existing(args['id'], util.get_log(args['id']))
+        args['claim'] = claim
+        args['resume'] = log is not None
+
+        # Queue the message for the publish worker if asked to, so the caller
+        # doesn't have to wait for every message to be sent.
+        if args['async'] is None:
+            queue = current_app.config['PUBLISH_ASYNC']
+        else:
+            queue = args['async'] in ['True', 'true']
+        if queue:
+            job = jobs.enqueue(args)
+            return Response(json.dumps(job),
+                            status=202,
+                            mimetype='application/json')
+
         # Assuming everything is fine publish the message.
         responses = util.publish(args)
 
@@ -132,18 +166,83 @@ class Publish(Resource):
                         mimetype='application/json')
 
 
-class Notify(Resource):
+def existing(message_id, log):
+    """
+    The response to a request to publish a message whose ID has already been
+    claimed by another request.
+
+    Args:
+        message_id (str): The message's ID.
+        log (dict): The message's log record, or None if it has been deleted.
+
+    Returns:
+        A 202 response with the message's state if it is still being sent,
+        otherwise a 400 Bad Request response.
+    """
+    state = (log or {}).get('state', 'done')
+    if state in ['claimed', 'sending', 'failed']:
+        return Response(json.dumps({'id': message_id, 'state': state}),
+                        status=202,
+                        mimetype='application/json')
+
+    logger.warning(
+        "Can't publish message. ID {} already exists.".format(message_id)
+    )
+    # If the message ID exists, return with a 400 bad request response.
+    message = {
+        "message": ("400 Bad Request: id " + message_id +
+                    " already exists"),
+        "state": state
+    }
+    return Response(json.dumps(message),
+                    status=400,
+                    mimetype='application/json')
+
+
+class PublishStatus(Resource):
 
     decorators = [authorise]
 
-    def __init__(self):
-        # Load the database and tables, upon object creation.
-        db = boto3.resource(
-            'dynamodb',
-            endpoint_url=current_app.config['DB_URL'],
-            region_name='eu-west-1'
-        )
-        self.subscribers = db.Table(current_app.config['SUBSCRIBERS'])
+    def get(self, message_id):
+        """
+        Get the state and per-medium progress of a publish job.
+
+        Args:
+            message_id (str): The id of the published message.
+
+        Returns:
+            The job's state ('queued', 'sending', 'done' or 'failed') and
+            counts of the messages sent so far for each medium.
+        """
+        job = jobs.status(message_id)
+
+        # Messages that were published without the queue are only logged.
+        if job is None:
+            log = util.get_log(message_id)
+            if log is not None:
+                job = {
+                    'id': message_id,
+                    'state': log.get('state', 'done'),
+                    'progress': {}
+                }
+
+        if job is None:
+            message = {
+                "message": ("404 Not Found: id " + message_id +
+                            " hasn't been published")
+            }
+            return Response(json.dumps(message),
+                            status=404,
+                            mimetype='application/json')
+
+        return Response(json.dumps(job),
+                        status=200,
+                        mimetype='application/json')
+
+
+class Notify(Resource):
+
+    decorators = [authorise]
 
     def get(self):
         """
@@ -223,15 +322,6 @@ class Error(Resource):
 
     decorators = [authorise]
 
-    def __init__(self):
-        # Load the database and tables, upon object creation.
-        db = boto3.resource(
-            'dynamodb',
-            endpoint_url=current_app.config['DB_URL'],
-            region_name='eu-west-1'
-        )
-        self.subscribers = db.Table(current_app.config['SUBSCRIBERS'])
-
     def put(self):
         """
         Notify the developers of an error in the system. Error notifications
@@ -3,10 +3,9 @@ This class manages the Subscriber database field.  It includes methods to
 update the the dynamodb table "hermes_subscribers".
 """
 from flask_restful import Resource, reqparse
-from flask import Response, current_app, jsonify
+from flask import Response, jsonify
 from meerkat_hermes import authorise
 import meerkat_hermes.util as util
-import boto3
 import json
 
 
@@ -14,15 +13,6 @@ class Subscribe(Resource):
 
     decorators = [authorise]
 
-    def __init__(self):
-        # Load the database and tables once upon object creation.
-        db = boto3.resource(
-            'dynamodb',
-            endpoint_url=current_app.config['DB_URL'],
-            region_name='eu-west-1'
-        )
-        self.subscribers = db.Table(current_app.config['SUBSCRIBERS'])
-
     def get(self, subscriber_id):
         """
         Get a subscriber's info from the database.
@@ -30,13 +20,15 @@ class Subscribe(Resource):
         Args:
              subscriber_id (str): The ID for the desired subscriber.
         Returns:
-             The amazon dynamodb response.
+             The subscriber in the shape of an amazon dynamodb get_item
+             response, with the record as attribute "Item" unless the
+             subscriber doesn't exist. The record may come from the cache,
+             so the "ResponseMetadata" only holds the HTTPStatusCode.
         """
-        response = self.subscribers.get_item(
-            Key={
-                'id': subscriber_id
-            }
-        )
+        response = {'ResponseMetadata': {'HTTPStatusCode': 200}}
+        subscriber = util.get_subscriber(subscriber_id)
+        if subscriber:
+            response['Item'] = subscriber
         return Response(json.dumps(response),
                         status=response['ResponseMetadata']['HTTPStatusCode'],
                         mimetype='application/json')
@@ -111,6 +103,65 @@ class Subscribe(Resource):
                         status=response['ResponseMetadata']['HTTPStatusCode'],
                         mimetype='application/json')
 
+    def patch(self, subscriber_id):
+        """
+        Change a subscriber's details in place, keeping their subscriber ID
+        and verification. Only the given arguments are changed.
+
+        Arguments are passed in the request data.
+
+        Args:
+            subscriber_id (str): The ID for the subscriber to be changed.\n
+            first_name (str): The subscriber's first name.\n
+            last_name (str): The subscriber's last name.\n
+            email (str): The subscriber's email address.\n
+            country (str): The country that the subscriber has signed up to.\n
+            sms (str): The subscribers phone number for sms, empty to remove
+                       it.\n
+            slack (str): The slack username/channel, empty to remove it.\n
+            topics ([str]): The ID's for all the topics to which the
+                            subscriber wishes to subscribe.\n
+            add_topics ([str]): Topic ID's to subscribe to, as well as their
+                                existing topics.\n
+            remove_topics ([str]): Topic ID's to unsubscribe from.
+
+        Returns:
+            A json object with the updated subscriber record as attribute
+            "Item", as for the GET method.
+        """
+        parser = reqparse.RequestParser()
+        for field in util.SUBSCRIBER_FIELDS:
+            parser.add_argument(field, required=False, type=str,
+                                store_missing=False)
+        for field in ['topics', 'add_topics', 'remove_topics']:
+            parser.add_argument(field, required=False, type=str,
+                                action='append', store_missing=False)
+        args = parser.parse_args()
+
+        try:
+            subscriber = util.update_subscriber(
+                subscriber_id,
+                {k: v for k, v in args.items()
+                 if k in util.SUBSCRIBER_FIELDS + ['topics']},
+                args.get('add_topics', []),
+                args.get('remove_topics', [])
+            )
+        except ValueError as e:
+            return Response(
+                json.dumps({'message': '400 Bad Request: {}'.format(e)}),
+                status=400,
+                mimetype='application/json'
+            )
+        if subscriber is None:
+            return Response(
+                json.dumps({'message': '404 Not Found: Unknown subscriber'}),
+                status=404,
+                mimetype='application/json'
+            )
+        return Response(json.dumps({'Item': subscriber}),
+                        status=200,
+                        mimetype='application/json')
+
     def delete(self, subscriber_id):
         """
         Delete a subscriber from the database.
@@ -2,36 +2,39 @@
 This class enables bulk extraction of subscribers details.
 """
 from flask_restful import Resource
-from flask import current_app
+from flask import current_app, Response, stream_with_context
+from boto3.dynamodb.conditions import Attr
 from meerkat_hermes import authorise
-import boto3
+import meerkat_hermes.util as util
 import logging
+import json
 
 
 class Subscribers(Resource):
 
     decorators = [authorise]
 
-    def __init__(self):
-        # Load the database and tables once upon object creation.
-        db = boto3.resource(
-            'dynamodb',
-            endpoint_url=current_app.config['DB_URL'],
-            region_name='eu-west-1'
-        )
-        self.subscribers = db.Table(current_app.config['SUBSCRIBERS'])
-
     def get(self, country):
         """
         Get multiple subscribers from the database according the country the
-        subscriber is part of.
+        subscriber is part of. The subscribers are streamed as a JSON array
+        as they are read, rather than loaded into memory first.
 
         Args:
             country (string): the deployment that the subscribers should be
                 subscribed toself.
         """
         # Query DB for all subscribers belonging to a particular country.
-        return self.get_all(country, None)
+        subscribers = self.iter_all(country, None)
+
+        def stream():
+            yield '['
+            for i, subscriber in enumerate(subscribers):
+                yield (',' if i else '') + json.dumps(subscriber)
+            yield ']'
+
+        return Response(stream_with_context(stream()),
+                        mimetype='application/json')
 
     def get_all(self, countries, attributes):
         """
@@ -47,7 +50,20 @@ class Subscribers(Resource):
                 want to download.
 
         Returns:
-            A python dictionary storing user accounts by username.
+            A list of the subscriber records.
+        """
+        return list(self.iter_all(countries, attributes))
+
+    def iter_all(self, countries, attributes):
+        """
+        Lazily yields the requested attributes for all subscribers that belong
+        to the specified countries. Each country, and the "All" wildcard, is
+        read with a query of the country index, so only the subscribers in
+        those countries are read. With no countries, the whole table is
+        scanned. Takes the same arguments as get_all().
+
+        Returns:
+            A generator of subscriber records, without duplicates.
         """
 
         # Set things up.
@@ -65,45 +81,51 @@ class Subscribers(Resource):
         if not isinstance(attributes, list):
             attributes = [attributes]
 
-        # Include the "All" wildcard [NOTE: Is this really used?]
-        countries = countries + ['All']
+        # Only load the requested attributes, and the id to remove duplicates.
+        projection = util.projection_kwargs(attributes)
 
-        # Return dict is indexed by username, so ensure added.
-        if attributes and 'id' not in attributes:
-            attributes.append('id')
-
-        # Assemble scan arguments programatically, by building a dictionary.
-        kwargs = {}
+        # With no countries, load every subscriber.
+        if not countries:
+            yield from util.parallel_scan(
+                current_app.config['SUBSCRIBERS'],
+                current_app.config['SCAN_SEGMENTS'],
+                **projection
+            )
+            return
+
+        # Include the subscribers to "All" countries.
+        countries = list(dict.fromkeys(countries + ['All']))
+
+        # Load data separately for each country, skipping subscribers already
+        # yielded for a previous country.
+        seen = set()
+        for country in countries:
+            for subscriber in self.iter_country(country, attributes):
+                if subscriber["id"] not in seen:
+                    seen.add(subscriber["id"])
+                    yield subscriber
+
+    def iter_country(self, country, attributes):
+        """
+        Lazily yields the requested attributes of the subscribers to a single
+        country, using the country index if there is one.
 
-        # Include AttributesToGet if any are specified.
-        # By not including them we get them all.
-        if attributes:
-            kwargs["AttributesToGet"] = attributes
+        Args:
+            country (str) The country.
+            attributes ([str]) The attribute names to load, or an empty list
+                to load whole records.
 
-        if not countries:
-            # If no country is specified, get all users and return as list.
-            return self.subscribers.scan(**kwargs).get("Items", [])
-
-        else:
-            subscribers = {}
-            # Load data separately for each country
-            # ...because Scan can't perform OR on CONTAINS
-            for country in countries:
-
-                kwargs["ScanFilter"] = {
-                    'country': {
-                        'AttributeValueList': [country],
-                        'ComparisonOperator': 'CONTAINS'
-                    }
-                }
-                logging.warning(kwargs)
-                logging.warning(
-                    self.subscribers.scan(**kwargs).get("Items", [])
-                )
-
-                # Get and combine the subscribers together in a no-duplications dict.
-                for subscriber in self.subscribers.scan(**kwargs).get("Items", []):
-                    subscribers[subscriber["id"]] = subscriber
-
-            # Convert the dict to a list by getting values.
-            return list(subscribers.values())
+        Returns:
+            A generator of subscriber records.
+        """
+        if current_app.config['SUBSCRIBERS_COUNTRY_INDEX']:
+            return util.country_subscribers(country, attributes)
+
+        # Without the index, scan for the country, which can also match
+        # subscribers with a list of countries.
+        return util.parallel_scan(
+            current_app.config['SUBSCRIBERS'],
+            current_app.config['SCAN_SEGMENTS'],
+            FilterExpression=Attr('country').contains(country),
+            **util.projection_kwargs(attributes)
+        )
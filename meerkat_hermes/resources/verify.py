@@ -5,11 +5,11 @@ and storing verify codes (one at a time) that can be used to verify any
 communication medium. It is also used after a subscriber's details have been
 verified, to make their subscriptions active.
 """
-import boto3
 import json
 from flask_restful import Resource, reqparse
 from flask import current_app, Response
-from meerkat_hermes import authorise
+from meerkat_hermes import authorise, cache, clients
+import meerkat_hermes.util as util
 
 
 class Verify(Resource):
@@ -17,13 +17,8 @@ class Verify(Resource):
     decorators = [authorise]
 
     def __init__(self):
-        # Load the database and tables, upon object creation.
-        db = boto3.resource(
-            'dynamodb',
-            endpoint_url=current_app.config['DB_URL'],
-            region_name='eu-west-1'
-        )
-        self.subscribers = db.Table(current_app.config['SUBSCRIBERS'])
+        # Load the tables from the shared client registry.
+        self.subscribers = clients.table(current_app.config['SUBSCRIBERS'])
 
     def put(self):
         """
@@ -61,6 +56,7 @@ class Verify(Resource):
                 }
             }
         )
+        cache.invalidate('subscribers', [args['subscriber_id']])
 
         return Response(json.dumps(response),
                         status=response['ResponseMetadata']['HTTPStatusCode'],
@@ -152,6 +148,13 @@ class Verify(Resource):
                     }
                 }
             )
+            cache.invalidate('subscribers', [subscriber_id])
+
+            # Make the subscriber's subscriptions active.
+            util.create_subscriptions(
+                subscriber_id,
+                subscriber['Item']['topics']
+            )
 
             return Response(
                 json.dumps({"message": "Subscriber verified"}),
@@ -0,0 +1,210 @@
+"""
+retry.py
+
+Retries sends that fail because a provider is throttling hermes or is briefly
+unavailable, so that bursts near a provider's quota are slowed down rather
+than lost.
+
+Each provider ('ses', 'sns', 'slack' or 'gcm') has its own classification of
+errors. Throttling, server errors and dropped connections are retried, while
+permanent errors, e.g. an invalid address or an exhausted daily quota, fail
+straight away. Retries wait with full jitter exponential backoff: a random
+delay of up to RETRY_BASE_DELAY seconds, doubling with each retry up to
+RETRY_MAX_DELAY. A send is retried at most RETRY_ATTEMPTS times, and only
+while it is within RETRY_BUDGET seconds of its first attempt.
+
+Sends made by util.dispatch() don't wait in their worker threads. Instead
+they raise RetryLater, and dispatch() runs them again once their delay has
+passed, so that a throttled send doesn't hold up the rest of a fan-out.
+"""
+from meerkat_hermes import app, logger
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotocoreConnectionError
+from contextlib import contextmanager
+import requests
+import threading
+import random
+import time
+
+# The AWS error codes that each provider uses for throttling and for brief
+# outages, which are worth retrying.
+AWS_TRANSIENT = {
+    'ses': {
+        'Throttling', 'ThrottlingException', 'ServiceUnavailable',
+        'InternalFailure', 'RequestTimeout'
+    },
+    'sns': {
+        'Throttling', 'ThrottlingException', 'ThrottledException',
+        'KMSThrottlingException', 'InternalError', 'InternalFailure',
+        'ServiceUnavailable'
+    }
+}
+
+# SES uses the Throttling code when the daily sending quota is used up, which
+# won't recover for hours.
+AWS_PERMANENT_MESSAGES = {
+    'ses': ['Daily message quota exceeded']
+}
+
+_local = threading.local()
+
+
+class RetryLater(Exception):
+    """
+    Raised by a deferred send that should be retried after a delay.
+
+    Args:
+        delay (float): The number of seconds to wait before retrying.
+    """
+
+    def __init__(self, delay):
+        super().__init__("Retry in {:.2f}s".format(delay))
+        self.delay = delay
+
+
+class Backoff(object):
+    """
+    The retry state of a single send, shared between its attempts. The
+    send's time budget starts when its state is created, so it should be
+    created just before the first attempt.
+
+    Args:
+        budget (float): The seconds after which the send isn't retried.
+            Defaults to RETRY_BUDGET.
+    """
+
+    def __init__(self, budget=None):
+        self.retries = 0
+        self.started = time.time()
+        self.budget = budget
+        if budget is None:
+            self.budget = app.config['RETRY_BUDGET']
+
+    def delay(self, minimum=0):
+        """
+        Counts another retry and returns how long to wait before making it.
+
+        Args:
+            minimum (float): The least time to wait, e.g. as requested by the
+                provider's Retry-After header.
+
+        Returns:
+            The number of seconds to wait, or None if the send has run out of
+            retries or out of its time budget.
+        """
+        if self.retries >= app.config['RETRY_ATTEMPTS']:
+            return None
+        cap = min(
+            app.config['RETRY_MAX_DELAY'],
+            app.config['RETRY_BASE_DELAY'] * 2 ** self.retries
+        )
+        delay = max(random.uniform(0, cap), minimum)
+        elapsed = time.time() - self.started
+        if elapsed + delay > self.budget:
+            return None
+        self.retries += 1
+        return delay
+
+
+def transient(provider, error=None, response=None):
+    """
+    Classifies a failed send as transient, and so worth retrying, or
+    permanent.
+
+    Args:
+        provider (str): Required. 'ses', 'sns', 'slack' or 'gcm'.
+        error (Exception): The exception raised by the send, if any.
+        response: The HTTP response returned by the send, if any.
+
+    Returns:
+        True if the send should be retried.
+    """
+    if isinstance(error, ClientError):
+        details = error.response.get('Error', {})
+        message = details.get('Message', '')
+        if any(permanent in message
+               for permanent in AWS_PERMANENT_MESSAGES.get(provider, [])):
+            return False
+        return details.get('Code') in AWS_TRANSIENT.get(provider, set())
+    if isinstance(error, (BotocoreConnectionError, HTTPClientError)):
+        return True
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if error is None and response is not None:
+        status = getattr(response, 'status_code', None)
+        return isinstance(status, int) and (status == 429 or status >= 500)
+    return False
+
+
+def _retry_after(response):
+    # The delay asked for by an HTTP response's Retry-After header, if any.
+    try:
+        return float(response.headers.get('Retry-After', 0))
+    except (AttributeError, ValueError):
+        return 0
+
+
+@contextmanager
+def deferred(backoff):
+    """
+    Makes sends in this thread raise RetryLater instead of waiting to retry,
+    see util.dispatch().
+
+    Args:
+        backoff (Backoff): Required. The retry state of the send, kept by the
+            caller between attempts.
+    """
+    _local.backoff = backoff
+    try:
+        yield backoff
+    finally:
+        _local.backoff = None
+
+
+def call(provider, function, *args, **kwargs):
+    """
+    Calls a send function, retrying it while it fails transiently and the
+    retry budget allows. Any further args are passed to the function.
+
+    Args:
+        provider (str): Required. 'ses', 'sns', 'slack' or 'gcm'.
+        function (function): Required. The function that sends the message.
+
+    Returns:
+        A tuple of the function's return value and the number of retries it
+        took. A transient HTTP error response is returned once the retries
+        have run out.
+
+    Raises:
+        RetryLater: If the send is deferred, see deferred().
+        Exception: The function's last error, with the number of retries it
+            took as its 'retries' attribute.
+    """
+    backoff = getattr(_local, 'backoff', None)
+    defer = backoff is not None
+    if not defer:
+        backoff = Backoff()
+
+    while True:
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            delay = backoff.delay() if transient(provider, error=e) else None
+            if delay is None:
+                e.retries = backoff.retries
+                raise
+            logger.warning("Retrying {} send in {:.2f}s: {}".format(
+                provider, delay, e
+            ))
+        else:
+            delay = None
+            if transient(provider, response=result):
+                delay = backoff.delay(_retry_after(result))
+            if delay is None:
+                return result, backoff.retries
+            logger.warning("Retrying {} send in {:.2f}s: status {}".format(
+                provider, delay, result.status_code
+            ))
+        if defer:
+            raise RetryLater(delay)
+        time.sleep(delay)
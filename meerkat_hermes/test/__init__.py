@@ -5,18 +5,36 @@ Meerkat Hermes Tests
 Unit tests for Meerkat Hermes util methods and resource classes.
 """
 from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
 from unittest import mock
 from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import meerkat_hermes.util as util
+import meerkat_hermes.jobs as jobs
+import meerkat_hermes.cache as cache
+import meerkat_hermes.logwriter as logwriter
+import meerkat_hermes.dedup as dedup
+import meerkat_hermes.retry as retry
+import meerkat_hermes.ratelimit as ratelimit
+import meerkat_hermes.pacing as pacing
+import meerkat_hermes.clients as clients
+import meerkat_hermes.coalesce as coalesce
+import meerkat_hermes.export as export
 import meerkat_hermes
 from meerkat_hermes import app
+from meerkat_hermes.resources.log import encode_token
 import requests
 import json
 import unittest
 import boto3
 import logging
 import copy
+import csv
+import io
+import threading
 import time
+import os
+import uuid
 
 
 class MeerkatHermesTestCase(unittest.TestCase):
@@ -130,6 +148,29 @@ class MeerkatHermesTestCase(unittest.TestCase):
             self.assertEquals(value, util.replace_keywords(
                 message, self.subscriber))
 
+    def test_util_mail_merge(self):
+        """
+        Test the MailMerge class renders a parsed message for different
+        subscribers, leaving unknown fields alone.
+        """
+        template = util.MailMerge(
+            "Dear <<first_name>> <<last_name>>, <<unknown>> <<topics>>."
+        )
+        self.assertEqual(template.fields,
+                         ['first_name', 'last_name', 'unknown', 'topics'])
+        values = util.keyword_values(self.subscriber, template.fields)
+        self.assertEqual(
+            template.render(values),
+            "Dear Testy McTestFace, <<unknown>> Test1, Test2 and Test3."
+        )
+        values['first_name'] = 'Other'
+        self.assertEqual(
+            template.render(values),
+            "Dear Other McTestFace, <<unknown>> Test1, Test2 and Test3."
+        )
+        self.assertEqual(util.MailMerge("No fields").render(values),
+                         "No fields")
+
     def test_util_id_valid(self):
         """
         Test the id_valid utility function that checks whether a message ID
@@ -165,6 +206,484 @@ class MeerkatHermesTestCase(unittest.TestCase):
             util.get_date()
         )
 
+    def test_util_dispatch(self):
+        """
+        Test the dispatch utility function keeps the order of the jobs, even
+        when later jobs finish first.
+        """
+        def job(i):
+            time.sleep(0.01 * (5 - i % 5))
+            return i
+
+        jobs = [('email' if i % 2 else 'sms', job, (i,)) for i in range(20)]
+        self.assertEqual(util.dispatch(jobs), list(range(20)))
+
+    def test_util_limit_exceeded(self):
+        """
+        Test the limit_exceeded utility function enforces the topic and
+        caller rate limits, using each of the rate limit backends.
+        """
+        config = {key: app.config[key] for key in [
+            'RATE_LIMIT_BACKEND',
+            'PUBLISH_RATE_LIMIT',
+            'PUBLISH_TOPIC_RATE_LIMIT',
+            'PUBLISH_CALLER_RATE_LIMIT'
+        ]}
+        app.config.update({
+            'PUBLISH_RATE_LIMIT': 0,
+            'PUBLISH_TOPIC_RATE_LIMIT': 2,
+            'PUBLISH_CALLER_RATE_LIMIT': 3
+        })
+
+        for backend in ['local', 'dynamodb']:
+            app.config['RATE_LIMIT_BACKEND'] = backend
+            topic = 'TestLimit' + uuid.uuid4().hex
+            caller = 'TestCaller' + uuid.uuid4().hex
+
+            # Two calls to the topic are allowed, the third exceeds the limit.
+            self.assertFalse(util.limit_exceeded([topic], caller))
+            self.assertFalse(util.limit_exceeded([topic], caller))
+            exceeded = util.limit_exceeded([topic], caller)
+            self.assertEqual(len(exceeded), 1)
+            self.assertIn(topic, exceeded[0])
+
+            # The caller's fourth call exceeds their limit on any topic.
+            exceeded = util.limit_exceeded(['Other' + topic], caller)
+            self.assertEqual(len(exceeded), 1)
+            self.assertIn(caller, exceeded[0])
+
+        # Only the scopes hit since the last window closed are remembered.
+        now = time.time()
+        for i in range(3):
+            with mock.patch('time.time', return_value=now + i * 60):
+                ratelimit.hit('TestScope' + str(i), window=60)
+        self.assertEqual(list(ratelimit._closed_windows[60][1]),
+                         ['TestScope2'])
+
+        app.config.update(config)
+
+    def test_util_scan(self):
+        """
+        Test the scan utility functions read every page of the table, for
+        both serial and parallel scans.
+        """
+        last_name = 'Scan' + uuid.uuid4().hex
+        subscriber_ids = []
+        for i in range(5):
+            subscriber = self.subscriber.copy()
+            subscriber['last_name'] = last_name
+            response = util.subscribe(**subscriber)
+            subscriber_ids.append(response['subscriber_id'])
+
+        # A Limit of one item per page forces many pages.
+        kwargs = {'ScanFilter': {'last_name': {
+            'AttributeValueList': [last_name],
+            'ComparisonOperator': 'EQ'
+        }}, 'Limit': 1}
+        scanned = [s['id'] for s in util.scan(self.subscribers, **kwargs)]
+        self.assertEqual(sorted(scanned), sorted(subscriber_ids))
+        scanned = util.parallel_scan(app.config['SUBSCRIBERS'], 1, **kwargs)
+        self.assertEqual(sorted(s['id'] for s in scanned),
+                         sorted(subscriber_ids))
+
+        for subscriber_id in subscriber_ids:
+            util.delete_subscriber(subscriber_id)
+
+        # The local database ignores scan segments, so fake a table that
+        # pages through each segment two items at a time.
+        def segment_scan(Segment, TotalSegments, ExclusiveStartKey=0):
+            items = [{'id': i} for i in range(Segment, 20, TotalSegments)]
+            response = {'Items': items[ExclusiveStartKey:ExclusiveStartKey+2]}
+            if ExclusiveStartKey + 2 < len(items):
+                response['LastEvaluatedKey'] = ExclusiveStartKey + 2
+            return response
+
+        with mock.patch('meerkat_hermes.clients.table') as table_mock:
+            table_mock.return_value.scan.side_effect = segment_scan
+            scanned = util.parallel_scan('segmented', 3)
+            self.assertEqual(sorted(s['id'] for s in scanned), list(range(20)))
+
+            # Scanning stops when the caller stops reading.
+            scanned = util.parallel_scan('segmented', 3)
+            self.assertEqual(len([next(scanned) for i in range(3)]), 3)
+            scanned.close()
+
+    def test_util_cache(self):
+        """
+        Test subscribers and topic subscriptions are cached until they are
+        changed, in this process and, with the dynamodb backend, in others.
+        """
+        topic = 'TestCache' + uuid.uuid4().hex
+        subscriber = dict(self.subscriber, topics=[topic], verified=True)
+        subscriber_id = util.subscribe(**subscriber)['subscriber_id']
+
+        # The second lookups are cache hits.
+        stats = cache.stats().get('subscribers', {'hits': 0})
+        self.assertEqual(util.get_subscriber(subscriber_id)['id'],
+                         subscriber_id)
+        self.assertEqual(util.get_subscriber(subscriber_id)['id'],
+                         subscriber_id)
+        self.assertEqual(cache.stats()['subscribers']['hits'],
+                         stats['hits'] + 1)
+        self.assertEqual(util.get_topic_subscribers(topic), [subscriber_id])
+        self.assertEqual(util.get_topic_subscribers(topic), [subscriber_id])
+
+        get_response = self.app.get('/metrics')
+        get_response = json.loads(get_response.data.decode('UTF-8'))
+        self.assertIn('topics', get_response['cache'])
+
+        # Deleting the subscriber invalidates the cache.
+        util.delete_subscriber(subscriber_id)
+        self.assertIsNone(util.get_subscriber(subscriber_id))
+        self.assertEqual(util.get_topic_subscribers(topic), [])
+
+        # Another process's change clears this process's cache.
+        config = {key: app.config[key] for key in [
+            'CACHE_BACKEND',
+            'CACHE_SYNC_INTERVAL'
+        ]}
+        app.config.update({
+            'CACHE_BACKEND': 'dynamodb',
+            'CACHE_SYNC_INTERVAL': 0
+        })
+        subscriber_id = util.subscribe(**subscriber)['subscriber_id']
+        self.assertEqual(util.get_topic_subscribers(topic), [subscriber_id])
+        self.subscriptions.delete_item(Key={
+            'topicID': topic,
+            'subscriberID': subscriber_id
+        })
+        self.assertEqual(util.get_topic_subscribers(topic), [subscriber_id])
+        cache.backend().bump('topics')
+        self.assertEqual(util.get_topic_subscribers(topic), [])
+
+        util.delete_subscriber(subscriber_id)
+        app.config.update(config)
+
+    def test_util_log_message(self):
+        """
+        Test the log_message utility function writes log entries in batches,
+        including entries too large to log in full.
+        """
+        log_ids = ['TestLog' + uuid.uuid4().hex for i in range(30)]
+        for log_id in log_ids:
+            util.log_message(log_id, {
+                'destination': [self.subscriber['email']],
+                'message': self.message['message'],
+                'medium': ['email'],
+                'time': util.get_date()
+            })
+            self.assertFalse(util.id_valid(log_id))
+        util.log_message(log_ids[0], {
+            'destination': [self.subscriber['email']],
+            'message': self.message['message'] + 'x' * 500 * 1024,
+            'medium': ['email'],
+            'time': util.get_date()
+        })
+
+        written = logwriter.stats()['written']
+        logwriter.flush()
+        self.assertEqual(logwriter.stats()['written'] - written, 31)
+        self.assertEqual(logwriter.stats()['pending'], 0)
+        for log_id in log_ids:
+            get_response = self.log.get_item(Key={'id': log_id})
+            self.assertIn('Item', get_response)
+            self.assertFalse(util.id_valid(log_id))
+            self.log.delete_item(Key={'id': log_id})
+
+        # Entries a throttled table won't take are given up on once the
+        # retries run out, rather than holding up the flush.
+        def unprocessed(RequestItems):
+            return {'UnprocessedItems': RequestItems}
+
+        failed = logwriter.stats()['failed']
+        config = {'RETRY_ATTEMPTS': 2, 'RETRY_BASE_DELAY': 0.01}
+        with mock.patch.dict(app.config, config), \
+                mock.patch.object(clients, 'dynamodb') as dynamodb_mock:
+            dynamodb_mock.return_value.batch_write_item.side_effect = \
+                unprocessed
+            util.log_message(log_ids[0], {'message': 'Throttled'})
+            logwriter.flush()
+            self.assertEqual(
+                dynamodb_mock.return_value.batch_write_item.call_count, 3
+            )
+        self.assertEqual(logwriter.stats()['failed'] - failed, 1)
+        self.assertNotIn('Item', self.log.get_item(Key={'id': log_ids[0]}))
+
+    def test_util_claim_id(self):
+        """
+        Test ids new to this process skip the log, and that only the first
+        claim of an id succeeds, even if this process has forgotten it.
+        """
+        bloom = dedup.BloomFilter(1024)
+        bloom.add('TestBloom')
+        self.assertIn('TestBloom', bloom)
+        self.assertNotIn('TestBloomOther', bloom)
+
+        message_id = 'TestClaim' + uuid.uuid4().hex
+        with mock.patch('meerkat_hermes.clients.table') as table_mock:
+            self.assertTrue(util.id_valid(message_id, consistent=False))
+            self.assertFalse(table_mock.called)
+
+        details = {'message': self.message['message'], 'time': 'now'}
+        self.assertTrue(util.claim_id(message_id, details))
+        self.assertFalse(util.id_valid(message_id, consistent=False))
+        self.assertFalse(util.claim_id(message_id, details))
+
+        # Another process knows nothing of the id, but can't claim it.
+        dedup.discard(message_id)
+        with mock.patch.object(dedup, 'check', return_value=dedup.NEW):
+            self.assertTrue(util.id_valid(message_id, consistent=False))
+            self.assertFalse(util.claim_id(message_id, details))
+        self.app.delete('/log/' + message_id)
+
+    @mock.patch('meerkat_hermes.clients.client')
+    def test_util_retry(self, boto_mock):
+        """
+        Test throttled sends are retried with backoff, that permanent errors
+        aren't retried, and that a throttled send in a fan-out doesn't hold
+        up the others.
+        """
+        def error(code, message=''):
+            return ClientError(
+                {'Error': {'Code': code, 'Message': message}},
+                'SendEmail'
+            )
+
+        self.assertTrue(retry.transient('ses', error('Throttling')))
+        self.assertTrue(retry.transient('sns', error('ThrottledException')))
+        self.assertFalse(retry.transient('ses', error('MessageRejected')))
+        self.assertFalse(retry.transient(
+            'ses', error('Throttling', 'Daily message quota exceeded.')
+        ))
+        self.assertTrue(retry.transient('slack', requests.ConnectionError()))
+        self.assertTrue(retry.transient(
+            'gcm', response=mock.Mock(status_code=503)
+        ))
+        self.assertFalse(retry.transient(
+            'gcm', response=mock.Mock(status_code=400)
+        ))
+
+        config = {'RETRY_BASE_DELAY': 0.01, 'RETRY_ATTEMPTS': 3}
+        with mock.patch.dict(app.config, config):
+
+            # The send succeeds once SES stops throttling it.
+            send_email = boto_mock.return_value.send_email
+            send_email.side_effect = [
+                error('Throttling'),
+                error('Throttling'),
+                {'MessageId': 'TestID', 'ResponseMetadata': {}}
+            ]
+            response = util.send_email(
+                [self.subscriber['email']], 'Subject', 'Message', '', 'Sender'
+            )
+            self.assertEqual(response['SesMessageId'], 'TestID')
+            self.assertEqual(response['ResponseMetadata']['RetryAttempts'], 2)
+
+            # Permanent errors and too many throttles fail.
+            send_email.side_effect = error('MessageRejected')
+            response = util.send_email(
+                [self.subscriber['email']], 'Subject', 'Message', '', 'Sender'
+            )
+            self.assertEqual(response['ResponseMetadata']['RetryAttempts'], 0)
+            send_email.side_effect = error('Throttling')
+            send_email.reset_mock()
+            response = util.send_email(
+                [self.subscriber['email']], 'Subject', 'Message', '', 'Sender'
+            )
+            self.assertEqual(response['ResponseMetadata']['HTTPStatusCode'],
+                             400)
+            self.assertEqual(response['ResponseMetadata']['RetryAttempts'], 3)
+            self.assertEqual(send_email.call_count, 4)
+
+            # A send isn't retried once its retry budget has been spent.
+            backoff = retry.Backoff()
+            self.assertIsNotNone(backoff.delay())
+            backoff.started -= app.config['RETRY_BUDGET']
+            self.assertIsNone(backoff.delay())
+
+        # With one worker, a throttled job waits without blocking the next.
+        calls = []
+
+        def send(name):
+            calls.append(name)
+
+            def attempt():
+                if calls == ['first']:
+                    raise error('Throttling')
+                return name
+            return retry.call('ses', attempt)[0]
+
+        finished = []
+        config = {'RETRY_BASE_DELAY': 0.2, 'PUBLISH_WORKERS': {'email': 1}}
+        with mock.patch.dict(app.config, config):
+            with mock.patch('random.uniform', lambda low, high: high):
+                results = util.dispatch(
+                    [('email', send, ('first',)),
+                     ('email', send, ('second',))],
+                    on_result=lambda index, result: finished.append(result)
+                )
+        self.assertEqual(results, ['first', 'second'])
+        self.assertEqual(finished, ['second', 'first'])
+        self.assertEqual(calls, ['first', 'second', 'first'])
+
+    @mock.patch('meerkat_hermes.clients.client')
+    def test_util_pacing(self, boto_mock):
+        """
+        Test sends are paced to a share of the provider's quota, read from
+        SES for emails, and that the utilisation is reported.
+        """
+        boto_mock.return_value.get_send_quota.return_value = {
+            'Max24HourSend': 50000.0,
+            'MaxSendRate': 20.0,
+            'SentLast24Hours': 0.0
+        }
+        config = {
+            'PACING_RATES': {'sns': 10},
+            'PACING_SES_QUOTA': True,
+            'PACING_HEADROOM': 0.5,
+            'PACING_PROCESSES': 1
+        }
+        pacing.reset()
+        with mock.patch.dict(app.config, config):
+            self.assertEqual(pacing.pacer('ses').rate, 10)
+            self.assertEqual(pacing.pacer('sns').rate, 5)
+            self.assertIsNone(pacing.pacer('slack'))
+
+            # A full bucket sends a second's worth straight away, then waits.
+            with mock.patch('time.sleep') as sleep_mock:
+                self.assertEqual(pacing.acquire('sns', 5), 0)
+                self.assertAlmostEqual(pacing.acquire('sns'), 0.2, places=1)
+                self.assertAlmostEqual(pacing.acquire('sns', 2), 0.6,
+                                       places=1)
+                self.assertEqual(sleep_mock.call_count, 2)
+                self.assertEqual(pacing.acquire('slack', 100), 0)
+
+        get_response = self.app.get('/metrics')
+        get_response = json.loads(get_response.data.decode('UTF-8'))
+        self.assertEqual(get_response['pacing']['sns']['sent'], 8)
+        self.assertEqual(get_response['pacing']['sns']['rate'], 5)
+        self.assertNotIn('slack', get_response['pacing'])
+
+        # Without a configured number of processes, each process counts
+        # itself in the rate limit backend. Pretend two processes counted
+        # themselves in the last window. The quota is read without holding
+        # the lock.
+        def send_quota():
+            self.assertFalse(pacing._lock.locked())
+            return {'MaxSendRate': 20.0}
+        boto_mock.return_value.get_send_quota.side_effect = send_quota
+        window = app.config['PACING_QUOTA_REFRESH']
+        index = int(time.time() // window)
+        for i in range(2):
+            ratelimit.backend().incr(
+                'pacing:processes:{}:{}'.format(window, index - 1),
+                (index + 1) * window
+            )
+        pacing.reset()
+        with mock.patch.dict(app.config, dict(config, PACING_PROCESSES=0)):
+            self.assertEqual(pacing.pacer('ses').rate, 5)
+            self.assertEqual(pacing.pacer('sns').rate, 2.5)
+            self.assertEqual(ratelimit.backend().get(
+                'pacing:processes:{}:{}'.format(window, index)
+            ), 1)
+        pacing.reset()
+
+    def test_util_http_session(self):
+        """
+        Test Slack posts to a local stub server reuse one keep-alive
+        connection, and that a hung endpoint times out.
+        """
+        posts = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                posts.append((self.client_address, json.loads(body)))
+                if self.path == '/slow':
+                    time.sleep(0.5)
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'ok')
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        clients.reset()
+        try:
+            with mock.patch.dict(app.config, {'SLACK_WEBHOOK_URL': url}):
+                for i in range(5):
+                    response = util.slack('#test', 'Message {}'.format(i))
+                    self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(posts), 5)
+            self.assertEqual(posts[4][1]['text'], 'Message 4')
+            self.assertEqual(len({address for address, body in posts}), 1)
+
+            config = {
+                'SLACK_WEBHOOK_URL': url + '/slow',
+                'HTTP_READ_TIMEOUT': 0.1,
+                'RETRY_ATTEMPTS': 0
+            }
+            with mock.patch.dict(app.config, config):
+                with self.assertRaises(requests.Timeout):
+                    util.slack('#test', 'Hung')
+        finally:
+            server.shutdown()
+            server.server_close()
+            clients.reset()
+
+    def test_util_coalesce(self):
+        """
+        Test bursts of notifications are posted to slack as one digest per
+        channel, counting repeated messages.
+        """
+        post = mock.Mock()
+        config = {'SLACK_COALESCE_WINDOW': 60, 'SLACK_DIGEST_LINES': 2}
+        with mock.patch.dict(app.config, config):
+            for i in range(3):
+                coalesce.add('#errors', 'Abacus failed', 'Error', post)
+            coalesce.add('#errors', 'Abacus recovered', 'Notice', post)
+            coalesce.add('#errors', 'Abacus failed again', 'Error', post)
+            coalesce.add('#other', 'Deployed', 'Notice', post)
+            self.assertFalse(post.called)
+            coalesce.flush()
+
+        self.assertEqual(post.call_count, 2)
+        digests = {args[0]: args[1:] for args, kwargs in post.call_args_list}
+        message, subject = digests['#errors']
+        self.assertEqual(subject, '5 messages in 60s')
+        self.assertEqual(message.split('\n'), [
+            '*_Error_* | Abacus failed (x3)',
+            '*_Notice_* | Abacus recovered',
+            '...and 1 more distinct messages.'
+        ])
+        self.assertEqual(digests['#other'], ('Deployed', 'Notice'))
+
+        # Notifications are coalesced when published.
+        subscriber = {**self.subscriber, 'topics': app.config['NOTIFY_DEV'],
+                      'slack': '#notify', 'verified': True}
+        del subscriber['sms']
+        subscriber_id = util.subscribe(**subscriber)['subscriber_id']
+        with mock.patch.object(util, 'slack') as slack_mock:
+            for i in range(3):
+                responses = util.notify({'message': 'Deployed'})
+                self.assertEqual(responses[0]['code'], 202)
+            self.assertFalse(slack_mock.called)
+            coalesce.flush()
+            slack_mock.assert_called_once_with(
+                '#notify',
+                '*_{} Meerkat Notification_* | Deployed (x3)'.format(
+                    app.config['HERMES_DEPLOYMENT']
+                ),
+                '3 messages in 5s'
+            )
+        util.delete_subscriber(subscriber_id)
+
     # TODO: Tests for these util functions would be almost doubled later on:
     #  - log_message()
     #  - send_sms()
@@ -198,6 +717,17 @@ class MeerkatHermesTestCase(unittest.TestCase):
             self.subscriber['email'], get_response['Item']['email']
         )
 
+        # The resource returns it in the shape of a get_item response.
+        get_response = self.app.get('/subscribe/' + subscriber_id)
+        self.assertEquals(get_response.status_code, 200)
+        get_response = json.loads(get_response.data.decode('UTF-8'))
+        self.assertEquals(
+            self.subscriber['email'], get_response['Item']['email']
+        )
+        self.assertEquals(
+            get_response['ResponseMetadata']['HTTPStatusCode'], 200
+        )
+
         # Try to delete the subscriber.
         delete_response = self.app.delete('/subscribe/badID')
         self.assertEquals(delete_response.status_code, 500)
@@ -209,6 +739,121 @@ class MeerkatHermesTestCase(unittest.TestCase):
         delete_response = json.loads(delete_response.data.decode('UTF-8'))
         self.assertEquals(delete_response.get('status'), 'successful')
 
+        # A missing subscriber has no item.
+        get_response = self.app.get('/subscribe/' + subscriber_id)
+        self.assertEquals(get_response.status_code, 200)
+        get_response = json.loads(get_response.data.decode('UTF-8'))
+        self.assertNotIn('Item', get_response)
+        self.assertIn('ResponseMetadata', get_response)
+
+    def test_subscribe_resource_patch(self):
+        """
+        Test the Subscribe resource's PATCH method changes a subscriber in
+        place, keeping their subscriptions in step with their topics.
+        """
+        subscriber = dict(self.subscriber, topics=['PatchA', 'PatchB'],
+                          verified=True)
+        subscriber_id = util.subscribe(**subscriber)['subscriber_id']
+
+        patch_response = self.app.patch('/subscribe/' + subscriber_id, data={
+            'email': 'patched@simulator.amazonses.com',
+            'sms': '',
+            'add_topics': ['PatchC', 'PatchA'],
+            'remove_topics': ['PatchB']
+        })
+        self.assertEqual(patch_response.status_code, 200)
+        item = json.loads(patch_response.data.decode('UTF-8'))['Item']
+        self.assertEqual(item['id'], subscriber_id)
+        self.assertEqual(item['email'], 'patched@simulator.amazonses.com')
+        self.assertEqual(item['topics'], ['PatchA', 'PatchC'])
+        self.assertTrue(item['verified'])
+        self.assertNotIn('sms', item)
+        self.assertEqual(util.get_subscriber(subscriber_id), item)
+        self.assertEqual(util.get_topic_subscribers('PatchB'), [])
+        self.assertEqual(util.get_topic_subscribers('PatchC'),
+                         [subscriber_id])
+
+        # Replacing the topics.
+        patch_response = self.app.patch('/subscribe/' + subscriber_id,
+                                        data={'topics': ['PatchB']})
+        item = json.loads(patch_response.data.decode('UTF-8'))['Item']
+        self.assertEqual(item['topics'], ['PatchB'])
+        self.assertEqual(util.get_topic_subscribers('PatchA'), [])
+        self.assertEqual(util.get_topic_subscribers('PatchB'),
+                         [subscriber_id])
+
+        # Invalid changes and unknown subscribers.
+        for data in [{}, {'email': ''}, {'remove_topics': ['PatchB']}]:
+            patch_response = self.app.patch('/subscribe/' + subscriber_id,
+                                            data=data)
+            self.assertEqual(patch_response.status_code, 400)
+        patch_response = self.app.patch('/subscribe/badID',
+                                        data={'first_name': 'Nobody'})
+        self.assertEqual(patch_response.status_code, 404)
+        self.assertNotIn('Item', self.subscribers.get_item(
+            Key={'id': 'badID'}
+        ))
+
+        util.delete_subscriber(subscriber_id)
+
+    def test_bulk_subscribe_resources(self):
+        """
+        Test the bulk subscribe and bulk unsubscribe resources, with JSON
+        arrays and NDJSON, written a chunk of rows at a time.
+        """
+        with mock.patch.dict(app.config, {'BULK_CHUNK_SIZE': 8}):
+            rows = [
+                dict(self.subscriber, first_name='Bulk' + str(i),
+                     verified='True')
+                for i in range(30)
+            ]
+            rows.insert(1, dict(self.subscriber, email=''))
+            post_response = self.app.post('/subscribe/bulk',
+                                          data=json.dumps(rows),
+                                          content_type='application/json')
+            self.assertEqual(post_response.status_code, 200)
+            data = json.loads(post_response.data.decode('UTF-8'))
+            self.assertEqual(data['counts'], {'subscribed': 30, 'invalid': 1})
+            self.assertEqual(data['results'][1], {
+                'row': 1,
+                'status': 'invalid',
+                'error': 'Missing email.'
+            })
+            subscriber_ids = [r['subscriber_id'] for r in data['results']
+                              if r['status'] == 'subscribed']
+
+            # The subscribers and their subscriptions are written.
+            stored = util.get_subscribers(subscriber_ids)
+            self.assertEqual(len(stored), 30)
+            self.assertTrue(stored[subscriber_ids[0]]['verified'])
+            topic_subscribers = util.get_topic_subscribers('Test1')
+            self.assertTrue(set(subscriber_ids) <= set(topic_subscribers))
+
+            # NDJSON lines that aren't valid JSON are invalid rows.
+            ndjson = "\n".join(
+                [json.dumps(subscriber_ids[0]), "{bad", "",
+                 json.dumps({'id': 'badID'})] +
+                [json.dumps({'id': s}) for s in subscriber_ids[1:]]
+            )
+            post_response = self.app.post('/unsubscribe/bulk', data=ndjson,
+                                          content_type='application/x-ndjson')
+            self.assertEqual(post_response.status_code, 200)
+            data = json.loads(post_response.data.decode('UTF-8'))
+            self.assertEqual(data['counts'], {
+                'unsubscribed': 30,
+                'invalid': 1,
+                'not found': 1
+            })
+            self.assertEqual(data['results'][2]['subscriber_id'], 'badID')
+            self.assertEqual(util.get_subscribers(subscriber_ids), {})
+            topic_subscribers = util.get_topic_subscribers('Test1')
+            self.assertFalse(set(subscriber_ids) & set(topic_subscribers))
+
+            # A body that isn't a list of rows is rejected.
+            post_response = self.app.post('/subscribe/bulk', data='{}',
+                                          content_type='application/json')
+            self.assertEqual(post_response.status_code, 400)
+
     def test_subscribers_resource(self):
         """
         Test the Subscribers resource GET method.
@@ -241,6 +886,23 @@ class MeerkatHermesTestCase(unittest.TestCase):
         logging.warning(get_response)
         self.assertEqual(len(get_response), 1)
 
+        # Countries are queried with the country index, not scanned, and
+        # only the requested attributes are loaded.
+        resource = meerkat_hermes.resources.subscribers.Subscribers
+        with app.test_request_context():
+            with mock.patch.object(util, 'parallel_scan') as scan_mock:
+                subscribers = resource().get_all(['Jordan'], ['email'])
+                self.assertFalse(scan_mock.called)
+            self.assertEqual(subscribers, [{
+                'id': subscriber_ids[3],
+                'email': self.subscriber['email']
+            }])
+
+            # Without countries, every subscriber is loaded.
+            subscribers = resource().get_all(None, 'country')
+            ids = {subscriber['id'] for subscriber in subscribers}
+            self.assertTrue(set(subscriber_ids) <= ids)
+
         # Delete the test subscribers.
         for subscriber_id in subscriber_ids:
             self.app.delete('/subscribe/' + subscriber_id)
@@ -278,8 +940,14 @@ class MeerkatHermesTestCase(unittest.TestCase):
         get_response = self.app.get('/verify/' + subscriber_id)
         self.assertEquals(get_response.status_code, 400)
 
-        # Delete the user
+        # Check that verifying created the subscriptions.
+        for topic in self.subscriber['topics']:
+            self.assertIn(subscriber_id, util.get_topic_subscribers(topic))
+
+        # Delete the user and check the subscriptions are deleted too.
         self.app.delete('/subscribe/' + subscriber_id)
+        for topic in self.subscriber['topics']:
+            self.assertNotIn(subscriber_id, util.get_topic_subscribers(topic))
 
     def test_unsubscribe_resource(self):
         """
@@ -326,6 +994,7 @@ class MeerkatHermesTestCase(unittest.TestCase):
         )
 
         # Check that the message has been logged properly.
+        logwriter.flush()
         log_response = self.log.get_item(
             Key={
                 'id': put_response['log_id']
@@ -338,21 +1007,26 @@ class MeerkatHermesTestCase(unittest.TestCase):
         # Delete the message from the log
         self.app.delete('/log/' + put_response['log_id'])
 
-        # Test the PUT method using a subscriber ID.
-        email = {**self.message, **{"subscriber_id": subscriber_id}}
+        # Test the PUT method using a subscriber ID, and an unknown ID.
+        email = {**self.message, **{
+            "subscriber_id": [subscriber_id, 'FAKESUBSCRIBERID']
+        }}
         put_response = self.app.put('/email', data=email)
         put_response = json.loads(put_response.data.decode('UTF-8'))
         self.assertEquals(put_response['ResponseMetadata'][
                           'HTTPStatusCode'], 200)
+        self.assertEquals(put_response['unknown_subscriber_ids'],
+                          ['FAKESUBSCRIBERID'])
 
         # Check that the message has been logged properly.
+        logwriter.flush()
         log_response = self.log.get_item(
             Key={
                 'id': put_response['log_id']
             }
         )
         self.assertEquals(
-            log_response['Item']['destination'][0], self.subscriber['email']
+            log_response['Item']['destination'], [self.subscriber['email']]
         )
 
         # Delete the user
@@ -361,6 +1035,158 @@ class MeerkatHermesTestCase(unittest.TestCase):
         # Delete the message from the log
         self.app.delete('/log/' + put_response['log_id'])
 
+        # Emailing only unknown subscribers fails.
+        email = {**self.message, **{"subscriber_id": 'FAKESUBSCRIBERID'}}
+        put_response = self.app.put('/email', data=email)
+        self.assertEquals(put_response.status_code, 400)
+
+    def test_export_resource(self):
+        """
+        Test the Export resource streams the subscribers as CSV, and the
+        message log between two dates as NDJSON.
+        """
+        subscriber_ids = [
+            util.subscribe(**dict(self.subscriber, sms=str(i)))
+            ['subscriber_id'] for i in range(3)
+        ]
+        get_response = self.app.get('/export/subscribers?format=csv')
+        self.assertEqual(get_response.status_code, 200)
+        self.assertEqual(get_response.mimetype, 'text/csv')
+        rows = list(csv.DictReader(
+            io.StringIO(get_response.data.decode('UTF-8'))
+        ))
+        self.assertEqual(list(rows[0]), export.COLUMNS['subscribers'])
+        rows = {row['id']: row for row in rows}
+        self.assertTrue(set(subscriber_ids) <= set(rows))
+        self.assertEqual(rows[subscriber_ids[2]]['sms'], '2')
+        self.assertEqual(rows[subscriber_ids[2]]['topics'],
+                         ' '.join(self.subscriber['topics']))
+
+        # Only the log messages between the dates are exported.
+        with self.log.batch_writer() as batch:
+            for day in ['01', '15', '30']:
+                batch.put_item(Item=dict(
+                    util.time_index(datetime(2017, 6, int(day), 12)),
+                    id='exportID' + day,
+                    message=self.message['message'],
+                    delivery_count=1
+                ))
+        get_response = self.app.get(
+            '/export/log?start=2017-06-02&end=2017-06-30&segments=1'
+            '&columns=message,delivery_count'
+        )
+        self.assertEqual(get_response.mimetype, 'application/x-ndjson')
+        lines = get_response.data.decode('UTF-8').splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [{
+            'id': 'exportID15',
+            'message': self.message['message'],
+            'delivery_count': 1
+        }])
+
+        # Unknown tables, formats and dates are rejected.
+        for url in ['/export/other', '/export/log?format=xml',
+                    '/export/log?start=June', '/export/subscribers?end=2017',
+                    '/export/log?end=2017-06-30']:
+            self.assertEqual(self.app.get(url).status_code, 400)
+
+        for day in ['01', '15', '30']:
+            self.log.delete_item(Key={'id': 'exportID' + day})
+        for subscriber_id in subscriber_ids:
+            util.delete_subscriber(subscriber_id)
+
+    def test_log_resource_list(self):
+        """
+        Test the Log resource lists the messages logged in a time range,
+        across days and pages, using the log's time index.
+        """
+        times = [datetime(2017, 6, day, hour) for day, hour in
+                 [(1, 9), (2, 9), (3, 18), (4, 12), (8, 0)]]
+        ids = ['listID{}'.format(i) for i in range(len(times))]
+        with self.log.batch_writer() as batch:
+            for i, (log_id, when) in enumerate(zip(ids, times)):
+                batch.put_item(Item=dict(
+                    util.time_index(when),
+                    id=log_id,
+                    medium=['email', 'sms'] if i % 2 else ['email'],
+                    topics=['Test1']
+                ))
+
+        # Pages of the range, newest first, with the end excluded.
+        url = '/log?from=2017-06-02&to=2017-06-08&limit=2'
+        pages = []
+        while url:
+            get_response = self.app.get(url)
+            self.assertEqual(get_response.status_code, 200)
+            data = json.loads(get_response.data.decode('UTF-8'))
+            pages.append([item['id'] for item in data['Items']])
+            url = None
+            if 'NextToken' in data:
+                url = '/log?from=2017-06-02&to=2017-06-08&limit=2&token=' + \
+                    data['NextToken']
+        self.assertEqual(pages[0], [ids[3], ids[2]])
+        self.assertEqual(sum(pages, []), [ids[3], ids[2], ids[1]])
+
+        # Filtered by medium and topic.
+        get_response = self.app.get(
+            '/log?from=2017-06-01&to=2017-06-09&medium=sms&topic=Test1'
+        )
+        data = json.loads(get_response.data.decode('UTF-8'))
+        self.assertEqual([item['id'] for item in data['Items']],
+                         [ids[3], ids[1]])
+
+        # Topics only match whole topic names, also in the topics string
+        # logged by publish().
+        with self.log.batch_writer() as batch:
+            for log_id, topics in [('listIDstr', ['Test2', 'Test1']),
+                                   ('listIDother', ['Test10', 'NotTest1'])]:
+                batch.put_item(Item=dict(
+                    util.time_index(datetime(2017, 6, 5)),
+                    id=log_id,
+                    topics='Published to: ' + str(topics)
+                ))
+        get_response = self.app.get(
+            '/log?from=2017-06-01&to=2017-06-09&topic=Test1'
+        )
+        data = json.loads(get_response.data.decode('UTF-8'))
+        self.assertEqual([item['id'] for item in data['Items']],
+                         [ids[4], 'listIDstr'] + ids[3::-1])
+        ids += ['listIDstr', 'listIDother']
+
+        # New log entries are indexed by the time they are logged.
+        util.log_message('listIDnow', {'medium': ['email']})
+        logwriter.flush()
+        get_response = self.app.get('/log')
+        data = json.loads(get_response.data.decode('UTF-8'))
+        self.assertEqual(data['Items'][0]['id'], 'listIDnow')
+
+        for url in ['/log?from=June', '/log?from=2017-06-02&to=2017-06-01',
+                    '/log?from=2010-01-01&to=2017-06-01', '/log?token=bad']:
+            self.assertEqual(self.app.get(url).status_code, 400)
+
+        # Well formed tokens of the wrong shape are rejected too.
+        for token in ['day', [], {'key': {}}, {'day': '2017-06-02', 'key': 1},
+                      {'day': '2017-06-02', 'key': {'id': 'x'}}]:
+            get_response = self.app.get(
+                '/log?from=2017-06-02&to=2017-06-08&token=' +
+                encode_token(token)
+            )
+            self.assertEqual(get_response.status_code, 400)
+            get_response = self.app.get(
+                '/log/' + ids[0] + '?token=' + encode_token(token)
+            )
+            self.assertEqual(get_response.status_code, 400)
+
+        # The whole log can't be deleted.
+        delete_response = self.app.delete('/log')
+        self.assertEqual(delete_response.status_code, 405)
+        self.assertIn('message', json.loads(
+            delete_response.data.decode('UTF-8')
+        ))
+        self.assertIsNotNone(util.get_log(ids[0]))
+
+        for log_id in ids + ['listIDnow']:
+            self.log.delete_item(Key={'id': log_id})
+
     def test_log_resource(self):
         """Test the Log resource GET and Delete methods."""
 
@@ -392,7 +1218,7 @@ class MeerkatHermesTestCase(unittest.TestCase):
             200
         )
 
-    @mock.patch('meerkat_hermes.util.boto3.client')
+    @mock.patch('meerkat_hermes.clients.client')
     def test_sms_resource(self, sns_mock):
         """
         Test the SMS resource PUT method, using the fake response returned
@@ -447,6 +1273,7 @@ class MeerkatHermesTestCase(unittest.TestCase):
         )
 
         # Check that the message has been logged properly.
+        logwriter.flush()
         log_response = self.log.get_item(
             Key={
                 'id': put_response['log_id']
@@ -457,12 +1284,13 @@ class MeerkatHermesTestCase(unittest.TestCase):
         # Delete the message from the log
         self.app.delete('/log/' + put_response['log_id'])
 
-    @mock.patch('meerkat_hermes.util.requests.post')
-    def test_gcm_resource(self, request_mock):
+    @mock.patch('meerkat_hermes.clients.http')
+    def test_gcm_resource(self, http_mock):
         """
         Test the GCM resource PUT method, using the fake response returned
         by util.send_gcm().
         """
+        request_mock = http_mock.return_value.post
 
         gcm = {
             "message": self.message['message'],
@@ -504,6 +1332,7 @@ class MeerkatHermesTestCase(unittest.TestCase):
         self.assertEquals(put_response['success'], 1)
 
         # Check that the message has been logged properly.
+        logwriter.flush()
         log_response = self.log.get_item(
             Key={
                 'id': put_response['log_id']
@@ -515,19 +1344,115 @@ class MeerkatHermesTestCase(unittest.TestCase):
         # Delete the message from the log
         self.app.delete('/log/' + put_response['log_id'])
 
-    @mock.patch('meerkat_hermes.util.boto3.client')
+    @mock.patch('meerkat_hermes.clients.http')
+    def test_gcm_batch_resource(self, http_mock):
+        """
+        Test the GcmBatch resource PUT method sends multicast requests, maps
+        the results back to each token and retries unavailable tokens and
+        failed requests within its budget.
+        """
+        attempts = {}
+
+        def post(url, data, headers):
+            # Fake GCM multicast results for each registration token.
+            results = []
+            for token in json.loads(data)['registration_ids']:
+                attempts[token] = attempts.get(token, 0) + 1
+                if token == 'bad':
+                    results.append({'error': 'NotRegistered'})
+                elif token == 'flaky' and attempts[token] == 1:
+                    results.append({'error': 'Unavailable'})
+                elif token == 'old':
+                    results.append({'message_id': '0:' + token,
+                                    'registration_id': 'new'})
+                else:
+                    results.append({'message_id': '0:' + token})
+            response = requests.Response()
+            response.status_code = 200
+            response._content = json.dumps({'results': results}).encode()
+            return response
+
+        http_mock.return_value.post.side_effect = post
+        config = {'GCM_BATCH_SIZE': 2, 'RETRY_BASE_DELAY': 0.01,
+                  'GCM_MOCK_RESPONSE_ONLY': 0}
+        with mock.patch.dict(app.config, config):
+            put_response = self.app.put('/gcm/batch', data={
+                'message': self.message['message'],
+                'destination': ['a', 'bad', 'old', 'flaky', 'a']
+            })
+        self.assertEqual(put_response.status_code, 200)
+        put_response = json.loads(put_response.data.decode('UTF-8'))
+
+        # Two multicast requests, and a third for the unavailable token.
+        self.assertEqual(http_mock.return_value.post.call_count, 3)
+        self.assertEqual(put_response['success'], 3)
+        self.assertEqual(put_response['failure'], 1)
+        self.assertEqual(put_response['results']['flaky'],
+                         {'message_id': '0:flaky'})
+        self.assertEqual(put_response['invalid_tokens'], ['bad'])
+        self.assertEqual(put_response['canonical_ids'], {'old': 'new'})
+
+        # The batch is logged once.
+        logwriter.flush()
+        log = self.log.get_item(Key={'id': put_response['log_id']})['Item']
+        self.assertEqual(log['destination_count'], 4)
+        self.assertEqual(log['invalid_count'], 1)
+        self.app.delete('/log/' + put_response['log_id'])
+
+        # A response GCM can't have sent fails the whole batch.
+        http_mock.return_value.post.side_effect = None
+        http_mock.return_value.post.return_value = mock.Mock(
+            status_code=200,
+            headers={},
+            json=mock.Mock(side_effect=ValueError('No JSON'))
+        )
+        put_response = self.app.put('/gcm/batch', data={
+            'message': self.message['message'],
+            'destination': ['a', 'b']
+        })
+        self.assertEqual(put_response.status_code, 200)
+        put_response = json.loads(put_response.data.decode('UTF-8'))
+        self.assertEqual(put_response['failure'], 2)
+        self.assertIn('No JSON', put_response['results']['a']['error'])
+        self.app.delete('/log/' + put_response['log_id'])
+
+        # Failed requests are retried within the batch's retry budget.
+        http_mock.return_value.post.return_value = mock.Mock(
+            status_code=503,
+            headers={}
+        )
+        for budget, calls in [(10, 1 + app.config['RETRY_ATTEMPTS']),
+                              (0, 1)]:
+            http_mock.return_value.post.reset_mock()
+            config = {'GCM_BATCH_RETRY_BUDGET': budget}
+            with mock.patch.dict(app.config, config), \
+                    mock.patch('time.sleep') as sleep_mock:
+                put_response = self.app.put('/gcm/batch', data={
+                    'message': self.message['message'],
+                    'destination': ['a', 'b']
+                })
+            self.assertEqual(http_mock.return_value.post.call_count, calls)
+            self.assertEqual(sleep_mock.call_count, calls - 1)
+            put_response = json.loads(put_response.data.decode('UTF-8'))
+            self.assertEqual(put_response['results']['a'],
+                             {'error': 'HTTP 503'})
+            self.app.delete('/log/' + put_response['log_id'])
+
+        # Topics can't be sent to in a batch.
+        put_response = self.app.put('/gcm/batch', data={
+            'message': self.message['message'],
+            'destination': ['a', '/topics/demo']
+        })
+        self.assertEqual(put_response.status_code, 403)
+
+    @mock.patch('meerkat_hermes.clients.client')
     def test_publish_resource(self, boto_mock):
         """Test the Publish resource PUT method."""
 
-        def clones(object, times=None):
-            # Generator to yield clones of an object, infitnely or <n times.
-            # Used to generate nexmo response for the mock_sms_response
-            if times is None:
-                while True:
-                    yield copy.copy(object)
-            else:
-                for i in range(times):
-                    yield copy.copy(object)
+        def clones(object):
+            # Side effect returning a fresh clone of an object for each call.
+            # Safe to call from the concurrent publish worker threads.
+            return lambda *args, **kwargs: copy.copy(object)
 
         # Createfour test subscribers, each with subscriptions to a different
         # list of topics.
@@ -590,6 +1515,22 @@ class MeerkatHermesTestCase(unittest.TestCase):
             "log_id": "G891694c3d4364f89bb124e31bfb15b58",
         })
 
+        def bulk_response(**kwargs):
+            # One SES status for each destination of a bulk send.
+            return {
+                "Status": [{
+                    "Status": "Success",
+                    "MessageId": "0102015e7afbfec3-cf8df94b-81bc-4c9b5966a4"
+                } for destination in kwargs['Destinations']],
+                "ResponseMetadata": {
+                    "RequestId": "270fa909-9876-11e7-a0db-e3a14f067914",
+                    "HTTPStatusCode": 200,
+                    "RetryAttempts": 0
+                }
+            }
+        bulk_mock = boto_mock.return_value.send_bulk_templated_email
+        bulk_mock.side_effect = bulk_response
+
         # Create the message.
         message = self.message.copy()
         message['html-message'] = message.pop('html')
@@ -650,6 +1591,18 @@ class MeerkatHermesTestCase(unittest.TestCase):
         self.assertEquals(len(put_response), 3)
         self.assertTrue(boto_mock.return_value.publish.call_count == 1)
 
+        # The two emails are sent together in one SES bulk send.
+        self.assertEqual(bulk_mock.call_count, 1)
+        self.assertEqual(
+            len(bulk_mock.call_args[1]['Destinations']), 2
+        )
+        emails = [r for r in put_response if r['type'] == 'email']
+        self.assertEqual(len(emails), 2)
+        for response in emails:
+            self.assertEqual(response['Status'], 'Success')
+            self.assertEqual(response['Destination'],
+                             [self.subscriber['email']])
+
         # Publish the test message to both topics Test1 and Test2.
         message['topics'] = ['Test1', 'Test2']
         message['id'] = "testID4"
@@ -670,6 +1623,25 @@ class MeerkatHermesTestCase(unittest.TestCase):
         self.assertEquals(len(put_response), 5)
         self.assertTrue(boto_mock.return_value.publish.call_count == 3)
 
+        # Page through the message's delivery records, two at a time.
+        deliveries = []
+        token = ''
+        while token is not None:
+            get_response = self.app.get(
+                '/log/{}?limit=2&token={}'.format(message['id'], token)
+            )
+            get_response = json.loads(get_response.data.decode('UTF-8'))
+            self.assertLessEqual(len(get_response['Deliveries']), 2)
+            deliveries += get_response['Deliveries']
+            token = get_response.get('NextToken')
+        self.assertEqual(get_response['Item']['delivery_count'], 5)
+        self.assertEqual(len(set(d['delivery_id'] for d in deliveries)), 5)
+        self.assertEqual(sorted(d['medium'] for d in deliveries),
+                         sorted(r['type'] for r in put_response))
+        for delivery in deliveries:
+            self.assertEqual(delivery['status'], 'sent')
+            self.assertIn(delivery['subscriber_id'], subscriber_ids)
+
         # Delete the logs.
         for message_id in message_ids:
             self.app.delete('/log/' + message_id)
@@ -693,6 +1665,236 @@ class MeerkatHermesTestCase(unittest.TestCase):
         self.assertTrue(put_response_json.get('message', False))
         app.config['PUBLISH_RATE_LIMIT'] = 20
 
+    @mock.patch('meerkat_hermes.clients.client')
+    def test_publish_async(self, boto_mock):
+        """
+        Test the Publish resource PUT method can queue a message, and the
+        PublishStatus resource GET method reports on its progress.
+        """
+        boto_mock.return_value.send_email.return_value = {
+            "MessageId": "0102015e7afbfec3-cf8df94b-81bc-4c9b5966a4-000000",
+            "ResponseMetadata": {"HTTPStatusCode": 200, "RetryAttempts": 0}
+        }
+
+        # Create a verified test subscriber.
+        subscriber = {**self.subscriber, 'topics': ['Test1'],
+                      'verified': True}
+        subscribe_response = self.app.put('/subscribe', data=subscriber)
+        subscriber_id = json.loads(
+            subscribe_response.data.decode('UTF-8')
+        )['subscriber_id']
+
+        # Queue the message, nothing should be sent yet.
+        message = {**self.message, 'topics': ['Test1'], 'async': 'True',
+                   'id': 'testAsyncID' + subscriber_id}
+        put_response = self.app.put('/publish', data=message)
+        self.assertEqual(put_response.status_code, 202)
+        get_response = self.app.get('/publish/' + message['id'] + '/status')
+        get_response = json.loads(get_response.data.decode('UTF-8'))
+        self.assertEqual(get_response['state'], 'queued')
+        self.assertFalse(boto_mock.return_value.send_email.called)
+
+        # Run the worker until the queue is empty.
+        jobs.work(once=True)
+        get_response = self.app.get('/publish/' + message['id'] + '/status')
+        get_response = json.loads(get_response.data.decode('UTF-8'))
+        self.assertEqual(get_response['state'], 'done')
+        self.assertEqual(get_response['progress'],
+                         {'email': {'total': 1, 'sent': 1}})
+        self.assertEqual(boto_mock.return_value.send_email.call_count, 1)
+
+        # Clean up.
+        self.app.delete('/log/' + message['id'])
+        self.app.delete('/subscribe/' + subscriber_id)
+        os.remove(app.config['PUBLISH_QUEUE'])
+
+    @mock.patch('meerkat_hermes.clients.client')
+    def test_publish_resume(self, boto_mock):
+        """
+        Test the Publish resource PUT method resumes a message whose publish
+        failed or was abandoned, but doesn't resend a message that was sent or
+        is being sent.
+        """
+        send_email = boto_mock.return_value.send_email
+
+        # Create a verified test subscriber.
+        subscriber = {**self.subscriber, 'topics': ['Test1'],
+                      'verified': True}
+        subscribe_response = self.app.put('/subscribe', data=subscriber)
+        subscriber_id = json.loads(
+            subscribe_response.data.decode('UTF-8')
+        )['subscriber_id']
+        message = {**self.message, 'topics': ['Test1'], 'async': 'False',
+                   'id': 'testResumeID' + subscriber_id}
+
+        # A failed publish is logged as failed.
+        error = Exception('Publish worker died')
+        with mock.patch.object(util, 'dispatch', side_effect=error):
+            with self.assertRaises(Exception):
+                self.app.put('/publish', data=message)
+        self.assertFalse(send_email.called)
+        self.assertEqual(util.get_log(message['id'])['state'], 'failed')
+        get_response = self.app.get('/publish/' + message['id'] + '/status')
+        get_response = json.loads(get_response.data.decode('UTF-8'))
+        self.assertEqual(get_response['state'], 'failed')
+
+        # Retrying the request resumes the message.
+        send_email.side_effect = lambda *args, **kwargs: {
+            "MessageId": "0102015e7afbfec3-cf8df94b-81bc-4c9b5966a4-000000",
+            "ResponseMetadata": {"HTTPStatusCode": 200, "RetryAttempts": 0}
+        }
+        put_response = self.app.put('/publish', data=message)
+        self.assertEqual(put_response.status_code, 200)
+        self.assertEqual(send_email.call_count, 1)
+        log = util.get_log(message['id'])
+        self.assertEqual(log['state'], 'done')
+        self.assertEqual(log['delivery_count'], 1)
+
+        # Once sent, the message isn't sent again.
+        put_response = self.app.put('/publish', data=message)
+        self.assertEqual(put_response.status_code, 400)
+        self.assertEqual(send_email.call_count, 1)
+
+        # The old claim can no longer change the message's state.
+        with self.assertRaises(util.ClaimLost):
+            util.set_state(message['id'], 'stale', 'failed')
+        self.app.delete('/log/' + message['id'])
+
+        # A message claimed by another request isn't sent, unless that
+        # request's claim has expired.
+        util.claim_id(message['id'], {'message': message['message']})
+        put_response = self.app.put('/publish', data=message)
+        self.assertEqual(put_response.status_code, 202)
+        put_response = json.loads(put_response.data.decode('UTF-8'))
+        self.assertEqual(put_response['state'], 'claimed')
+        self.assertEqual(send_email.call_count, 1)
+        with mock.patch.dict(app.config, {'PUBLISH_CLAIM_LEASE': -1}):
+            put_response = self.app.put('/publish', data=message)
+        self.assertEqual(put_response.status_code, 200)
+        self.assertEqual(send_email.call_count, 2)
+        self.assertEqual(util.get_log(message['id'])['state'], 'done')
+        self.app.delete('/log/' + message['id'])
+
+        # A request that loses the claim to a publish that has since failed
+        # resumes it, rather than reporting it as failed.
+        claim = util.claim_id(message['id'], {'message': message['message']})
+        util.set_state(message['id'], claim, 'failed', {'error': 'Died'})
+        with mock.patch.object(util, 'id_valid', return_value=True):
+            put_response = self.app.put('/publish', data=message)
+        self.assertEqual(put_response.status_code, 200)
+        self.assertEqual(send_email.call_count, 3)
+        self.assertEqual(util.get_log(message['id'])['state'], 'done')
+
+        # Clean up.
+        self.app.delete('/log/' + message['id'])
+        self.app.delete('/subscribe/' + subscriber_id)
+
+    @mock.patch('meerkat_hermes.clients.client')
+    def test_publish_checkpoint(self, boto_mock):
+        """
+        Test a publish that stops part way through is resumed from the
+        subscribers it hadn't yet sent the message to.
+        """
+        send_email = boto_mock.return_value.send_email
+        send_email.side_effect = lambda *args, **kwargs: {
+            "MessageId": "0102015e7afbfec3-cf8df94b-81bc-4c9b5966a4-000000",
+            "ResponseMetadata": {"HTTPStatusCode": 200, "RetryAttempts": 0}
+        }
+
+        # Create two verified test subscribers.
+        subscriber_ids = []
+        for i in range(2):
+            subscriber = {**self.subscriber, 'topics': ['Test1'],
+                          'verified': True}
+            subscribe_response = self.app.put('/subscribe', data=subscriber)
+            subscriber_ids.append(json.loads(
+                subscribe_response.data.decode('UTF-8')
+            )['subscriber_id'])
+        message = {**self.message, 'topics': ['Test1'], 'async': 'False',
+                   'id': 'testCheckpointID' + subscriber_ids[0]}
+
+        # Send the emails one at a time, failing on the second.
+        publish_email = util._publish_email
+
+        def fail_second(*args):
+            if send_email.call_count:
+                raise Exception('Worker recycled')
+            return publish_email(*args)
+
+        # The process dies before its log writer has written anything, so
+        # only the deliveries written by the publish itself survive.
+        config = {'SES_BULK_EMAIL': False,
+                  'PUBLISH_WORKERS': {'email': 1}}
+        with mock.patch.dict(app.config, config):
+            with mock.patch.object(util, '_publish_email', fail_second), \
+                    mock.patch.object(logwriter, 'put_delivery'), \
+                    mock.patch.object(util, 'sent_deliveries') as sent_mock:
+                with self.assertRaises(Exception):
+                    self.app.put('/publish', data=message)
+
+            # A new message ID has no deliveries to look up.
+            self.assertFalse(sent_mock.called)
+            self.assertEqual(send_email.call_count, 1)
+            sent = util.sent_deliveries(message['id'])
+            self.assertEqual(len(sent), 1)
+
+            # The retried request only sends to the other subscriber.
+            put_response = self.app.put('/publish', data=message)
+            self.assertEqual(put_response.status_code, 200)
+            put_response = json.loads(put_response.data.decode('UTF-8'))
+            self.assertEqual(len(put_response), 1)
+            self.assertEqual(send_email.call_count, 2)
+
+        log = util.get_log(message['id'])
+        self.assertEqual(log['state'], 'done')
+        self.assertEqual(log['delivery_count'], 2)
+        self.assertEqual(len(util.sent_deliveries(message['id'])), 2)
+
+        # Clean up.
+        self.app.delete('/log/' + message['id'])
+        for subscriber_id in subscriber_ids:
+            self.app.delete('/subscribe/' + subscriber_id)
+
+    def test_publish_resume_coalesced(self):
+        """
+        Test slack messages queued for a digest don't count as sent when
+        resuming a publish, and that a claimed publish posts its own slack
+        messages so that resuming it doesn't post them again.
+        """
+        subscriber = dict(self.subscriber, topics=['Test1'], verified=True,
+                          slack='@testy')
+        subscriber_id = util.subscribe(**subscriber)['subscriber_id']
+        message = dict(self.message, topics=['Test1'], medium=['slack'],
+                       coalesce=True, id='testCoalesceID' + subscriber_id)
+        posted = {'code': 200, 'message': 'ok'}
+
+        with mock.patch.object(coalesce, 'add') as add_mock, \
+                mock.patch.object(util, '_publish_slack',
+                                  return_value=posted) as slack_mock:
+            # An unclaimed message is queued for a digest.
+            responses = util.publish(dict(message))
+            self.assertEqual(responses[0]['code'], 202)
+            logwriter.flush()
+            self.assertEqual(util.get_deliveries(message['id'])[0][0]
+                             ['status'], 'queued')
+            self.assertEqual(util.sent_deliveries(message['id']), set())
+            self.app.delete('/log/' + message['id'])
+
+            # A claimed message posts straight away.
+            message['claim'] = util.claim_id(message['id'], {})
+            responses = util.publish(dict(message))
+            self.assertEqual(responses[0]['code'], 200)
+            self.assertEqual(util.sent_deliveries(message['id']),
+                             {util.delivery_id('slack', subscriber_id)})
+
+            # The resumed publish has nothing left to send.
+            self.assertEqual(util.publish(dict(message, resume=True)), [])
+            self.assertEqual(add_mock.call_count, 1)
+            self.assertEqual(slack_mock.call_count, 1)
+
+        self.app.delete('/log/' + message['id'])
+        util.delete_subscriber(subscriber_id)
+
 # TODO Test Error and Notify Resources
 
 if __name__ == '__main__':
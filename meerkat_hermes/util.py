@@ -1,11 +1,37 @@
-from meerkat_hermes import app, logger
+from meerkat_hermes import app, logger, clients, cache, dedup, logwriter
+from meerkat_hermes import ratelimit, retry, pacing, coalesce
 from flask import Response
+from boto3.dynamodb.conditions import Key, Attr
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
 import uuid
-import boto3
 import time
 import json
-import requests
+import threading
+import heapq
+import queue
+import re
+import itertools
+
+# Matches a mail merge field e.g. <<first_name>>.
+MAIL_MERGE_FIELD = re.compile(r'<<([^<>]+?)>>')
+
+# The subscriber details that can be changed in place, and those of them
+# that can't be removed.
+SUBSCRIBER_FIELDS = ['first_name', 'last_name', 'email', 'country', 'sms',
+                     'slack']
+SUBSCRIBER_REQUIRED = ['first_name', 'last_name', 'email', 'country']
+
+# The sortable UTC time at which a message was logged, and its day, which
+# index the log by time, see query_log().
+LOG_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+LOG_DAY_FORMAT = '%Y-%m-%d'
+
+# GCM multicast result errors for a token that will never work again, and for
+# a token that can be sent to again later.
+GCM_INVALID_ERRORS = ['NotRegistered', 'InvalidRegistration']
+GCM_TRANSIENT_ERRORS = ['Unavailable', 'InternalServerError']
 
 
 def slack(channel, message, subject=''):
@@ -19,7 +45,9 @@ def slack(channel, message, subject=''):
         message (str): Required. The message to post to slack.
         subject (str): Optional. Placed in bold and seperated by a pipe.
 
-    return "sent"
+    Returns:
+        The slack response, with the number of retries it took as its
+        'retries' attribute.
     """
 
     # Assemble the message text string
@@ -29,39 +57,34 @@ def slack(channel, message, subject=''):
 
     # Send the slack message
     message = {'text': text, 'channel': channel, 'username': 'Meerkat'}
-    url = ('https://hooks.slack.com/services/T050E3XPP/'
-           'B0G7UKUCA/EtXIFB3CRGyey2L7x5WbT32B')
     headers = {'Content-Type': 'application/json'}
-    r = requests.post(url, data=json.dumps(message), headers=headers)
+    r, retries = retry.call(
+        'slack',
+        pacing.paced('slack', clients.http().post),
+        app.config['SLACK_WEBHOOK_URL'],
+        data=json.dumps(message),
+        headers=headers
+    )
+    r.retries = retries
 
     # Return the slack response
     return r
 
 
-def subscribe(first_name, last_name, email,
-              country, topics, sms="", slack="", verified=False):
+def new_subscriber(first_name, last_name, email,
+                   country, topics, sms="", slack="", verified=False):
     """
-    Subscribes a user.  Factored out of the resources so it can be called
-    easily from python code.
+    Creates the record for a new subscriber, assigning them a unique id. The
+    record isn't written to the database.
 
     Args:
-        first_name (str): Required. The subscriber's first name.
-        last_name (str): Required. The subscriber's last name.
-        email (str): Required. The subscriber's email address.
-        country (str): Required. The country that the subscriber has signed up to.
-        sms (str): The subscribers phone number for sms.
-        slack (str): The slack username or channel.
-        topics ([str]): Required. The ID's for the topics to which the subscriber \
-            wishes to subscribe.
-        verified (bool): Are their contact details verified? Defaults to False.
-    """
+        See subscribe().
 
-    # Assign the new subscriber a unique id.
-    subscriber_id = uuid.uuid4().hex
-
-    # Create the subscriber object.
+    Returns:
+        The subscriber record.
+    """
     subscriber = {
-        'id': subscriber_id,
+        'id': uuid.uuid4().hex,
         'first_name': first_name,
         'last_name': last_name,
         'country': country,
@@ -76,20 +99,352 @@ def subscribe(first_name, last_name, email,
         subscriber['slack'] = slack
     if verified:
         subscriber['verified'] = verified
+    return subscriber
+
+
+def subscribe(first_name, last_name, email,
+              country, topics, sms="", slack="", verified=False):
+    """
+    Subscribes a user.  Factored out of the resources so it can be called
+    easily from python code.
+
+    Args:
+        first_name (str): Required. The subscriber's first name.
+        last_name (str): Required. The subscriber's last name.
+        email (str): Required. The subscriber's email address.
+        country (str): Required. The country that the subscriber has signed up to.
+        sms (str): The subscribers phone number for sms.
+        slack (str): The slack username or channel.
+        topics ([str]): Required. The ID's for the topics to which the subscriber \
+            wishes to subscribe.
+        verified (bool): Are their contact details verified? Defaults to False.
+    """
+
+    subscriber = new_subscriber(first_name, last_name, email, country,
+                                topics, sms, slack, verified)
+    subscriber_id = subscriber['id']
 
     # Write the subscriber to the database.
-    db = boto3.resource(
-        'dynamodb',
-        endpoint_url=app.config['DB_URL'],
-        region_name='eu-west-1'
-    )
-    subscribers = db.Table(app.config['SUBSCRIBERS'])
+    subscribers = clients.table(app.config['SUBSCRIBERS'])
     response = subscribers.put_item(Item=subscriber)
     response['subscriber_id'] = subscriber_id
 
+    # Only verified subscribers have active subscriptions.
+    if subscriber['verified']:
+        create_subscriptions(subscriber_id, topics)
+
     return response
 
 
+def create_subscriptions(subscriber_id, topics):
+    """
+    Adds a subscriber to the topic index, so that they receive messages
+    published to the given topics. Each subscription maps a single topic ID to
+    a single subscriber ID.
+
+    Args:
+        subscriber_id (str): Required. The subscriber's unique id.
+        topics ([str]): Required. The topics the subscriber is subscribed to.
+    """
+    subscriptions = clients.table(app.config['SUBSCRIPTIONS'])
+    with subscriptions.batch_writer(
+        overwrite_by_pkeys=['topicID', 'subscriberID']
+    ) as batch:
+        for topic in topics:
+            batch.put_item(Item={
+                'topicID': topic,
+                'subscriberID': subscriber_id
+            })
+    cache.invalidate('topics', topics)
+
+
+def delete_subscriptions(subscriber_id, topics):
+    """
+    Removes a subscriber from the topic index for the given topics.
+
+    Args:
+        subscriber_id (str): Required. The subscriber's unique id.
+        topics ([str]): Required. The topics to remove the subscriber from.
+    """
+    subscriptions = clients.table(app.config['SUBSCRIPTIONS'])
+    with subscriptions.batch_writer(
+        overwrite_by_pkeys=['topicID', 'subscriberID']
+    ) as batch:
+        for topic in topics:
+            batch.delete_item(Key={
+                'topicID': topic,
+                'subscriberID': subscriber_id
+            })
+    cache.invalidate('topics', topics)
+
+
+def get_topic_subscribers(topic):
+    """
+    Queries the topic index for the subscribers to a single topic. The result
+    is cached until the topic's subscriptions change.
+
+    Args:
+        topic (str): Required. The topic ID.
+
+    Returns:
+        A list of subscriber IDs, in index order.
+    """
+    subscriber_ids = cache.get('topics', topic)
+    if subscriber_ids is not None:
+        return list(subscriber_ids)
+
+    subscriptions = clients.table(app.config['SUBSCRIPTIONS'])
+    kwargs = {'KeyConditionExpression': Key('topicID').eq(topic)}
+    subscriber_ids = []
+    while True:
+        response = subscriptions.query(**kwargs)
+        subscriber_ids += [i['subscriberID'] for i in response['Items']]
+        if 'LastEvaluatedKey' not in response:
+            cache.set('topics', topic, tuple(subscriber_ids))
+            return subscriber_ids
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def projection_kwargs(attributes):
+    """
+    Builds the DynamoDB arguments to load only some attributes of each
+    subscriber. The subscriber's id is always loaded.
+
+    Args:
+        attributes ([str]): The attribute names to load, or None to load
+            whole records.
+
+    Returns:
+        A dict of ProjectionExpression and ExpressionAttributeNames
+        arguments, empty if whole records should be loaded.
+    """
+    if not attributes:
+        return {}
+    names = list(dict.fromkeys(['id'] + list(attributes)))
+    return {
+        'ProjectionExpression': ', '.join(
+            '#a{}'.format(i) for i in range(len(names))
+        ),
+        'ExpressionAttributeNames': {
+            '#a{}'.format(i): name for i, name in enumerate(names)
+        }
+    }
+
+
+def get_subscribers(subscriber_ids, attributes=None):
+    """
+    Loads many subscriber records at once. Cached records are used where
+    possible, and the rest are loaded using BatchGetItem, 100 keys per
+    request, retrying any keys that DynamoDB leaves unprocessed.
+
+    Args:
+        subscriber_ids ([str]): Required. The subscriber IDs to load.
+        attributes ([str]): Only load these attributes of the subscribers
+            that aren't cached. Defaults to loading whole records.
+
+    Returns:
+        A dict of subscriber records indexed by subscriber ID. Unknown IDs
+        are left out. The records are shared with the cache, so must not be
+        modified, and may include more than the requested attributes.
+    """
+    table_name = app.config['SUBSCRIBERS']
+    subscribers = {}
+    missing = []
+    for subscriber_id in dict.fromkeys(subscriber_ids):
+        subscriber = cache.get('subscribers', subscriber_id)
+        if subscriber is not None:
+            subscribers[subscriber_id] = subscriber
+        else:
+            missing.append(subscriber_id)
+
+    # Only whole records are cached.
+    projection = projection_kwargs(attributes)
+
+    for i in range(0, len(missing), 100):
+        request = {table_name: dict(
+            projection,
+            Keys=[{'id': s} for s in missing[i:i+100]]
+        )}
+        while request:
+            response = clients.dynamodb().batch_get_item(RequestItems=request)
+            for subscriber in response['Responses'].get(table_name, []):
+                subscribers[subscriber['id']] = subscriber
+                if not projection:
+                    cache.set('subscribers', subscriber['id'], subscriber)
+            request = response.get('UnprocessedKeys')
+    return subscribers
+
+
+def get_subscriber(subscriber_id):
+    """
+    Loads a single subscriber record, from the cache if possible.
+
+    Args:
+        subscriber_id (str): Required. The subscriber's unique id.
+
+    Returns:
+        The subscriber record, or None if the subscriber doesn't exist.
+    """
+    return get_subscribers([subscriber_id]).get(subscriber_id)
+
+
+def rebuild_subscriptions():
+    """
+    Rebuilds the topic index from the subscribers table, creating the
+    subscriptions of every verified subscriber. Used to populate the index for
+    subscribers created before it existed.
+
+    Returns:
+        The number of subscribers indexed.
+    """
+    count = 0
+    for subscriber in parallel_scan(
+        app.config['SUBSCRIBERS'],
+        app.config['SCAN_SEGMENTS']
+    ):
+        if subscriber.get('verified'):
+            create_subscriptions(subscriber['id'], subscriber['topics'])
+            count += 1
+    return count
+
+
+def scan(table, **kwargs):
+    """
+    Scans a DynamoDB table, following LastEvaluatedKey so that every page of
+    results is read. Items are yielded lazily, one page at a time.
+
+    Args:
+        table: Required. The boto3 Table resource to scan.
+        kwargs: Any further arguments for the DynamoDB scan, e.g. a \
+            ScanFilter, ProjectionExpression or Segment and TotalSegments.
+
+    Returns:
+        A generator of the scanned items.
+    """
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get('Items', []):
+            yield item
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def query(table, **kwargs):
+    """
+    Queries a DynamoDB table or index, following LastEvaluatedKey so that
+    every page of results is read. Items are yielded lazily, one page at a
+    time.
+
+    Args:
+        table: Required. The boto3 Table resource to query.
+        kwargs: Any further arguments for the DynamoDB query, e.g. the \
+            KeyConditionExpression, IndexName or ProjectionExpression.
+
+    Returns:
+        A generator of the matching items.
+    """
+    while True:
+        response = table.query(**kwargs)
+        for item in response.get('Items', []):
+            yield item
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def country_subscribers(country, attributes=None):
+    """
+    Lazily loads the subscribers signed up to a country, using the country
+    index of the subscribers table, see the SUBSCRIBERS_COUNTRY_INDEX config.
+    Only the subscribers in the country are read.
+
+    Args:
+        country (str): Required. The country.
+        attributes ([str]): Only load these attributes of each subscriber. \
+            Defaults to loading whole records.
+
+    Returns:
+        A generator of subscriber records.
+    """
+    return query(
+        clients.table(app.config['SUBSCRIBERS']),
+        IndexName=app.config['SUBSCRIBERS_COUNTRY_INDEX'],
+        KeyConditionExpression=Key('country').eq(country),
+        **projection_kwargs(attributes)
+    )
+
+
+def parallel_scan(table_name, segments=1, **kwargs):
+    """
+    Scans a DynamoDB table using a DynamoDB parallel scan, with a thread
+    scanning each segment. Pages of items are yielded as they arrive, so only
+    a few pages are held in memory at once.
+
+    Args:
+        table_name (str): Required. The name of the table to scan.
+        segments (int): The number of segments to scan in parallel.
+        kwargs: Any further arguments for the DynamoDB scan.
+
+    Returns:
+        A generator of the scanned items, in no particular order.
+    """
+    if segments <= 1:
+        yield from scan(clients.table(table_name), **kwargs)
+        return
+
+    pages = queue.Queue(maxsize=2 * segments)
+    stop = threading.Event()
+    finished = object()
+
+    def put(page):
+        # Wait for room in the queue, unless the caller has stopped reading.
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def scan_segment(segment):
+        try:
+            table = clients.table(table_name)
+            segment_kwargs = dict(kwargs, Segment=segment,
+                                  TotalSegments=segments)
+            while not stop.is_set():
+                response = table.scan(**segment_kwargs)
+                put(response.get('Items', []))
+                if 'LastEvaluatedKey' not in response:
+                    break
+                segment_kwargs['ExclusiveStartKey'] = \
+                    response['LastEvaluatedKey']
+        except Exception as e:
+            put(e)
+        finally:
+            put(finished)
+
+    for segment in range(segments):
+        threading.Thread(
+            target=scan_segment,
+            args=(segment,),
+            name='hermes-scan-{}'.format(segment),
+            daemon=True
+        ).start()
+
+    try:
+        remaining = segments
+        while remaining:
+            page = pages.get()
+            if page is finished:
+                remaining -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield from page
+    finally:
+        stop.set()
+
+
 def send_email(destination, subject, message, html, sender):
     """
     Sends an email using Amazon SES.
@@ -104,17 +459,20 @@ def send_email(destination, subject, message, html, sender):
             address. Defaults to the config file SENDER value.
 
     Returns:
-        The Amazon SES response. If email fails, returns a response look-a-like
-        object that contains the failiure error message.
+        The Amazon SES response, with the number of retries it took as its
+        ResponseMetadata RetryAttempts. If email fails, returns a response
+        look-a-like object that contains the failiure error message.
     """
 
-    client = boto3.client('ses', region_name='eu-west-1')
+    client = clients.client('ses')
 
     if(not html):
         html = message.replace('', '<br />')
 
     try:
-        response = client.send_email(
+        response, retries = retry.call(
+            'ses',
+            pacing.paced('ses', client.send_email, len(destination)),
             Source=sender,
             Destination={
                 'ToAddresses': destination
@@ -138,8 +496,11 @@ def send_email(destination, subject, message, html, sender):
         )
         response['SesMessageId'] = response.pop('MessageId')
         response['Destination'] = destination
+        response.setdefault('ResponseMetadata', {})['RetryAttempts'] = retries
         return response
 
+    except retry.RetryLater:
+        raise
     except Exception as e:
         msg = "Failed to send email \"{}\" to: {}{}".format(
             subject,
@@ -147,7 +508,164 @@ def send_email(destination, subject, message, html, sender):
             e
         )
         logger.error(msg)
-        return {'ResponseMetadata': {'error': msg, 'HTTPStatusCode': 400}}
+        return {'ResponseMetadata': {
+            'error': msg,
+            'HTTPStatusCode': 400,
+            'RetryAttempts': getattr(e, 'retries', 0)
+        }}
+
+
+def create_email_template(subject, message, html):
+    """
+    Creates a temporary SES template from a mail merge message, so that it can
+    be sent to many subscribers with send_bulk_email(). Each mail merge field
+    <<key>> becomes a template field. The template should be deleted with
+    delete_email_template() once it has been sent.
+
+    Args:
+        subject (str): Required. The email subject, which isn't mail merged.
+        message (MailMerge): Required. The mail merge message.
+        html (MailMerge): Required. The mail merge html version of the \
+            message.
+
+    Returns:
+        A tuple of the template name and the list of mail merge field names,
+        or None if the message can't be written as an SES template.
+    """
+    subject = subject or ''
+    fields = list(dict.fromkeys(message.fields + html.fields))
+
+    # SES templates use handlebars, so the messages musn't contain any
+    # handlebars syntax of their own and the fields must be plain names.
+    chunks = [subject] + message.chunks + html.chunks
+    if any('{{' in chunk or '}}' in chunk for chunk in chunks):
+        return None
+    if not all(field.isidentifier() for field in fields):
+        return None
+    template_fields = {field: '{{{' + field + '}}}' for field in fields}
+
+    name = 'hermes-' + uuid.uuid4().hex
+    try:
+        clients.client('ses').create_template(Template={
+            'TemplateName': name,
+            'SubjectPart': subject,
+            'TextPart': message.render(template_fields),
+            'HtmlPart': html.render(template_fields)
+        })
+    except Exception as e:
+        logger.warning("Failed to create email template: {}".format(e))
+        return None
+    return name, fields
+
+
+def delete_email_template(name):
+    """
+    Deletes a template created by create_email_template().
+
+    Args:
+        name (str): Required. The template name.
+    """
+    try:
+        clients.client('ses').delete_template(TemplateName=name)
+    except Exception as e:
+        logger.warning("Failed to delete email template {}: {}".format(
+            name,
+            e
+        ))
+
+
+def send_bulk_email(template, recipients, sender):
+    """
+    Sends a templated email to many recipients using Amazon SES bulk sending,
+    with one SES call per SES_BULK_SIZE (at most 50) recipients.
+
+    Args:
+        template (tuple): Required. The template name and field names, as \
+            returned by create_email_template().
+        recipients ([tuple]): Required. An (email, values) tuple for each \
+            recipient, where values is a dict of their mail merge values.
+        sender (str): Required. The sender's address. Must be an AWS SES \
+            verified email address.
+
+    Returns:
+        A list with an SES response look-a-like for each recipient, in the
+        same order as the recipients.
+
+    Raises:
+        RetryLater: If a deferred SES call should be retried, see retry.py.
+            Sends in a deferred job should only make one SES call, as the
+            whole job is run again.
+    """
+    client = clients.client('ses')
+    name, fields = template
+    responses = []
+
+    for i in range(0, len(recipients), app.config['SES_BULK_SIZE']):
+        chunk = recipients[i:i + app.config['SES_BULK_SIZE']]
+        destinations = []
+        for email, values in chunk:
+            # Fields the subscriber doesn't have are left as they are.
+            data = {f: values.get(f, '<<' + f + '>>') for f in fields}
+            destinations.append({
+                'Destination': {'ToAddresses': [email]},
+                'ReplacementTemplateData': json.dumps(data)
+            })
+
+        try:
+            response, retries = retry.call(
+                'ses',
+                pacing.paced(
+                    'ses',
+                    client.send_bulk_templated_email,
+                    len(destinations)
+                ),
+                Source=sender,
+                Template=name,
+                DefaultTemplateData='{}',
+                Destinations=destinations
+            )
+        except retry.RetryLater:
+            raise
+        except Exception as e:
+            msg = "Failed to send bulk email to: {}{}".format(
+                [email for email, values in chunk],
+                e
+            )
+            logger.error(msg)
+            responses += [{
+                'Destination': [email],
+                'ResponseMetadata': {
+                    'error': msg,
+                    'HTTPStatusCode': 400,
+                    'RetryAttempts': getattr(e, 'retries', 0)
+                }
+            } for email, values in chunk]
+            continue
+
+        for (email, values), status in zip(chunk, response['Status']):
+            result = {
+                'SesMessageId': status.get('MessageId'),
+                'Destination': [email],
+                'Status': status['Status'],
+                'ResponseMetadata': {
+                    'RequestId': response['ResponseMetadata'].get('RequestId'),
+                    'HTTPStatusCode': 200,
+                    'RetryAttempts': retries
+                }
+            }
+            if status['Status'] != 'Success':
+                msg = "Failed to send email to: {} {}".format(
+                    email,
+                    status.get('Error', status['Status'])
+                )
+                logger.error(msg)
+                result['ResponseMetadata'].update({
+                    'error': msg,
+                    'HTTPStatusCode': 400
+                })
+            responses.append(result)
+
+    return responses
 
 
 def send_gcm(destination, message):
@@ -160,7 +678,8 @@ def send_gcm(destination, message):
         message (str): Required. The message to be sent.
 
     Returns:
-        The Google Cloud Messaging server response.
+        The Google Cloud Messaging server response, with the number of
+        retries it took in its X-Retry-Attempts header.
     """
     headers = {"Content-Type": "application/json"}
 
@@ -168,22 +687,126 @@ def send_gcm(destination, message):
 
     payload = {"data": {"message": message}, "to": destination}
 
-    response = requests.post(
+    response, retries = retry.call(
+        'gcm',
+        pacing.paced('gcm', clients.http().post),
         app.config['GCM_API_URL'],
         data=json.dumps(payload),
         headers=headers
     )
 
-    return Response(
+    response = Response(
         response.text,
         status=response.status_code,
         mimetype='application/json'
     )
+    response.headers['X-Retry-Attempts'] = str(retries)
+    return response
+
+
+def send_gcm_batch(tokens, message):
+    """
+    Sends a notification to many tablets running the Collect app, with one
+    GCM multicast request per GCM_BATCH_SIZE (at most 1000) registration
+    tokens. Requests that fail transiently, and tokens that GCM reports as
+    temporarily unavailable, are sent again. As the retries wait in the
+    calling request, they stop once GCM_BATCH_RETRY_BUDGET seconds have
+    passed since the batch began. Requests are paced like other GCM sends.
+
+    Args:
+        tokens ([str]): Required. The GCM registration tokens to send to.
+        message (str): Required. The message to be sent.
+
+    Returns:
+        A dict with the counts of tokens sent to ('success') and not sent to
+        ('failure'), the GCM result for each token as 'results', indexed by
+        token, the tokens GCM no longer recognises as 'invalid_tokens', and
+        the tokens GCM has replaced as 'canonical_ids', a dict mapping each
+        old token to its new token. Invalid tokens should be pruned, and
+        replaced tokens updated, by the caller.
+    """
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": "key=" + app.config['GCM_AUTHENTICATION_KEY']
+    }
+    tokens = list(dict.fromkeys(tokens))
+    results = {}
+    started = time.time()
+
+    for i in range(0, len(tokens), app.config['GCM_BATCH_SIZE']):
+        chunk = tokens[i:i + app.config['GCM_BATCH_SIZE']]
+
+        # Failed requests and unavailable tokens share the chunk's retries,
+        # within what remains of the batch's budget.
+        backoff = retry.Backoff(
+            app.config['GCM_BATCH_RETRY_BUDGET'] - (time.time() - started)
+        )
+        while chunk:
+            payload = {"data": {"message": message}, "registration_ids": chunk}
+            try:
+                with retry.deferred(backoff):
+                    response, retries = retry.call(
+                        'gcm',
+                        pacing.paced('gcm', clients.http().post),
+                        app.config['GCM_API_URL'],
+                        data=json.dumps(payload),
+                        headers=headers
+                    )
+            except retry.RetryLater as e:
+                time.sleep(e.delay)
+                continue
+            except Exception as e:
+                logger.error("Failed to send GCM batch: {}".format(e))
+                results.update({token: {'error': str(e)} for token in chunk})
+                break
+            if response.status_code != 200:
+                error = 'HTTP {}'.format(response.status_code)
+                logger.error("Failed to send GCM batch: {}".format(error))
+                results.update({token: {'error': error} for token in chunk})
+                break
+
+            try:
+                chunk_results = response.json()['results']
+            except (ValueError, KeyError, TypeError) as e:
+                error = 'Invalid response: {}'.format(e)
+                logger.error("Failed to send GCM batch: {}".format(error))
+                results.update({token: {'error': error} for token in chunk})
+                break
+
+            # GCM returns a result for each token, in the same order.
+            unavailable = []
+            for token, result in zip(chunk, chunk_results):
+                results[token] = result
+                if result.get('error') in GCM_TRANSIENT_ERRORS:
+                    unavailable.append(token)
+            delay = backoff.delay() if unavailable else None
+            chunk = unavailable if delay is not None else []
+            if chunk:
+                time.sleep(delay)
+
+    invalid = [token for token, result in results.items()
+               if result.get('error') in GCM_INVALID_ERRORS]
+    if invalid:
+        logger.info("Pruning {} invalid GCM tokens.".format(len(invalid)))
+    success = sum('message_id' in result for result in results.values())
+    return {
+        'success': success,
+        'failure': len(results) - success,
+        'results': results,
+        'invalid_tokens': invalid,
+        'canonical_ids': {
+            token: result['registration_id']
+            for token, result in results.items()
+            if result.get('registration_id')
+        }
+    }
 
 
 def log_message(messageID, details):
     """
-    Logs that a message has been sent in the relavent dynamodb table.
+    Logs that a message has been sent in the relavent dynamodb table. The
+    entry is queued and written in the background by the log writer, see
+    logwriter.py.
 
     Args:
         messageID (str): Required. The unique message ID to be logged (Str) \
@@ -191,44 +814,209 @@ def log_message(messageID, details):
         details (dict): Required. A dictionary containing any further details \
             you wish to store. Typically: destinations, message, time and \
             medium and optionally topics.
+    """
+    details['id'] = messageID
+    for key, value in time_index().items():
+        details.setdefault(key, value)
+    dedup.add(messageID)
+    logwriter.put(details)
+
+
+def delivery_id(medium, subscriber_id):
+    """
+    Returns the id of the delivery of a message to a subscriber by a medium,
+    which is unique within the message's delivery records.
+    """
+    return medium + '#' + subscriber_id
+
+
+def delivery_record(log_id, medium, subscriber_id, destination, response):
+    """
+    Creates the record of a single message delivered to a single subscriber,
+    from the response of the function that sent it.
+
+    Args:
+        log_id (str): Required. The id of the logged message.
+        medium (str): Required. The medium e.g. 'email', 'sms' or 'slack'.
+        subscriber_id (str): Required. The subscriber the message was sent to.
+        destination (str): Required. The address the message was sent to.
+        response (dict): Required. The send response, as returned by \
+            publish().
 
     Returns:
-        The Amazon DynamoDB response.
+        A dict with the log id, a delivery id unique within the log id, the
+        medium, subscriber, destination, time and status ('sent', 'failed' or
+        'queued' to be sent in a slack digest) of the delivery, and if
+        available the provider's message id or the error.
     """
-    db = boto3.resource(
-        'dynamodb',
-        endpoint_url=app.config['DB_URL'],
-        region_name='eu-west-1'
-    )
-    table = db.Table(app.config['LOG'])
+    record = {
+        'log_id': log_id,
+        'delivery_id': delivery_id(medium, subscriber_id),
+        'medium': medium,
+        'subscriber_id': subscriber_id,
+        'destination': destination,
+        'time': get_date()
+    }
+    response = response or {}
+    metadata = response.get('ResponseMetadata', {})
+    status = metadata.get('HTTPStatusCode', response.get('code'))
+    sent = status == 200 and response.get('Status', 'Success') == 'Success'
+    record['status'] = 'sent' if sent else 'failed'
+    if status == 202:
+        record['status'] = 'queued'
+    provider_id = response.get('SesMessageId', response.get('MessageId'))
+    if provider_id:
+        record['provider_id'] = provider_id
+    if metadata.get('error'):
+        record['error'] = metadata['error']
+    return record
+
+
+def log_deliveries(log_id, deliveries, responses, durable=False):
+    """
+    Logs a delivery record for each message sent, in the DELIVERIES table.
+    The records are written in batches in the background by the log writer,
+    unless they must be durable.
 
-    details['id'] = messageID
+    Args:
+        log_id (str): Required. The id of the logged message.
+        deliveries ([tuple]): Required. A (medium, subscriber_id, \
+            destination) tuple for each message sent.
+        responses ([dict]): Required. The send response for each message.
+        durable (bool): Write the records before returning, so that they \
+            survive the process dying, e.g. for a resumable publish.
+    """
+    records = [delivery_record(log_id, *delivery, response)
+               for delivery, response in zip(deliveries, responses)]
+    if durable:
+        unwritten = batch_write(
+            app.config['DELIVERIES'],
+            [{'PutRequest': {'Item': record}} for record in records]
+        )
+        records = [request['PutRequest']['Item'] for request in unwritten]
+        if records:
+            logger.warning("Failed to write {} deliveries of {}, queueing "
+                           "them instead.".format(len(records), log_id))
+    for record in records:
+        logwriter.put_delivery(record)
 
-    # If the paramaeters are too large, it can cause problems.
-    try:
-        response = table.put_item(Item=details)
-    except Exception:
-        details['message'] = 'Message too large to log.'
-        response = table.put_item(Item=details)
 
-    return response, 200
+def get_deliveries(log_id, limit=100, start=None):
+    """
+    Gets a page of the delivery records for a logged message.
+
+    Args:
+        log_id (str): Required. The id of the logged message.
+        limit (int): The maximum number of records to return.
+        start (dict): The key to start after, as returned by the previous \
+            page. Defaults to the first page.
+
+    Returns:
+        A tuple (deliveries, next) of the page of delivery records and the
+        key to start the next page from, or None if this is the last page.
+    """
+    kwargs = {
+        'KeyConditionExpression': Key('log_id').eq(log_id),
+        'Limit': limit
+    }
+    if start:
+        kwargs['ExclusiveStartKey'] = start
+    response = clients.table(app.config['DELIVERIES']).query(**kwargs)
+    return response['Items'], response.get('LastEvaluatedKey')
 
 
-def limit_exceeded():
+def sent_deliveries(log_id):
     """
-    Each time the method is called, the time of calling is recorded.
-    It then checks whether more than the allowed threshold number of calls
-    has  been made in the past hour.
+    Gets the ids of the deliveries of a logged message that were sent
+    successfully, so that resuming the message doesn't send them again.
+    Slack messages only 'queued' for a digest aren't included, as the
+    digest may never have been posted.
+
+    Args:
+        log_id (str): Required. The id of the logged message.
 
     Returns:
-        True if more than the allowed threshold number of calls has been
-        made. False otherwise.
+        A set of delivery ids, see delivery_id().
+    """
+    kwargs = {
+        'KeyConditionExpression': Key('log_id').eq(log_id),
+        'FilterExpression': Attr('status').eq('sent'),
+        'ProjectionExpression': 'delivery_id'
+    }
+    deliveries = clients.table(app.config['DELIVERIES'])
+    sent = set()
+    while True:
+        response = deliveries.query(**kwargs)
+        sent.update(item['delivery_id'] for item in response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return sent
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def delete_deliveries(log_id):
+    """
+    Deletes all the delivery records for a logged message.
+
+    Args:
+        log_id (str): Required. The id of the logged message.
+
+    Returns:
+        The number of delivery records deleted.
+    """
+    deliveries = clients.table(app.config['DELIVERIES'])
+    kwargs = {
+        'KeyConditionExpression': Key('log_id').eq(log_id),
+        'ProjectionExpression': 'log_id, delivery_id'
+    }
+    count = 0
+    with deliveries.batch_writer() as batch:
+        while True:
+            response = deliveries.query(**kwargs)
+            for key in response['Items']:
+                batch.delete_item(Key=key)
+            count += len(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                return count
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def limit_exceeded(topics=(), caller=None):
+    """
+    Each time the method is called, a call is recorded against the overall
+    publish rate limit, the limit for each topic published to and the limit
+    for the caller. It then checks whether more than the allowed threshold
+    number of calls has been made in the past hour for any of them.
+
+    Limits are configured by PUBLISH_RATE_LIMIT, PUBLISH_TOPIC_RATE_LIMIT and
+    PUBLISH_CALLER_RATE_LIMIT. A limit of 0 is not enforced.
+
+    Args:
+        topics ([str]): The topics being published to.
+        caller (str): An identifier for the caller, e.g. their IP address.
 
+    Returns:
+        A list describing each limit that has been exceeded, which is empty
+        (and therefore False) if no limit has been exceeded.
     """
-    app.config['CALL_TIMES'].append(datetime.now())
-    while app.config['CALL_TIMES'][0] < datetime.now()-timedelta(hours=1):
-            app.config['CALL_TIMES'].pop(0)
-    return len(app.config['CALL_TIMES']) > app.config['PUBLISH_RATE_LIMIT']
+    limits = [('publish', app.config['PUBLISH_RATE_LIMIT'])]
+    limits += [('publish:topic:' + topic,
+                app.config['PUBLISH_TOPIC_RATE_LIMIT']) for topic in topics]
+    if caller:
+        limits.append(('publish:caller:' + caller,
+                       app.config['PUBLISH_CALLER_RATE_LIMIT']))
+
+    exceeded = []
+    for scope, limit in limits:
+        if not limit:
+            continue
+        calls = ratelimit.hit(scope)
+        if calls > limit:
+            exceeded.append('{} ({:.0f} calls, limit {})'.format(
+                scope,
+                calls,
+                limit
+            ))
+    return exceeded
 
 
 def send_sms(destination, message):
@@ -240,11 +1028,14 @@ def send_sms(destination, message):
         message (str): Required. The message to be sent.
 
     Returns:
-        The AWS response.
+        The AWS response, with the number of retries it took as its
+        ResponseMetadata RetryAttempts.
     """
 
-    client = boto3.client('sns', region_name='eu-west-1')
-    response = client.publish(
+    client = clients.client('sns')
+    response, retries = retry.call(
+        'sns',
+        pacing.paced('sns', client.publish),
         PhoneNumber=destination,
         Message=message,
         MessageAttributes={
@@ -254,6 +1045,7 @@ def send_sms(destination, message):
             }
         }
     )
+    response.setdefault('ResponseMetadata', {})['RetryAttempts'] = retries
     return response
 
 
@@ -267,19 +1059,164 @@ def get_date():
     return datetime.fromtimestamp(time.time()).strftime('%Y:%m:%dT%H:%M:%S')
 
 
-def id_valid(messageID):
+def time_index(when=None):
+    """
+    Returns the attributes that index a log entry by the time it was logged,
+    see the LOG_TIME_INDEX config. The 'day' is the index's partition key,
+    and the 'timestamp' sorts the entries within each day.
+
+    Args:
+        when (datetime): The UTC time to index. Defaults to now.
+
+    Returns:
+        A dict with the entry's 'timestamp' and 'day'.
+    """
+    when = when or datetime.utcnow()
+    return {
+        'timestamp': when.strftime(LOG_TIMESTAMP_FORMAT),
+        'day': when.strftime(LOG_DAY_FORMAT)
+    }
+
+
+def parse_time(value):
+    """
+    Parses a UTC date, or date and time, as given to query_log().
+
+    Args:
+        value (str): Required. e.g. "2017-06-01", "2017-06-01T12:00:00" or
+            a log entry's timestamp.
+
+    Returns:
+        The datetime.
+
+    Raises:
+        ValueError: If the value isn't a date.
+    """
+    for time_format in ['%Y-%m-%d', '%Y-%m-%dT%H:%M:%S',
+                        '%Y-%m-%dT%H:%M:%SZ', LOG_TIMESTAMP_FORMAT]:
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+    raise ValueError(
+        "Invalid time {}, use YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS.".format(value)
+    )
+
+
+def query_log(start, end, medium=None, topic=None, limit=100, token=None,
+              attributes=None):
+    """
+    Gets a page of the messages logged between two times, newest first. Each
+    day in the range is read with a query of the log's time index, so only
+    the messages in the range are read, however large the log grows.
+    Messages logged before the index existed aren't included.
+
+    Args:
+        start (datetime): Required. The earliest UTC time to include.
+        end (datetime): Required. The UTC time to include messages up to,
+            but not at.
+        medium (str): Only include messages sent by this medium e.g. 'sms'.
+        topic (str): Only include messages published to this topic.
+        limit (int): The maximum number of messages to return.
+        token (dict): The token to continue from, as returned with the \
+            previous page. Defaults to the first page.
+        attributes ([str]): Only load these attributes of each message, \
+            and its id. Defaults to loading whole entries.
+
+    Returns:
+        A tuple (messages, token) of the page of log entries and the token
+        to get the next page with, or None if this is the last page.
+
+    Raises:
+        ValueError: If the range is invalid or too long, or the token isn't
+            from a query of the same range.
+    """
+    if end <= start:
+        raise ValueError("The end must be after the start.")
+    last = (end - timedelta(microseconds=1)).date()
+    count = (last - start.date()).days + 1
+    if count > app.config['LOG_QUERY_MAX_DAYS']:
+        raise ValueError("Can't query more than {} days.".format(
+            app.config['LOG_QUERY_MAX_DAYS']
+        ))
+    days = [(last - timedelta(days=i)).strftime(LOG_DAY_FORMAT)
+            for i in range(count)]
+
+    # The range is inclusive, so the end is filtered out.
+    lower = start.strftime(LOG_TIMESTAMP_FORMAT)
+    upper = end.strftime(LOG_TIMESTAMP_FORMAT)
+    conditions = Attr('timestamp').lt(upper)
+    if medium:
+        conditions &= Attr('medium').contains(medium)
+    if topic:
+        # Published messages log their topics as a string of the list, e.g.
+        # "Published to: ['Test1']", so match the topic as it appears there.
+        conditions &= (
+            Attr('topics').attribute_type('L') &
+            Attr('topics').contains(topic) |
+            Attr('topics').contains(repr(topic))
+        )
+
+    token = token or {'day': days[0]}
+    if not isinstance(token, dict) or token.get('day') not in days:
+        raise ValueError("Invalid token.")
+    i = days.index(token['day'])
+    key = token.get('key')
+
+    table = clients.table(app.config['LOG'])
+    messages = []
+    while i < len(days) and len(messages) < limit:
+        kwargs = {
+            'IndexName': app.config['LOG_TIME_INDEX'],
+            'KeyConditionExpression': Key('day').eq(days[i]) &
+            Key('timestamp').between(lower, upper),
+            'FilterExpression': conditions,
+            'ScanIndexForward': False,
+            'Limit': limit - len(messages)
+        }
+        kwargs.update(projection_kwargs(attributes))
+        if key:
+            kwargs['ExclusiveStartKey'] = key
+        response = table.query(**kwargs)
+        messages += response['Items']
+        key = response.get('LastEvaluatedKey')
+        if not key:
+            i += 1
+
+    if i == len(days):
+        return messages, None
+    token = {'day': days[i]}
+    if key:
+        token['key'] = key
+    return messages, token
+
+
+def id_valid(messageID, consistent=True):
     """
     Checks whether or not the given messageID has already been logged.
 
+    Args:
+        messageID (str): Required. The message ID to check.
+        consistent (bool): If False, ids that this process definitely hasn't \
+            seen are assumed to be new without reading the log. This is only \
+            safe if the id is then claimed with claim_id(), which fails if \
+            another process has logged it. Defaults to True.
+
     Returns:
         True for a valid message ID, False for one that has already been logged.
     """
-    db = boto3.resource(
-        'dynamodb',
-        endpoint_url=app.config['DB_URL'],
-        region_name='eu-west-1'
-    )
-    table = db.Table(app.config['LOG'])
+    seen = dedup.check(messageID)
+    if seen == dedup.SEEN:
+        return False
+
+    # Messages logged by this process may not have been written yet.
+    if logwriter.is_pending(messageID):
+        return False
+
+    if seen == dedup.NEW and not consistent:
+        return True
+
+    table = clients.table(app.config['LOG'])
     response = table.get_item(
         Key={
             'id': messageID
@@ -287,15 +1224,228 @@ def id_valid(messageID):
     )
 
     if 'Item' in response:
+        dedup.add(messageID)
         return False
     else:
         return True
 
 
-def replace_keywords(message, subscriber):
+class ClaimLost(Exception):
+    """
+    Raised when a publish's claim on its message ID has been taken over by
+    another request, so it must stop sending.
+    """
 
-    for key in subscriber:
-        placeholder = "<<" + key + ">>"
+
+def claim_id(messageID, details):
+    """
+    Claims a message ID before the message is sent, by logging it with a
+    conditional write that fails if the ID has already been logged. Only one
+    of any number of concurrent claims of the same ID can succeed, even in
+    different processes.
+
+    The claim is logged in the 'claimed' state, and moves to 'sending',
+    'done' or 'failed' as the message is published, see set_state().
+
+    Args:
+        messageID (str): Required. The message ID to claim.
+        details (dict): Required. Details of the message to log with the \
+            claim, as for log_message().
+
+    Returns:
+        A token identifying the claim, to be passed to publish() as the
+        'claim' arg, or None if the ID has already been logged.
+    """
+    table = clients.table(app.config['LOG'])
+    claim = uuid.uuid4().hex
+    try:
+        item = time_index()
+        item.update(
+            details,
+            id=messageID,
+            state='claimed',
+            claim=claim,
+            updated=int(time.time())
+        )
+        table.put_item(
+            Item=item,
+            ConditionExpression='attribute_not_exists(id)'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        claim = None
+    dedup.add(messageID)
+    return claim
+
+
+def get_log(messageID):
+    """
+    Gets a message's log record, including the state of its claim.
+
+    Args:
+        messageID (str): Required. The message ID.
+
+    Returns:
+        The log record, or None if the message hasn't been logged.
+    """
+    logwriter.flush()
+    response = clients.table(app.config['LOG']).get_item(
+        Key={'id': messageID},
+        ConsistentRead=True
+    )
+    return response.get('Item')
+
+
+def resumable(log):
+    """
+    Checks whether a logged message can be published again by a retried
+    request: because publishing it failed, or because the request that
+    claimed it hasn't updated its state within the PUBLISH_CLAIM_LEASE and
+    is assumed to have died.
+
+    Args:
+        log (dict): Required. The message's log record.
+
+    Returns:
+        True if the message's claim can be taken over.
+    """
+    state = log.get('state', 'done')
+    expired = time.time() - app.config['PUBLISH_CLAIM_LEASE']
+    return state == 'failed' or (
+        state in ['claimed', 'sending'] and log.get('updated', 0) < expired
+    )
+
+
+def take_over(messageID, log):
+    """
+    Takes over the claim on a message ID from an earlier request, using a
+    conditional write that fails if the claim has changed since the log
+    record was read.
+
+    Args:
+        messageID (str): Required. The message ID.
+        log (dict): Required. The message's log record, as read before \
+            deciding to take over.
+
+    Returns:
+        A token identifying the new claim, or None if another request has
+        changed or taken over the claim first.
+    """
+    claim = uuid.uuid4().hex
+    try:
+        clients.table(app.config['LOG']).update_item(
+            Key={'id': messageID},
+            UpdateExpression=(
+                'SET #state = :claimed, claim = :claim, updated = :updated'
+            ),
+            ConditionExpression='claim = :old AND updated = :old_updated',
+            ExpressionAttributeNames={'#state': 'state'},
+            ExpressionAttributeValues={
+                ':claimed': 'claimed',
+                ':claim': claim,
+                ':updated': int(time.time()),
+                ':old': log.get('claim'),
+                ':old_updated': log.get('updated')
+            }
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return None
+    return claim
+
+
+def set_state(messageID, claim, state, details=None):
+    """
+    Records a new state for a claimed message, renewing the claim's lease.
+
+    Args:
+        messageID (str): Required. The message ID.
+        claim (str): Required. The token of the claim, from claim_id().
+        state (str): Required. 'sending', 'done' or 'failed'.
+        details (dict): Any further details to log with the state.
+
+    Raises:
+        ClaimLost: If the claim has been taken over by another request.
+    """
+    values = dict(details or {}, state=state, updated=int(time.time()))
+    names = {}
+    placeholders = {':claim': claim}
+    assignments = []
+    for i, (key, value) in enumerate(values.items()):
+        names['#a{}'.format(i)] = key
+        placeholders[':a{}'.format(i)] = value
+        assignments.append('#a{0} = :a{0}'.format(i))
+    try:
+        clients.table(app.config['LOG']).update_item(
+            Key={'id': messageID},
+            UpdateExpression='SET ' + ', '.join(assignments),
+            ConditionExpression='claim = :claim',
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=placeholders
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        raise ClaimLost(
+            "The claim on message {} has been taken over.".format(messageID)
+        )
+
+
+class MailMerge(object):
+    """
+    A mail merge message, parsed once into its literal text and the mail
+    merge fields between, so that it can be rendered for each subscriber with
+    a single join. Fields are written <<key>> e.g. <<first_name>>.
+
+    Args:
+        message (str): Required. The mail merge message.
+    """
+
+    def __init__(self, message):
+        parts = MAIL_MERGE_FIELD.split(message)
+        # Splitting on the field pattern alternates text, field, text...
+        self.chunks = parts[0::2]
+        self.fields = parts[1::2]
+        self.placeholders = ['<<' + field + '>>' for field in self.fields]
+
+    def render(self, values):
+        """
+        Renders the message with the given mail merge values. Fields without
+        a value are left as they are.
+
+        Args:
+            values (dict): Required. The string value for each field.
+
+        Returns:
+            The rendered message.
+        """
+        if not self.fields:
+            return self.chunks[0]
+        parts = [self.chunks[0]]
+        for field, placeholder, chunk in zip(self.fields, self.placeholders,
+                                             self.chunks[1:]):
+            parts.append(values.get(field, placeholder))
+            parts.append(chunk)
+        return ''.join(parts)
+
+
+def keyword_values(subscriber, keys=None):
+    """
+    Formats a subscriber's attributes for mail merging.
+
+    Args:
+        subscriber (dict): Required. The subscriber record.
+        keys ([str]): The attributes to format. Defaults to all of them.
+
+    Returns:
+        A dict of the string value to merge for each subscriber attribute.
+    """
+    values = {}
+    for key in subscriber if keys is None else keys:
+        if key not in subscriber:
+            continue
         replace = str(subscriber[key])
         # If it's a list, e.g. topics, then it's a little more complicated.
         if isinstance(subscriber[key], list):
@@ -306,15 +1456,156 @@ def replace_keywords(message, subscriber):
                     replace += ', '
                 elif i == len(subscriber[key]) - 2:
                     replace += ' and '
-        message = message.replace(placeholder, replace)
-    return message
+        values[key] = replace
+    return values
+
+
+def replace_keywords(message, subscriber):
+    """
+    Mail merges a single message for a single subscriber. When sending the
+    same message to many subscribers, create a MailMerge once instead.
+
+    Args:
+        message (str): Required. The mail merge message.
+        subscriber (dict): Required. The subscriber record.
+
+    Returns:
+        The message with each <<key>> replaced by the subscriber's value.
+    """
+    template = MailMerge(message)
+    return template.render(keyword_values(subscriber, template.fields))
+
+
+def update_subscriber(subscriber_id, fields=None, add_topics=(),
+                      remove_topics=()):
+    """
+    Changes a subscriber's details in place, keeping their id and
+    verification. Only the given fields are written. Topics are added and
+    removed with a write conditional on the topics being unchanged since
+    they were read, retried if another update gets there first, so that
+    concurrent topic changes aren't lost. The subscriber's subscriptions
+    are kept in step with their topics.
+
+    Args:
+        subscriber_id (str): Required. The subscriber's unique id.
+        fields (dict): New values for any of SUBSCRIBER_FIELDS, or a new
+            list of "topics". An empty "sms" or "slack" removes it.
+        add_topics ([str]): Topics to subscribe to.
+        remove_topics ([str]): Topics to unsubscribe from.
+
+    Returns:
+        The updated subscriber record, or None if the subscriber doesn't
+        exist.
+
+    Raises:
+        ValueError: If the changes aren't valid.
+    """
+    fields = dict(fields or {})
+    unknown = set(fields) - set(SUBSCRIBER_FIELDS + ['topics'])
+    if unknown:
+        raise ValueError("Can't update {}.".format(", ".join(sorted(unknown))))
+    if 'topics' in fields and (add_topics or remove_topics):
+        raise ValueError("Either replace the topics, or add and remove them.")
+    if not (fields or add_topics or remove_topics):
+        raise ValueError("Nothing to update.")
+    removed = [f for f in SUBSCRIBER_REQUIRED if f in fields and not fields[f]]
+    if removed:
+        raise ValueError("Can't remove {}.".format(", ".join(removed)))
+
+    names = {'#id': 'id'}
+    values = {}
+    assignments = []
+    removals = []
+    for i, (key, value) in enumerate(fields.items()):
+        if key == 'topics':
+            continue
+        names['#a{}'.format(i)] = key
+        if value:
+            values[':a{}'.format(i)] = value
+            assignments.append('#a{0} = :a{0}'.format(i))
+        else:
+            removals.append('#a{}'.format(i))
+
+    table = clients.table(app.config['SUBSCRIBERS'])
+    changes_topics = 'topics' in fields or add_topics or remove_topics
+    for attempt in range(app.config['RETRY_ATTEMPTS'] + 1):
+        condition = 'attribute_exists(#id)'
+        expression_values = dict(values)
+        updates = list(assignments)
+        old = new = []
+        if changes_topics:
+            current = table.get_item(
+                Key={'id': subscriber_id},
+                ConsistentRead=True,
+                ProjectionExpression='topics'
+            ).get('Item')
+            if current is None:
+                return None
+            old = current.get('topics', [])
+            if 'topics' in fields:
+                new = list(dict.fromkeys(fields['topics']))
+            else:
+                new = [t for t in old if t not in remove_topics]
+                new += [t for t in dict.fromkeys(add_topics) if t not in new]
+            if not new:
+                raise ValueError("A subscriber needs at least one topic.")
+            names['#topics'] = 'topics'
+            condition += ' AND #topics = :old_topics'
+            expression_values[':old_topics'] = old
+            if new != old:
+                expression_values[':topics'] = new
+                updates.append('#topics = :topics')
+
+        expression = ' '.join(filter(None, [
+            'SET ' + ', '.join(updates) if updates else '',
+            'REMOVE ' + ', '.join(removals) if removals else ''
+        ]))
+        if not expression:
+            # The topics already match, and there is nothing else to write.
+            return get_subscriber(subscriber_id)
+        kwargs = {'UpdateExpression': expression}
+        if expression_values:
+            kwargs['ExpressionAttributeValues'] = expression_values
+
+        try:
+            response = table.update_item(
+                Key={'id': subscriber_id},
+                ConditionExpression=condition,
+                ExpressionAttributeNames=names,
+                ReturnValues='ALL_NEW',
+                **kwargs
+            )
+            break
+        except ClientError as e:
+            if e.response['Error']['Code'] != \
+                    'ConditionalCheckFailedException':
+                raise
+            if not changes_topics:
+                return None
+            if attempt == app.config['RETRY_ATTEMPTS']:
+                raise
+            logger.info("Topics of subscriber {} changed, retrying.".format(
+                subscriber_id
+            ))
+
+    subscriber = response['Attributes']
+    cache.invalidate('subscribers', [subscriber_id])
+
+    # Only verified subscribers have active subscriptions.
+    if subscriber.get('verified') and new != old:
+        added = [t for t in new if t not in old]
+        dropped = [t for t in old if t not in new]
+        if added:
+            create_subscriptions(subscriber_id, added)
+        if dropped:
+            delete_subscriptions(subscriber_id, dropped)
+    return subscriber
 
 
 def delete_subscriber(subscriber_id):
     """
-    Delete a subscriber from the database. At the moment, if a user wishes to
-    change information, they need to delete themselves and then re-add
-    themselves with the new information.
+    Delete a subscriber from the database. To change a subscriber's details,
+    see update_subscriber().
 
     Args:
          subscriber_id (str)
@@ -322,12 +1613,7 @@ def delete_subscriber(subscriber_id):
     Returns:
          The amazon dynamodb response.
     """
-    db = boto3.resource(
-        'dynamodb',
-        endpoint_url=app.config['DB_URL'],
-        region_name='eu-west-1'
-    )
-    subscribers = db.Table(app.config['SUBSCRIBERS'])
+    subscribers = clients.table(app.config['SUBSCRIBERS'])
 
     subscribers_response = subscribers.delete_item(
         Key={
@@ -336,10 +1622,386 @@ def delete_subscriber(subscriber_id):
         ReturnValues='ALL_OLD'
     )
 
+    cache.invalidate('subscribers', [subscriber_id])
+
+    # Remove the subscriber from the topic index.
+    deleted = subscribers_response.get('Attributes')
+    if deleted:
+        delete_subscriptions(subscriber_id, deleted.get('topics', []))
+
     return subscribers_response
 
 
-def publish(args):
+def batch_write(table_name, requests):
+    """
+    Writes many items to a table using BatchWriteItem, 25 requests at a time.
+    Requests that DynamoDB leaves unprocessed are retried with backoff, see
+    retry.Backoff.
+
+    Args:
+        table_name (str): Required. The table to write to.
+        requests ([dict]): Required. The PutRequest and DeleteRequest write
+            requests. No two requests may be for the same key.
+
+    Returns:
+        The requests that were still unprocessed once the retries ran out.
+    """
+    failed = []
+    for i in range(0, len(requests), 25):
+        request = {table_name: requests[i:i+25]}
+        backoff = retry.Backoff()
+        while request:
+            response = clients.dynamodb().batch_write_item(
+                RequestItems=request
+            )
+            request = response.get('UnprocessedItems')
+            if not request:
+                break
+            delay = backoff.delay()
+            if delay is None:
+                failed += request.get(table_name, [])
+                break
+            time.sleep(delay)
+    return failed
+
+
+def bulk_subscriber(row):
+    """
+    Validates a row of a bulk subscribe, and creates its subscriber record.
+    Rows take the same fields as subscribe(), and may give the topics as a
+    single string and verified as the string "True".
+
+    Args:
+        row (dict): Required. The subscriber's details.
+
+    Returns:
+        The subscriber record, see new_subscriber().
+
+    Raises:
+        ValueError: If the row isn't a valid subscriber.
+    """
+    if not isinstance(row, dict):
+        raise ValueError("Row is not an object.")
+    required = ['first_name', 'last_name', 'email', 'country', 'topics']
+    missing = [field for field in required if not row.get(field)]
+    if missing:
+        raise ValueError("Missing {}.".format(", ".join(missing)))
+    topics = row['topics']
+    if isinstance(topics, str):
+        topics = [topics]
+    fields = ['first_name', 'last_name', 'email', 'country', 'sms', 'slack']
+    if not isinstance(topics, list) or \
+            not all(isinstance(topic, str) and topic for topic in topics) or \
+            not all(isinstance(row.get(field, ''), str) for field in fields):
+        raise ValueError("Topics must be a list of strings, and the other "
+                         "fields strings.")
+    return new_subscriber(
+        row['first_name'],
+        row['last_name'],
+        row['email'],
+        row['country'],
+        list(dict.fromkeys(topics)),
+        row.get('sms', ''),
+        row.get('slack', ''),
+        row.get('verified') in [True, 'True', 'true']
+    )
+
+
+def bulk_chunks(rows):
+    """
+    Splits the rows of a bulk request into chunks of BULK_CHUNK_SIZE rows,
+    reading them only as each chunk is needed.
+
+    Args:
+        rows (iterable): Required. The rows.
+
+    Returns:
+        A generator of lists of (index, row) tuples.
+    """
+    rows = enumerate(rows)
+    while True:
+        chunk = list(itertools.islice(rows, app.config['BULK_CHUNK_SIZE']))
+        if not chunk:
+            return
+        yield chunk
+
+
+def bulk_subscribe(rows):
+    """
+    Subscribes many users at once. Each row is validated on its own, and the
+    valid subscribers and their subscriptions are written in batches, a
+    chunk of rows at a time as they are read.
+
+    Args:
+        rows (iterable): Required. The subscribers' details, see
+            bulk_subscriber().
+
+    Returns:
+        A list with a result for each row, in order, with the row's index as
+        "row" and a "status" of "subscribed", "invalid" or "failed". Invalid
+        and failed rows include an "error", and written rows the
+        "subscriber_id".
+    """
+    results = []
+    for chunk in bulk_chunks(rows):
+        results += _bulk_subscribe_chunk(chunk)
+    return results
+
+
+def _bulk_subscribe_chunk(chunk):
+    # Subscribes a chunk of (index, row) tuples, returning their results.
+    results = {}
+    subscribers = []
+    for i, row in chunk:
+        try:
+            subscriber = bulk_subscriber(row)
+        except ValueError as e:
+            results[i] = {'row': i, 'status': 'invalid', 'error': str(e)}
+            continue
+        results[i] = {
+            'row': i,
+            'status': 'subscribed',
+            'subscriber_id': subscriber['id']
+        }
+        subscribers.append((i, subscriber))
+
+    failed = {r['PutRequest']['Item']['id'] for r in batch_write(
+        app.config['SUBSCRIBERS'],
+        [{'PutRequest': {'Item': s}} for i, s in subscribers]
+    )}
+
+    # Only verified subscribers have active subscriptions.
+    subscriptions = [
+        {'PutRequest': {'Item': {'topicID': t, 'subscriberID': s['id']}}}
+        for i, s in subscribers
+        if s['verified'] and s['id'] not in failed for t in s['topics']
+    ]
+    unindexed = batch_write(app.config['SUBSCRIPTIONS'], subscriptions)
+    cache.invalidate('topics', list({
+        r['PutRequest']['Item']['topicID'] for r in subscriptions
+    }))
+
+    unindexed = {r['PutRequest']['Item']['subscriberID'] for r in unindexed}
+    for i, subscriber in subscribers:
+        if subscriber['id'] in failed:
+            results[i] = {
+                'row': i,
+                'status': 'failed',
+                'error': 'Failed to write the subscriber.'
+            }
+        elif subscriber['id'] in unindexed:
+            results[i].update(
+                status='failed',
+                error='Failed to write the subscriptions.'
+            )
+    return [results[i] for i, row in chunk]
+
+
+def bulk_unsubscribe(subscriber_ids):
+    """
+    Deletes many subscribers and their subscriptions at once, in batches, a
+    chunk of IDs at a time as they are read.
+
+    Args:
+        subscriber_ids (iterable): Required. The IDs of the subscribers to
+            delete.
+
+    Returns:
+        A list with a result for each ID, in order, with the ID's index as
+        "row", the "subscriber_id" and a "status" of "unsubscribed",
+        "not found", "invalid" or "failed". An ID repeated in a later chunk
+        is "not found", as it has already been deleted.
+    """
+    results = []
+    for chunk in bulk_chunks(subscriber_ids):
+        results += _bulk_unsubscribe_chunk(chunk)
+    return results
+
+
+def _bulk_unsubscribe_chunk(chunk):
+    # Unsubscribes a chunk of (index, subscriber ID) tuples, returning their
+    # results.
+    valid = [s for i, s in chunk if isinstance(s, str) and s]
+    subscribers = get_subscribers(valid, ['topics'])
+    ids = list(dict.fromkeys(s for s in valid if s in subscribers))
+
+    subscriptions = {}
+    for subscriber_id in ids:
+        for topic in subscribers[subscriber_id].get('topics', []):
+            key = {'topicID': topic, 'subscriberID': subscriber_id}
+            subscriptions[(topic, subscriber_id)] = {
+                'DeleteRequest': {'Key': key}
+            }
+
+    # Remove the subscriptions first, so that a subscriber whose
+    # subscriptions fail to be removed isn't left in the topic index.
+    unindexed = {
+        r['DeleteRequest']['Key']['subscriberID']
+        for r in batch_write(
+            app.config['SUBSCRIPTIONS'],
+            list(subscriptions.values())
+        )
+    }
+    failed = {r['DeleteRequest']['Key']['id'] for r in batch_write(
+        app.config['SUBSCRIBERS'],
+        [{'DeleteRequest': {'Key': {'id': s}}}
+         for s in ids if s not in unindexed]
+    )} | unindexed
+    cache.invalidate('subscribers', ids)
+    cache.invalidate('topics', list({t for t, s in subscriptions}))
+
+    results = []
+    for i, subscriber_id in chunk:
+        result = {'row': i, 'subscriber_id': subscriber_id}
+        if not isinstance(subscriber_id, str) or not subscriber_id:
+            result['status'] = 'invalid'
+        elif subscriber_id not in subscribers:
+            result['status'] = 'not found'
+        elif subscriber_id in failed:
+            result['status'] = 'failed'
+        else:
+            result['status'] = 'unsubscribed'
+        results.append(result)
+    return results
+
+
+def dispatch(jobs, progress=None, on_result=None):
+    """
+    Runs a list of send jobs concurrently. Each medium gets its own bounded
+    pool of worker threads, sized by the PUBLISH_WORKERS config, so that a
+    slow medium can't starve the others of workers.
+
+    Sends that are throttled by their provider don't wait in their worker
+    thread. The job is run again once its backoff delay has passed, leaving
+    the thread free for other jobs in the meantime, see retry.py.
+
+    Args:
+        jobs ([tuple]): Required. A list of (medium, function, args) tuples.
+            Each function is called with the given args tuple. A fourth
+            element can give the number of messages the job sends, if more
+            than one.
+        progress (function): Called each time a job finishes, with a dict of
+            {'total': int, 'sent': int} message counts for each medium.
+        on_result (function): Called each time a job finishes, with the
+            job's index and return value. If it raises an exception, the
+            jobs that haven't started are cancelled.
+
+    Returns:
+        A list of the functions' return values, in the same order as the jobs.
+    """
+    executors = {}
+    counts = {}
+    sizes = [job[3] if len(job) > 3 else 1 for job in jobs]
+    backoffs = [None] * len(jobs)
+    results = [None] * len(jobs)
+    pending = {}
+    waiting = []
+
+    def run(function, function_args, index):
+        # A job's retry budget starts from its first attempt, not from when
+        # it was queued.
+        if backoffs[index] is None:
+            backoffs[index] = retry.Backoff()
+        with retry.deferred(backoffs[index]):
+            return function(*function_args)
+
+    def submit(index):
+        medium, function, function_args = jobs[index][:3]
+        future = executors[medium].submit(
+            run, function, function_args, index
+        )
+        pending[future] = index
+
+    try:
+        for index, job in enumerate(jobs):
+            medium = job[0]
+            if medium not in executors:
+                executors[medium] = ThreadPoolExecutor(
+                    max_workers=app.config['PUBLISH_WORKERS'].get(medium, 1),
+                    thread_name_prefix='hermes-' + medium
+                )
+                counts[medium] = {'total': 0, 'sent': 0}
+            counts[medium]['total'] += sizes[index]
+            submit(index)
+
+        while pending or waiting:
+            # Resubmit the jobs whose retry delay has passed, and wait for a
+            # job to finish or for the next retry to be due.
+            while waiting and waiting[0][0] <= time.time():
+                submit(heapq.heappop(waiting)[1])
+            timeout = None
+            if waiting:
+                timeout = max(waiting[0][0] - time.time(), 0)
+            done, not_done = wait(
+                pending,
+                timeout=timeout,
+                return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    results[index] = future.result()
+                except retry.RetryLater as e:
+                    heapq.heappush(waiting, (time.time() + e.delay, index))
+                    continue
+                counts[jobs[index][0]]['sent'] += sizes[index]
+                if on_result:
+                    on_result(index, results[index])
+                if progress:
+                    progress(counts)
+        return results
+    except Exception:
+        for future in pending:
+            future.cancel()
+        raise
+    finally:
+        for executor in executors.values():
+            executor.shutdown()
+
+
+def _publish_email(email, subject, message, html_message, sender):
+    response = send_email([email], subject, message, html_message, sender)
+    response['type'] = 'email'
+    response['message'] = message
+    return response
+
+
+def _publish_bulk_email(template, recipients, messages, sender):
+    responses = send_bulk_email(template, recipients, sender)
+    for response, message in zip(responses, messages):
+        response['type'] = 'email'
+        response['message'] = message
+    return responses
+
+
+def _publish_sms(sms, sms_message):
+    response = send_sms(sms, sms_message)
+    response['type'] = 'sms'
+    response['message'] = sms_message
+    return response
+
+
+def _publish_slack(channel, message, subject):
+    response = slack(channel, message, subject)
+    return {
+        'message': message,
+        'type': 'slack',
+        'code': response.status_code,
+        'retries': getattr(response, 'retries', 0)
+    }
+
+
+def _coalesce_slack(channel, message, subject):
+    coalesce.add(channel, message, subject, slack)
+    return {
+        'message': message,
+        'type': 'slack',
+        'code': 202,
+        'coalesced': True
+    }
+
+
+def publish(args, progress=None):
     """
     Publishes a message to a given topic set. All subscribers with
     subscriptions to any of those topics are to receive the message.
@@ -363,9 +2025,25 @@ def publish(args):
             subject (str): The e-mail subject. Defaults to "".
             from (str): The address from which to send the message. Deafults to \
                 an emro address stored in the config.
+            coalesce (bool): Post slack messages in a digest with the other \
+                slack messages to the same channel in the next \
+                SLACK_COALESCE_WINDOW seconds, see coalesce.py. Ignored for \
+                a claimed message, which can't record whether the digest \
+                was posted. Defaults to False.
+            claim (str): The token of the claim on the message ID, from \
+                claim_id(). If given, the claim's state and progress are \
+                recorded as the message is sent.
+            resume (bool): Whether the claim was taken over from an \
+                earlier attempt to publish the message, see take_over(). \
+                If so, subscribers already sent the message by the earlier \
+                attempt are skipped. Defaults to False.
+        progress (function): Optional. Called with per-medium counts of the \
+            messages sent so far, see dispatch().
 
     Returns:
-        An array of amazon SES and nexmo responses for each message sent.
+        An array of amazon SES and nexmo responses for each message sent. A
+        resumed message only returns responses for the messages it sent
+        after resuming.
     """
 
     # Set the default values for the non-required fields.
@@ -378,104 +2056,216 @@ def publish(args):
     if not args.get('from', ''):
         args['from'] = app.config['SENDER']
 
-    # Load the database.
-    db = boto3.resource(
-        'dynamodb',
-        endpoint_url=app.config['DB_URL'],
-        region_name='eu-west-1'
-    )
-    subscribers_table = db.Table(app.config['SUBSCRIBERS'])
+    # Identify those subscribed to the given topics with one query per topic,
+    # combining them in order without duplications.
+    subscriber_ids = []
+    for topic in args['topics']:
+        subscriber_ids += get_topic_subscribers(topic)
+    subscriber_ids = list(dict.fromkeys(subscriber_ids))
 
-    # Identify those subscribed to the given topics.
+    # Load the subscriber records. Only verified subscribers are indexed, but
+    # check again in case the index is behind the subscribers table.
+    records = get_subscribers(subscriber_ids)
     subscribers = {}
-    kwargs = {}
-    # Load data separately for each country - Scan can't perform OR on CONTAINS
-    for topic in args['topics']:
-        kwargs["ScanFilter"] = {
-            'topics': {
-                'AttributeValueList': [topic],
-                'ComparisonOperator': 'CONTAINS'
-            },
-            'verified': {
-                'AttributeValueList': [True],
-                'ComparisonOperator': 'EQ'
-            }
-        }
-        # Get and combine the users together in a no-duplications dict.
-        for subscriber in subscribers_table.scan(**kwargs).get("Items", []):
-            subscribers[subscriber["id"]] = subscriber
+    for subscriber_id in subscriber_ids:
+        subscriber = records.get(subscriber_id)
+        if subscriber and subscriber.get('verified'):
+            subscribers[subscriber_id] = subscriber
+
+    logger.debug('Publishing to {} subscribers.'.format(len(subscribers)))
+
+    # A message taken over from an earlier attempt may be resuming a publish
+    # that stopped part way through, so skip the deliveries that have
+    # already been sent. A newly claimed ID can't have any.
+    claim = args.get('claim')
+    sent = set()
+    if claim and args.get('resume'):
+        sent = sent_deliveries(args['id'])
+    if sent:
+        logger.info('Resuming message {}, {} deliveries already sent.'.format(
+            args['id'], len(sent)
+        ))
+
+    # Parse the mail merge messages once, reusing them where they're the same.
+    templates = {}
+    for key in ['message', 'sms-message', 'html-message']:
+        if args[key] not in templates:
+            templates[args[key]] = MailMerge(args[key])
+    message_template = templates[args['message']]
+    sms_template = templates[args['sms-message']]
+    html_template = templates[args['html-message']]
+    fields = list(dict.fromkeys(
+        message_template.fields + sms_template.fields + html_template.fields
+    ))
+
+    # Bursts of slack notifications can be coalesced into digests. A claimed
+    # message posts its own, so that each delivery it records as sent was.
+    publish_slack = _publish_slack
+    if args.get('coalesce') and app.config['SLACK_COALESCE_WINDOW'] and \
+            not claim:
+        publish_slack = _coalesce_slack
+
+    # Send emails to many subscribers in bulk using an SES template, if the
+    # message can be written as one.
+    template = None
+    emails = [subscriber_id for subscriber_id in subscribers
+              if delivery_id('email', subscriber_id) not in sent]
+    if ('email' in args['medium'] and app.config['SES_BULK_EMAIL'] and
+            len(emails) > 1):
+        template = create_email_template(
+            args['subject'],
+            message_template,
+            html_template
+        )
 
-    print('SUBSCRIBERS: ' + str(subscribers))
+    # Record details about the sent messages. Each job fills the listed
+    # indices of the deliveries and responses.
+    jobs = []
+    job_indices = []
+    deliveries = []
+    bulk_emails = []
 
-    # Record details about the sent messages.
-    responses = []
-    destinations = []
-
-    # Send the messages to each subscriber.
+    # Assemble the messages for each subscriber.
     for subscriber_id, subscriber in subscribers.items():
 
-        # Create some variables to hold the mailmerged messages.
-        message = args['message']
-        sms_message = args['sms-message']
-        html_message = args['html-message']
-
-        # Enable mail merging on subscriber attributes.
-        message = replace_keywords(message, subscriber)
-        if args['sms-message']:
-            sms_message = replace_keywords(
-                sms_message, subscriber
-            )
-        if args['html-message']:
-            html_message = replace_keywords(
-                html_message, subscriber
-            )
-
-        # Assemble and send the messages for each medium.
-        if 'email' in args['medium']:
-            temp = send_email(
-                [subscriber['email']],
+        mediums = [medium for medium in args['medium']
+                   if delivery_id(medium, subscriber_id) not in sent]
+        if not mediums:
+            continue
+
+        # Enable mail merging on subscriber attributes, rendering each
+        # message only if it is needed.
+        values = keyword_values(subscriber, fields)
+        message = message_template.render(values)
+        sms_message = message
+        if 'sms' in mediums and sms_template is not message_template:
+            sms_message = sms_template.render(values)
+        html_message = message
+        if html_template is not message_template and not template:
+            html_message = html_template.render(values)
+
+        # Queue up the messages for each medium.
+        if 'email' in mediums and template:
+            bulk_emails.append((
+                len(deliveries),
+                (subscriber['email'], values),
+                message
+            ))
+            deliveries.append(('email', subscriber_id, subscriber['email']))
+
+        elif 'email' in mediums:
+            jobs.append(('email', _publish_email, (
+                subscriber['email'],
                 args['subject'],
                 message,
                 html_message,
-                sender=args['from']
-            )
-            temp['type'] = 'email'
-            temp['message'] = message
-            responses.append(temp)
-            destinations.append(subscriber['email'])
+                args['from']
+            )))
+            job_indices.append([len(deliveries)])
+            deliveries.append(('email', subscriber_id, subscriber['email']))
 
-        if 'sms' in args['medium'] and 'sms' in subscriber:
-            temp = send_sms(
+        if 'sms' in mediums and 'sms' in subscriber:
+            jobs.append(('sms', _publish_sms, (
                 subscriber['sms'],
                 sms_message
-            )
-            temp['type'] = 'sms'
-            temp['message'] = sms_message
-            responses.append(temp)
-            destinations.append(subscriber['sms'])
+            )))
+            job_indices.append([len(deliveries)])
+            deliveries.append(('sms', subscriber_id, subscriber['sms']))
 
-        if 'slack' in args['medium'] and 'slack' in subscriber:
-            temp = slack(
+        if 'slack' in mediums and 'slack' in subscriber:
+            jobs.append(('slack', publish_slack, (
                 subscriber['slack'],
                 message,
                 args['subject']
+            )))
+            job_indices.append([len(deliveries)])
+            deliveries.append(('slack', subscriber_id, subscriber['slack']))
+
+    # Split the bulk emails into one job per SES bulk send.
+    for i in range(0, len(bulk_emails), app.config['SES_BULK_SIZE']):
+        chunk = bulk_emails[i:i + app.config['SES_BULK_SIZE']]
+        jobs.append(('email', _publish_bulk_email, (
+            template,
+            [recipient for index, recipient, message in chunk],
+            [message for index, recipient, message in chunk],
+            args['from']
+        ), len(chunk)))
+        job_indices.append([index for index, recipient, message in chunk])
+
+    # Send the messages concurrently, putting the responses in the same order
+    # as the deliveries. Each delivery is logged as soon as it is sent. A
+    # claimed message instead holds its deliveries until the next checkpoint
+    # and writes them in one batch, so that a resumed publish knows who has
+    # already been sent the message even if this process dies, without a
+    # round trip to the database for every job.
+    responses = [None] * len(deliveries)
+    checkpoint = {'time': time.time(), 'sent': len(sent)}
+    pending = []
+
+    def write_pending():
+        if pending:
+            log_deliveries(
+                args['id'],
+                [delivery for delivery, response in pending],
+                [response for delivery, response in pending],
+                durable=True
             )
-            request_status = {
-                'message': message,
-                'type': 'slack',
-                'code': temp.status_code
-            }
-            responses.append(request_status)
-            destinations.append(subscriber['slack'])
-
-    # Log the message
-    log_message(args['id'], {
-        'destination': destinations,
+            del pending[:]
+
+    def on_result(index, result):
+        if not isinstance(result, list):
+            result = [result]
+        for i, response in zip(job_indices[index], result):
+            responses[i] = response
+        delivered = [deliveries[i] for i in job_indices[index]]
+        checkpoint['sent'] += len(result)
+        if not claim:
+            log_deliveries(args['id'], delivered, result)
+            return
+
+        # Record the progress of a claimed message, renewing its claim.
+        pending.extend(zip(delivered, result))
+        interval = app.config['PUBLISH_CHECKPOINT_INTERVAL']
+        if time.time() - checkpoint['time'] > interval:
+            write_pending()
+            set_state(args['id'], claim, 'sending',
+                      {'sent_count': checkpoint['sent']})
+            checkpoint['time'] = time.time()
+        elif len(pending) >= app.config['PUBLISH_CHECKPOINT_DELIVERIES']:
+            write_pending()
+
+    # A claimed message records each change of state so that retried
+    # requests know whether to resume it.
+    try:
+        if claim:
+            set_state(args['id'], claim, 'sending')
+        dispatch(jobs, progress, on_result)
+        write_pending()
+    except Exception as e:
+        if claim and not isinstance(e, ClaimLost):
+            try:
+                write_pending()
+            finally:
+                logwriter.flush()
+                set_state(args['id'], claim, 'failed', {'error': str(e)})
+        raise
+    finally:
+        if template:
+            delete_email_template(template[0])
+
+    # Log the message, with a separate record of each delivery so that the
+    # log item stays small however many subscribers there are.
+    details = {
+        'delivery_count': len(sent) + len(deliveries),
         'medium': args['medium'],
         'time': get_date(),
         'message': args['message'],
         'topics': 'Published to: ' + str(args['topics'])
-    })
+    }
+    if claim:
+        set_state(args['id'], claim, 'done', details)
+    else:
+        log_message(args['id'], details)
 
     return responses
 
@@ -510,9 +2300,11 @@ def error(args):
     if not args.get('sms-message', ''):
         args['sms-message'] = args['message']
 
-    # Publish any messages to the hot-topic error-reporting.
+    # Publish any messages to the hot-topic error-reporting, coalescing
+    # error storms on slack.
     args['topics'] = app.config['ERROR_REPORTING']
     args['id'] = 'ERROR-'+str(datetime.now().isoformat())
+    args['coalesce'] = True
 
     # Publish!
     return publish(args)
@@ -547,9 +2339,11 @@ def notify(args):
     if not args.get('sms-message', ''):
         args['sms-message'] = args['message']
 
-    # Publish any messages to the hot-topic notices.
+    # Publish any messages to the hot-topic notices, coalescing bursts on
+    # slack.
     args['topics'] = app.config['NOTIFY_DEV']
     args['id'] = 'NOTICE-'+str(datetime.now().isoformat())
+    args['coalesce'] = True
 
     # Publish!
     return publish(args)
@@ -0,0 +1,8 @@
+#!/usr/bin/env python3
+"""
+Runs a worker that sends the publish jobs queued by `/publish` when called
+with async=True (or with the PUBLISH_ASYNC config set). Run as many workers
+as needed, they share the queue configured by PUBLISH_QUEUE.
+"""
+from meerkat_hermes import jobs
+jobs.work()